@@ -10,6 +10,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 import collections
+import threading
 
 import sqlalchemy as sa
 
@@ -22,6 +23,16 @@ _CONSUMER_TYPE_TBL = models.ConsumerType.__table__
 _RC_TBL = models.ResourceClass.__table__
 _TRAIT_TBL = models.Trait.__table__
 
+# The content of each table last read by any request of this process, keyed
+# by _AttributeCache subclass, if [placement]shared_attribute_cache is
+# enabled. The values are _SharedAttributes namedtuples that are replaced but
+# never modified, so request caches can use their dicts directly.
+_SHARED = {}
+_SHARED_LOCK = threading.Lock()
+
+_SharedAttributes = collections.namedtuple(
+    "_SharedAttributes", ["version", "id_cache", "str_cache", "all_cache"])
+
 
 class _AttributeCache(object):
     """A cache of integer and string lookup values for string-based attributes.
@@ -38,6 +49,11 @@ class _AttributeCache(object):
 
     Despite that requirement, any time an entity associated with a cache is
     created, updated, or deleted `clear()` should be called on the cache.
+
+    If [placement]shared_attribute_cache is enabled the content of the table
+    read by a request is shared with the later requests of the same process.
+    A request uses the shared content instead of reading the whole table if
+    a cheap query shows the table has not changed since it was read.
     """
     _table = None
     _not_found = None
@@ -59,12 +75,19 @@ class _AttributeCache(object):
         assert self._table is not None, "_table must be defined"
         assert self._not_found is not None, "_not_found must be defined"
         self._ctx = ctx
-        self.clear()
+        self._reset()
 
-    def clear(self):
+    def _reset(self):
         self._id_cache = {}
         self._str_cache = {}
         self._all_cache = {}
+        # Whether this cache was already checked against the shared content
+        self._shared_checked = False
+
+    def clear(self):
+        self._reset()
+        with _SHARED_LOCK:
+            _SHARED.pop(type(self), None)
 
     def id_from_string(self, attr_str):
         """Given a string representation of an attribute -- e.g. "DISK_GB"
@@ -141,14 +164,33 @@ class _AttributeCache(object):
             self._refresh_from_db(self._ctx)
         return self._all_cache.values()
 
-    @db_api.placement_context_manager.reader
+    @db_api.placement_context_manager.reader.allow_async
     def _refresh_from_db(self, ctx):
         """Grabs all resource classes or traits from the respective DB table
         and populates the supplied cache object's internal integer and string
         identifier dicts.
 
+        If the shared cache is enabled and the table did not change since the
+        shared content was read, the first refresh of the cache uses the
+        shared content instead. Later refreshes always read the table as
+        those mean that the looked up value is missing from the shared
+        content.
+
         :param ctx: RequestContext with the the database session.
         """
+        shared = ctx.config is not None and (
+            ctx.config.placement.shared_attribute_cache)
+        if shared:
+            version = self._get_version(ctx)
+            if not self._shared_checked:
+                self._shared_checked = True
+                attrs = _SHARED.get(type(self))
+                if attrs is not None and attrs.version == version:
+                    self._id_cache = attrs.id_cache
+                    self._str_cache = attrs.str_cache
+                    self._all_cache = attrs.all_cache
+                    return
+
         table = self._table
         sel = sa.select(
             table.c.id,
@@ -162,6 +204,32 @@ class _AttributeCache(object):
         # Note that r is Row object that is compatible with the namedtuple
         # interface of the cache
         self._all_cache = {r[1]: r for r in res}
+        self._add_default_attributes()
+
+        if shared:
+            with _SHARED_LOCK:
+                _SHARED[type(self)] = _SharedAttributes(
+                    version, self._id_cache, self._str_cache,
+                    self._all_cache)
+
+    def _get_version(self, ctx):
+        """Return a tuple that changes whenever a record of the table is
+        created, updated or deleted.
+        """
+        table = self._table
+        sel = sa.select(
+            sa.func.count(table.c.id),
+            sa.func.max(table.c.id),
+            sa.func.max(table.c.updated_at),
+            sa.func.max(table.c.created_at),
+        )
+        return tuple(ctx.session.execute(sel).fetchone())
+
+    def _add_default_attributes(self):
+        """Add the attributes that are not stored in the database to the
+        cache. Called after the cache is populated from the database.
+        """
+        pass
 
     def _add_attribute(self, attr_id, name, created_at, updated_at):
         """Use this to add values to the cache that are not coming from the
@@ -179,9 +247,7 @@ class ConsumerTypeCache(_AttributeCache):
     _table = _CONSUMER_TYPE_TBL
     _not_found = exception.ConsumerTypeNotFound
 
-    @db_api.placement_context_manager.reader
-    def _refresh_from_db(self, ctx):
-        super(ConsumerTypeCache, self)._refresh_from_db(ctx)
+    def _add_default_attributes(self):
         # The consumer_type_id is nullable and records with a NULL (None)
         # consumer_type_id are considered as 'unknown'. Also the 'unknown'
         # consumer_type is not created in the database so we need to manually
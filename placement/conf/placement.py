@@ -73,9 +73,12 @@ runtime. If set to -1 it means that the number of generated candidates are
 only limited by the number and structure of the resource providers and the
 content of the allocation_candidates query.
 
-Note that the limit param of the allocation_candidates query is applied after
-all the viable candidates are generated so that limit alone is not enough to
-restrict the runtime or memory consumption of the query.
+Note that the limit param of the allocation_candidates query stops the
+candidate generation as soon as enough candidates are generated, but not if
+randomize_allocation_candidates is enabled, as then the returned candidates
+are sampled from all the viable candidates, nor for microversions older than
+1.29 in deployments having nested resource providers. So the limit alone is
+not always enough to restrict the runtime or memory consumption of the query.
 
 In a deployment with thousands of resource providers or if the deployment has
 wide and symmetric provider trees, i.e. there are multiple children providers
@@ -116,6 +119,197 @@ Both strategies produce the candidates in the API response in an undefined but
 deterministic order. That is, all things being equal, two requests for
 allocation candidates will return the same results in the same order; but no
 guarantees are made as to how that order is determined.
+"""),
+    cfg.StrOpt(
+        'allocation_candidates_matching_strategy',
+        default='per-resource-class',
+        choices=('per-resource-class', 'single-query'),
+        help="""
+Defines how placement finds the resource providers that can satisfy all the
+resources of a request group alone, which is the case for every suffixed
+request group and for every request group in a deployment without nested or
+sharing resource providers:
+
+* per-resource-class, queries the providers having enough capacity of each
+  requested resource class separately, then intersects the results. The debug
+  log tells which resource class had no providers with enough capacity.
+
+* single-query, queries the providers having enough capacity of every
+  requested resource class with a single query, reading the usages of the
+  providers once instead of once per requested resource class.
+
+Both strategies return the same allocation candidates. This option has no
+effect if [placement]allocation_candidates_usage_snapshot is enabled, as then
+the capacity is checked in memory.
+"""),
+    cfg.IntOpt(
+        'allocation_candidates_group_workers',
+        default=1,
+        min=1,
+        help="""
+The number of request groups of a GET /allocation_candidates request that are
+searched concurrently, each in a thread of its own and with a database
+transaction of its own. If set to 1, the request groups are searched one
+after the other.
+
+Requests having several request groups, e.g. for NUMA, PCI and vGPU
+resources, are answered faster if the request groups are searched
+concurrently, as their database queries are then run in parallel. Each
+placement API process might use this many database connections for a single
+request, so the database connection pool of the processes might need to be
+increased accordingly.
+"""),
+    cfg.BoolOpt(
+        'allocation_candidates_usage_snapshot',
+        default=False,
+        help="""
+If True, each placement API process keeps an in-memory snapshot of every
+resource provider's inventories and the usage against them, and uses it to
+find providers with enough capacity and to build provider summaries when
+serving GET /allocation_candidates, instead of aggregating the allocations
+table for every resource class of every request group.
+
+The snapshot is validated against the database at the beginning of every
+allocation candidates request with a single cheap query. Providers whose
+generation changed since the snapshot was taken are reloaded individually;
+other changes, like creating or deleting resource providers or deleting
+allocations, cause the whole snapshot to be reloaded. So the results are
+the same as without the snapshot.
+
+This is mostly useful in large deployments where the allocations table is
+big and allocation candidates are requested considerably more often than
+allocations are deleted. The memory used by each placement API process grows
+with the number of inventory records.
+"""),
+    cfg.BoolOpt(
+        'allocation_candidates_provider_index',
+        default=False,
+        help="""
+If True, each placement API process keeps an in-memory index of the traits
+and aggregates of every resource provider, and uses it to find the providers
+matching the required, forbidden and any-of traits and the member_of
+aggregates of GET /allocation_candidates requests, instead of joining the
+provider trait and aggregate tables once per requested trait or aggregate.
+
+The index is validated against the database at the beginning of every
+allocation candidates request with a single cheap query. Providers whose
+traits, aggregates, inventories or allocations changed since the index was
+built are reloaded individually; creating or deleting resource providers
+causes the whole index to be reloaded. So the results are the same as
+without the index.
+
+This is mostly useful in large deployments where requests have many trait or
+aggregate constraints. The memory used by each placement API process grows
+with the number of traits and aggregates times the highest internal resource
+provider ID.
+"""),
+    cfg.BoolOpt(
+        'allocation_candidates_stream_response',
+        default=False,
+        help="""
+If True, the body of the GET /allocation_candidates response is serialized
+and sent to the client in chunks while the allocation requests and provider
+summaries are transformed to their JSON representation, instead of building
+the whole transformed response and its serialized form in memory before
+sending it. The content of the response is the same in both cases.
+
+This reduces the peak memory usage of the placement API processes and the time
+until the first byte of the response is sent when a large number of
+allocation candidates are returned. As the length of the body is not known in
+advance the response is sent without a Content-Length header, which requires
+a WSGI server that supports chunked transfer encoding or closing the
+connection to signal the end of the body.
+"""),
+    cfg.BoolOpt(
+        'shared_attribute_cache',
+        default=False,
+        help="""
+If True, the resource classes, traits and consumer types read from the
+database by an API request are kept in memory and reused by the later
+requests served by the same placement API process. Otherwise every request
+reads the whole table the first time it needs to look up a resource class,
+trait or consumer type.
+
+Before reusing the kept content, each request checks whether the table
+changed since it was read with a query returning the number of records and
+the largest identifier and timestamps of the table, so changes made via any
+placement API process are taken into account.
+"""),
+    cfg.IntOpt(
+        'provider_shape_cache_ttl',
+        default=0,
+        min=0,
+        help="""
+The number of seconds each placement API process caches whether there are
+nested resource providers in the deployment and which resource providers have
+the MISC_SHARES_VIA_AGGREGATE trait. Every GET /allocation_candidates request
+needs these facts, which otherwise are queried from the database for every
+request. If set to 0 the facts are not cached.
+
+Before reusing the cached facts, each request checks with a single cheap query
+whether the resource providers, their traits or aggregates changed since the
+facts were read, so changes made via any placement API process are taken into
+account.
+"""),
+    cfg.IntOpt(
+        'allocation_candidates_cache_ttl',
+        default=0,
+        min=0,
+        help="""
+The number of seconds each placement API process caches the result of a GET
+/allocation_candidates request, to answer identical requests, like the ones
+issued by the scheduler for each instance of a multi-create or when retrying,
+without searching for the candidates again. If set to 0 the results are not
+cached.
+
+Before a cached result is used it is validated against the database with a
+single cheap query, so results are never served once the resource providers,
+their inventories, traits or aggregates or the allocations against them have
+changed. Results are not cached if
+``[placement]randomize_allocation_candidates`` is enabled.
+
+Related options:
+
+* ``[placement]allocation_candidates_cache_size``
+"""),
+    cfg.IntOpt(
+        'allocation_candidates_cache_size',
+        default=100,
+        min=1,
+        help="""
+The maximum number of GET /allocation_candidates results each placement API
+process caches if ``[placement]allocation_candidates_cache_ttl`` is set. When
+the cache is full the least recently used result is dropped.
+"""),
+    cfg.BoolOpt(
+        'read_replica_routing',
+        default=False,
+        help="""
+If True and [placement_database]slave_connection is set, the database reads
+of GET /allocation_candidates, GET /resource_providers and of the usage
+queries are served by the read replica database at slave_connection instead
+of the primary database. All other requests, including every request that
+writes to the database, use the primary database.
+
+Data read from the replica can be slightly out of date. Allocations are
+always written to the primary database where the capacity of the providers
+is checked again, so stale candidates result in a conflict that the client
+can retry, not in overallocation.
+"""),
+    cfg.IntOpt(
+        'read_replica_lag',
+        default=2,
+        min=0,
+        help="""
+The number of seconds the read replica database is expected to lag behind
+the primary database. For this long after a placement API process commits a
+change to a resource provider or to the allocations of a project, it serves
+the provider listings filtered by uuid or in_tree and the usages of that
+provider or project from the primary database even if
+[placement]read_replica_routing is enabled, so its own writes are visible to
+its subsequent requests. Other requests, like GET /allocation_candidates,
+keep using the read replica. Only used if [placement]read_replica_routing is
+enabled.
 """),
 ]
 
@@ -0,0 +1,35 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Add update_count to resource_providers
+
+Revision ID: c9d3a4e7f1b2
+Revises: a082b8bb98d0
+Create Date: 2026-10-17 11:02:37.418205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9d3a4e7f1b2'
+down_revision = 'a082b8bb98d0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('resource_providers') as batch_op:
+        batch_op.add_column(
+            sa.Column('update_count', sa.Integer(), nullable=False,
+                      server_default='0'))
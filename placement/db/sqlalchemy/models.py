@@ -61,6 +61,12 @@ class ResourceProvider(BASE):
     uuid = Column(String(36), nullable=False)
     name = Column(Unicode(200), nullable=True)
     generation = Column(Integer, default=0)
+    # The number of the updates of the provider that do not increment its
+    # generation, like re-parenting it or changing its aggregates with
+    # microversions older than 1.19. Summed up by
+    # usage_snapshot.get_data_version() along with the generations, so the
+    # per-process caches see every change without relying on updated_at.
+    update_count = Column(Integer, nullable=False, server_default='0')
     # Represents the root of the "tree" that the provider belongs to
     root_provider_id = Column(
         Integer, ForeignKey('resource_providers.id'), nullable=True)
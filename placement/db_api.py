@@ -11,14 +11,88 @@
 #    under the License.
 """Database context manager for placement database connection."""
 
+import collections
+import contextlib
+import threading
+import time
+
+from oslo_db import exception as db_exc
 from oslo_db.sqlalchemy import enginefacade
 from oslo_log import log as logging
+import sqlalchemy as sa
 
 from placement.util import run_once
 
 LOG = logging.getLogger(__name__)
 placement_context_manager = enginefacade.transaction_context()
 
+# The key of the set of keys of the data written by the transaction of a
+# connection in the info dict of the connection, see record_writes().
+_WRITTEN_KEYS = 'placement_written_keys'
+# An OrderedDict, keyed by the keys of the data written by this process, of
+# the time.monotonic() value when the write was committed, oldest first.
+_RECENT_WRITES = collections.OrderedDict()
+_RECENT_WRITES_LOCK = threading.Lock()
+
+
+def _provider_key(rp_uuid):
+    return ('provider', rp_uuid)
+
+
+def _project_key(project_id):
+    return ('project', project_id)
+
+
+def _record_commit(conn):
+    keys = conn.info.pop(_WRITTEN_KEYS, None)
+    if keys:
+        _add_recent_writes(keys)
+
+
+def _record_rollback(conn):
+    conn.info.pop(_WRITTEN_KEYS, None)
+
+
+def _add_recent_writes(keys):
+    now = time.monotonic()
+    with _RECENT_WRITES_LOCK:
+        for key in keys:
+            _RECENT_WRITES.pop(key, None)
+            _RECENT_WRITES[key] = now
+
+
+def _on_engine_create(engine):
+    sa.event.listen(engine, 'commit', _record_commit)
+    sa.event.listen(engine, 'rollback', _record_rollback)
+
+
+placement_context_manager.append_on_engine_create(_on_engine_create)
+
+
+def record_writes(context, provider_uuids=(), project_ids=()):
+    """Record that the resource providers and the usages of the projects
+    identified by the supplied UUIDs and external IDs are changed, so the
+    requests reading them are served by the primary database for
+    [placement]read_replica_lag seconds once the change is committed, see
+    read_replica().
+
+    :param context: The RequestContext doing the write, in its writer
+                    transaction or after it is committed.
+    :param provider_uuids: Iterable of UUIDs of the changed providers. None
+                           values are ignored.
+    :param project_ids: Iterable of external IDs of the projects whose usages
+                        are changed.
+    """
+    keys = {_provider_key(uuid) for uuid in provider_uuids if uuid}
+    keys.update(_project_key(project_id) for project_id in project_ids)
+    try:
+        conn = context.session.connection()
+    except db_exc.NoEngineContextEstablished:
+        # Not in a transaction, so the write is committed already
+        _add_recent_writes(keys)
+        return
+    conn.info.setdefault(_WRITTEN_KEYS, set()).update(keys)
+
 
 def _get_db_conf(conf_group):
     conf_dict = dict(conf_group.items())
@@ -40,6 +114,72 @@ def get_placement_engine():
     return placement_context_manager.writer.get_engine()
 
 
+def _use_read_replica(context, keys):
+    """Return whether the read-only operations of the request can read from
+    [placement_database]slave_connection.
+
+    :param keys: The keys of the data the request reads that must reflect the
+                 writes of this process, see read_replica().
+    """
+    conf = context.config
+    if not (conf.placement.read_replica_routing and
+            conf.placement_database.slave_connection):
+        return False
+    # The writes committed recently by this process might not have been
+    # replicated yet.
+    expired = time.monotonic() - conf.placement.read_replica_lag
+    with _RECENT_WRITES_LOCK:
+        while _RECENT_WRITES:
+            key, committed = next(iter(_RECENT_WRITES.items()))
+            if committed > expired:
+                break
+            _RECENT_WRITES.popitem(last=False)
+        return not any(key in _RECENT_WRITES for key in keys)
+
+
+@contextlib.contextmanager
+def read_replica(context, provider_uuids=(), project_ids=()):
+    """Run the enclosed read-only database operations in a single
+    transaction on the read replica database, if [placement]
+    read_replica_routing is enabled and the replica can be used.
+
+    The replica is not used if this process changed any of the supplied
+    resource providers or the usages of any of the supplied projects in the
+    last [placement]read_replica_lag seconds, see record_writes(), so the
+    request sees those changes. The data not identified this way, like the
+    providers considered by allocation candidates, can be up to the lag of
+    the replica out of date.
+
+    The enclosed operations must not write to the database and must use
+    placement_context_manager.reader.allow_async to join the transaction.
+
+    :param provider_uuids: Iterable of UUIDs of the resource providers read.
+    :param project_ids: Iterable of external IDs of the projects whose usages
+                        are read.
+    """
+    keys = [_provider_key(uuid) for uuid in provider_uuids]
+    keys.extend(_project_key(project_id) for project_id in project_ids)
+    if _use_read_replica(context, keys):
+        with placement_context_manager.reader.async_.using(context):
+            context.read_replica = True
+            try:
+                yield
+            finally:
+                context.read_replica = False
+    else:
+        yield
+
+
+def reader_for(context):
+    """Return the reader transaction context manager a thread other than the
+    one serving the request has to use to read from the same database as the
+    request, see read_replica().
+    """
+    if getattr(context, 'read_replica', False):
+        return placement_context_manager.reader.async_
+    return placement_context_manager.reader
+
+
 @enginefacade.transaction_context_provider
 class DbContext(object):
     """Stub class for db session handling outside of web requests."""
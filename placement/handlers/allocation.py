@@ -179,11 +179,16 @@ def create_allocation_list(context, data, consumers):
     """
     allocation_objects = []
 
+    # Read every resource provider referenced by any of the consumers at once.
+    rp_uuids = []
+    for consumer_uuid in data:
+        rp_uuids.extend(data[consumer_uuid]['allocations'])
+    rp_objs = _resource_providers_by_uuid(context, rp_uuids)
+
     for consumer_uuid in data:
         allocations = data[consumer_uuid]['allocations']
         consumer = consumers[consumer_uuid]
         if allocations:
-            rp_objs = _resource_providers_by_uuid(context, allocations.keys())
             for resource_provider_uuid in allocations:
                 resource_provider = rp_objs[resource_provider_uuid]
                 resources = allocations[resource_provider_uuid]['resources']
@@ -335,17 +340,9 @@ def _resource_providers_by_uuid(ctx, rp_uuids):
     :raises: `webob.exc.HTTPBadRequest` if any of the UUIDs do not refer to
              an existing resource provider.
     """
-    res = {}
+    res = {rp.uuid: rp for rp in rp_obj.get_all_by_uuids(ctx, rp_uuids)}
     for rp_uuid in rp_uuids:
-        # TODO(jaypipes): Clearly, this is not efficient to do one query for
-        # each resource provider UUID in the allocations instead of doing a
-        # single query for all the UUIDs. However, since
-        # rp_obj.get_all_by_filters() is way too complicated for
-        # this purpose and doesn't raise NotFound anyway, we'll do this.
-        # Perhaps consider adding a rp_obj.get_all_by_uuids() later on?
-        try:
-            res[rp_uuid] = rp_obj.ResourceProvider.get_by_uuid(ctx, rp_uuid)
-        except exception.NotFound:
+        if rp_uuid not in res:
             raise webob.exc.HTTPBadRequest(
                 "Allocation for resource provider '%(rp_uuid)s' "
                 "that does not exist." % {'rp_uuid': rp_uuid})
@@ -19,6 +19,7 @@ from oslo_utils import encodeutils
 from oslo_utils import timeutils
 import webob
 
+from placement import db_api
 from placement import exception
 from placement import lib
 from placement import microversion
@@ -34,6 +35,10 @@ _GET_SCHEMA_MICROVERSIONS = [
     (1, 36), (1, 35), (1, 33), (1, 31), (1, 25), (1, 21), (1, 17), (1, 16)
 ]
 
+# The approximate size, in characters, of the chunks of the response body
+# produced when [placement]allocation_candidates_stream_response is enabled.
+_STREAM_CHUNK_SIZE = 64 * 1024
+
 
 def _transform_allocation_requests_dict(alloc_reqs, want_version):
     """Turn supplied list of AllocationRequest objects into a list of
@@ -68,20 +73,24 @@ def _transform_allocation_requests_dict(alloc_reqs, want_version):
         ...
     ]
     """
-    results = []
+    include_mappings = want_version.matches((1, 34))
+    return [_transform_allocation_request_dict(ar, include_mappings)
+            for ar in alloc_reqs]
 
-    for ar in alloc_reqs:
-        # A default dict of {$rp_uuid: "resources": {})
-        rp_resources = collections.defaultdict(lambda: dict(resources={}))
-        for rr in ar.resource_requests:
-            res_dict = rp_resources[rr.resource_provider.uuid]['resources']
-            res_dict[rr.resource_class] = rr.amount
-        result = dict(allocations=rp_resources)
-        if want_version.matches((1, 34)):
-            result['mappings'] = ar.mappings
-        results.append(result)
 
-    return results
+def _transform_allocation_request_dict(ar, include_mappings):
+    """Turn a single AllocationRequest object into an item of the list
+    described in _transform_allocation_requests_dict.
+    """
+    # A default dict of {$rp_uuid: "resources": {})
+    rp_resources = collections.defaultdict(lambda: dict(resources={}))
+    for rr in ar.resource_requests:
+        res_dict = rp_resources[rr.resource_provider.uuid]['resources']
+        res_dict[rr.resource_class] = rr.amount
+    result = dict(allocations=rp_resources)
+    if include_mappings:
+        result['mappings'] = ar.mappings
+    return result
 
 
 def _transform_allocation_requests_list(alloc_reqs):
@@ -107,26 +116,29 @@ def _transform_allocation_requests_list(alloc_reqs):
         }, ...
     ]
     """
-    results = []
-    for ar in alloc_reqs:
-        provider_resources = collections.defaultdict(dict)
-        for rr in ar.resource_requests:
-            res_dict = provider_resources[rr.resource_provider.uuid]
-            res_dict[rr.resource_class] = rr.amount
-
-        allocs = [
-            {
-                "resource_provider": {
-                    "uuid": rp_uuid,
-                },
-                "resources": resources,
-            } for rp_uuid, resources in provider_resources.items()
-        ]
-        alloc = {
-            "allocations": allocs
-        }
-        results.append(alloc)
-    return results
+    return [_transform_allocation_request_list(ar) for ar in alloc_reqs]
+
+
+def _transform_allocation_request_list(ar):
+    """Turn a single AllocationRequest object into an item of the list
+    described in _transform_allocation_requests_list.
+    """
+    provider_resources = collections.defaultdict(dict)
+    for rr in ar.resource_requests:
+        res_dict = provider_resources[rr.resource_provider.uuid]
+        res_dict[rr.resource_class] = rr.amount
+
+    allocs = [
+        {
+            "resource_provider": {
+                "uuid": rp_uuid,
+            },
+            "resources": resources,
+        } for rp_uuid, resources in provider_resources.items()
+    ]
+    return {
+        "allocations": allocs
+    }
 
 
 def _transform_provider_summaries(p_sums, requests, want_version):
@@ -181,19 +193,26 @@ def _transform_provider_summaries(p_sums, requests, want_version):
        }
     }
     """
+    transform = _provider_summary_transformer(requests, want_version)
+    return {ps.resource_provider.uuid: transform(ps) for ps in p_sums}
+
+
+def _provider_summary_transformer(requests, want_version):
+    """Return a function turning a single ProviderSummary object into a value
+    of the dict described in _transform_provider_summaries.
+    """
     include_traits = want_version.matches((1, 17))
     include_all_resources = want_version.matches((1, 27))
     enable_nested_providers = want_version.matches((1, 29))
 
-    ret = {}
     requested_resources = set()
 
     for requested_group in requests.values():
         requested_resources |= set(requested_group.resources)
 
-    # if include_all_resources is false, only requested resources are
-    # included in the provider_summaries.
-    for ps in p_sums:
+    def transform(ps):
+        # if include_all_resources is false, only requested resources are
+        # included in the provider_summaries.
         resources = {
             psr.resource_class: {
                 'capacity': psr.capacity,
@@ -203,18 +222,20 @@ def _transform_provider_summaries(p_sums, requests, want_version):
                 psr.resource_class in requested_resources)
         }
 
-        ret[ps.resource_provider.uuid] = {'resources': resources}
+        summary = {'resources': resources}
 
         if include_traits:
-            ret[ps.resource_provider.uuid]['traits'] = ps.traits
+            summary['traits'] = ps.traits
 
         if enable_nested_providers:
-            ret[ps.resource_provider.uuid]['parent_provider_uuid'] = (
+            summary['parent_provider_uuid'] = (
                 ps.resource_provider.parent_provider_uuid)
-            ret[ps.resource_provider.uuid]['root_provider_uuid'] = (
+            summary['root_provider_uuid'] = (
                 ps.resource_provider.root_provider_uuid)
 
-    return ret
+        return summary
+
+    return transform
 
 
 def _transform_allocation_candidates(alloc_cands, requests, want_version):
@@ -242,6 +263,61 @@ def _transform_allocation_candidates(alloc_cands, requests, want_version):
     }
 
 
+def _stream_allocation_candidates(alloc_cands, requests, want_version):
+    """Generate the UTF-8 encoded JSON representation of the dict returned
+    by _transform_allocation_candidates in chunks.
+
+    Every allocation request and provider summary is transformed and
+    serialized only when the chunk containing it is produced, so the whole
+    transformed structure and its serialized form are never held in memory
+    at once. The concatenated chunks are identical to the serialized result
+    of _transform_allocation_candidates.
+    """
+    if want_version.matches((1, 12)):
+        include_mappings = want_version.matches((1, 34))
+
+        def transform_a_req(ar):
+            return _transform_allocation_request_dict(ar, include_mappings)
+    else:
+        transform_a_req = _transform_allocation_request_list
+    transform_p_sum = _provider_summary_transformer(requests, want_version)
+
+    a_reqs = (
+        jsonutils.dumps(transform_a_req(ar))
+        for ar in alloc_cands.allocation_requests)
+    p_sums = (
+        '%s: %s' % (jsonutils.dumps(ps.resource_provider.uuid),
+                    jsonutils.dumps(transform_p_sum(ps)))
+        for ps in alloc_cands.provider_summaries)
+
+    yield b'{"allocation_requests": ['
+    yield from _join_in_chunks(a_reqs)
+    yield b'], "provider_summaries": {'
+    yield from _join_in_chunks(p_sums)
+    yield b'}}'
+
+
+def _join_in_chunks(items):
+    """Join the serialized items with the default JSON item separator and
+    generate the result as UTF-8 encoded chunks of roughly
+    _STREAM_CHUNK_SIZE characters.
+    """
+    chunk = []
+    size = 0
+    separator = ''
+    for item in items:
+        chunk.append(separator)
+        chunk.append(item)
+        separator = ', '
+        size += len(item)
+        if size >= _STREAM_CHUNK_SIZE:
+            yield encodeutils.to_utf8(''.join(chunk))
+            chunk = []
+            size = 0
+    if chunk:
+        yield encodeutils.to_utf8(''.join(chunk))
+
+
 def _get_schema(want_version):
     """Calculate the desired query parameter schema for
     list_allocation_candidates.
@@ -284,8 +360,9 @@ def list_allocation_candidates(req):
     nested_aware = want_version.matches((1, 29))
 
     try:
-        cands = ac_obj.AllocationCandidates.get_by_requests(
-            context, groups, rqparams, nested_aware=nested_aware)
+        with db_api.read_replica(context):
+            cands = ac_obj.AllocationCandidates.get_by_requests(
+                context, groups, rqparams, nested_aware=nested_aware)
     except exception.ResourceClassNotFound as exc:
         raise webob.exc.HTTPBadRequest(
             'Invalid resource class in resources parameter: %(error)s' %
@@ -294,9 +371,14 @@ def list_allocation_candidates(req):
         raise webob.exc.HTTPBadRequest(str(exc))
 
     response = req.response
-    trx_cands = _transform_allocation_candidates(cands, groups, want_version)
-    json_data = jsonutils.dumps(trx_cands)
-    response.body = encodeutils.to_utf8(json_data)
+    if context.config.placement.allocation_candidates_stream_response:
+        response.app_iter = _stream_allocation_candidates(
+            cands, groups, want_version)
+    else:
+        trx_cands = _transform_allocation_candidates(
+            cands, groups, want_version)
+        json_data = jsonutils.dumps(trx_cands)
+        response.body = encodeutils.to_utf8(json_data)
     response.content_type = 'application/json'
     if want_version.matches((1, 15)):
         response.cache_control = 'no-cache'
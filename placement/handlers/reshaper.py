@@ -59,16 +59,18 @@ def reshape(req):
     # uuid.
     inventory_by_rp = {}
 
+    rp_objs = {
+        rp.uuid: rp for rp in rp_obj.get_all_by_uuids(context, inventories)}
+
     # TODO(cdent): this has overlaps with inventory:set_inventories
     # and is a mess of bad names and lack of method extraction.
     for rp_uuid, inventory_data in inventories.items():
-        try:
-            resource_provider = rp_obj.ResourceProvider.get_by_uuid(
-                context, rp_uuid)
-        except exception.NotFound as exc:
+        resource_provider = rp_objs.get(rp_uuid)
+        if resource_provider is None:
             raise webob.exc.HTTPBadRequest(
                 'Resource provider %(rp_uuid)s in inventories not found: '
-                '%(error)s' % {'rp_uuid': rp_uuid, 'error': exc},
+                'No resource provider with uuid %(rp_uuid)s found' %
+                {'rp_uuid': rp_uuid},
                 comment=errors.RESOURCE_PROVIDER_NOT_FOUND)
 
         # Do an early generation check.
@@ -20,6 +20,7 @@ from oslo_utils import timeutils
 from oslo_utils import uuidutils
 import webob
 
+from placement import db_api
 from placement import errors
 from placement import exception
 from placement import microversion
@@ -249,8 +250,13 @@ def list_resource_providers(req):
             if attr == 'resources':
                 value = util.normalize_resources_qs_param(value)
             filters[attr] = value
+    # The providers looked up by uuid have to reflect the changes made to
+    # them by this process, the other lists can be out of date.
+    rp_uuids = [filters[attr] for attr in ('uuid', 'in_tree')
+                if attr in filters]
     try:
-        resource_providers = rp_obj.get_all_by_filters(context, filters)
+        with db_api.read_replica(context, provider_uuids=rp_uuids):
+            resource_providers = rp_obj.get_all_by_filters(context, filters)
     except exception.ResourceClassNotFound as exc:
         raise webob.exc.HTTPBadRequest(
             'Invalid resource class in resources parameter: %(error)s' %
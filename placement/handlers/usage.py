@@ -18,6 +18,7 @@ from oslo_utils import encodeutils
 from oslo_utils import timeutils
 import webob
 
+from placement import db_api
 from placement import exception
 from placement import microversion
 from placement.objects import resource_provider as rp_obj
@@ -55,15 +56,16 @@ def list_usages(req):
     # get_all_by_resource_provider_uuid can return an empty list.
     # It is also needed for the generation, used in the outgoing
     # representation.
-    try:
-        resource_provider = rp_obj.ResourceProvider.get_by_uuid(
-            context, uuid)
-    except exception.NotFound as exc:
-        raise webob.exc.HTTPNotFound(
-            "No resource provider with uuid %(uuid)s found: %(error)s" %
-            {'uuid': uuid, 'error': exc})
+    with db_api.read_replica(context, provider_uuids=(uuid,)):
+        try:
+            resource_provider = rp_obj.ResourceProvider.get_by_uuid(
+                context, uuid)
+        except exception.NotFound as exc:
+            raise webob.exc.HTTPNotFound(
+                "No resource provider with uuid %(uuid)s found: %(error)s" %
+                {'uuid': uuid, 'error': exc})
 
-    usage = usage_obj.get_all_by_resource_provider_uuid(context, uuid)
+        usage = usage_obj.get_all_by_resource_provider_uuid(context, uuid)
 
     response = req.response
     response.body = encodeutils.to_utf8(jsonutils.dumps(
@@ -106,12 +108,14 @@ def get_total_usages(req):
         want_schema = schema.GET_USAGES_SCHEMA_V1_38
     util.validate_query_params(req, want_schema)
 
-    if show_consumer_type:
-        usages = usage_obj.get_by_consumer_type(
-            context, project_id, user_id=user_id, consumer_type=consumer_type)
-    else:
-        usages = usage_obj.get_all_by_project_user(context, project_id,
-                                                   user_id=user_id)
+    with db_api.read_replica(context, project_ids=(project_id,)):
+        if show_consumer_type:
+            usages = usage_obj.get_by_consumer_type(
+                context, project_id, user_id=user_id,
+                consumer_type=consumer_type)
+        else:
+            usages = usage_obj.get_all_by_project_user(context, project_id,
+                                                       user_id=user_id)
 
     response = req.response
     if show_consumer_type:
@@ -51,16 +51,57 @@ class Allocation(object):
 
 
 @db_api.placement_context_manager.writer
-def _delete_allocations_for_consumer(ctx, consumer_id):
+def _delete_allocations_for_consumers(ctx, consumer_ids):
     """Deletes any existing allocations that correspond to the allocations to
     be written. This is wrapped in a transaction, so if the write subsequently
     fails, the deletion will also be rolled back.
     """
     del_sql = _ALLOC_TBL.delete().where(
-        _ALLOC_TBL.c.consumer_id == consumer_id)
+        _ALLOC_TBL.c.consumer_id.in_(consumer_ids))
     ctx.session.execute(del_sql)
 
 
+@db_api.placement_context_manager.writer
+def _insert_allocations(ctx, allocs):
+    """Inserts the supplied allocations with a single statement and sets the
+    id attribute of each Allocation object.
+
+    The existing allocations of the consumers of the supplied allocations
+    must have been deleted already in the same transaction.
+    """
+    rows = []
+    for alloc in allocs:
+        rows.append({
+            'resource_provider_id': alloc.resource_provider.id,
+            'resource_class_id': ctx.rc_cache.id_from_string(
+                alloc.resource_class),
+            'consumer_id': alloc.consumer.uuid,
+            'used': alloc.used,
+        })
+    ctx.session.execute(_ALLOC_TBL.insert(), rows)
+
+    # The internal ids of the inserted rows are not returned by a multi-row
+    # INSERT on every supported database, so read them back. As the consumers
+    # had no other allocations the rows can be matched by provider, class and
+    # consumer. Rows with the same keys, if any, are matched in order of
+    # insertion.
+    sel = sa.select(
+        _ALLOC_TBL.c.id,
+        _ALLOC_TBL.c.resource_provider_id,
+        _ALLOC_TBL.c.resource_class_id,
+        _ALLOC_TBL.c.consumer_id,
+    ).where(
+        _ALLOC_TBL.c.consumer_id.in_(set(row['consumer_id'] for row in rows))
+    ).order_by(_ALLOC_TBL.c.id)
+    ids = collections.defaultdict(collections.deque)
+    for rec in ctx.session.execute(sel):
+        ids[(rec.resource_provider_id, rec.resource_class_id,
+             rec.consumer_id)].append(rec.id)
+    for alloc, row in zip(allocs, rows):
+        alloc.id = ids[(row['resource_provider_id'], row['resource_class_id'],
+                        row['consumer_id'])].popleft()
+
+
 @db_api.placement_context_manager.writer
 def _delete_allocations_by_ids(ctx, alloc_ids):
     """Deletes allocations having an internal id value in the set of supplied
@@ -396,8 +437,7 @@ def _set_allocations(context, allocs):
         context,
         [alloc.resource_provider.id for alloc in allocs],
         [alloc.resource_class for alloc in allocs])
-    for consumer_id in consumer_ids:
-        _delete_allocations_for_consumer(context, consumer_id)
+    _delete_allocations_for_consumers(context, consumer_ids)
 
     # Before writing any allocation records, we check that the submitted
     # allocations do not cause any inventory capacity to be exceeded for
@@ -420,6 +460,7 @@ def _set_allocations(context, allocs):
     # allocation is using a resource class that does not exist.
     visited_consumers = {}
     visited_rps = _check_capacity_exceeded(context, allocs, prev_usage)
+    allocs_to_insert = []
     for alloc in allocs:
         if alloc.consumer.id not in visited_consumers:
             visited_consumers[alloc.consumer.id] = alloc.consumer
@@ -430,16 +471,9 @@ def _set_allocations(context, allocs):
         # continue
         if alloc.used == 0:
             continue
-        consumer_id = alloc.consumer.uuid
-        rp = alloc.resource_provider
-        rc_id = context.rc_cache.id_from_string(alloc.resource_class)
-        ins_stmt = _ALLOC_TBL.insert().values(
-            resource_provider_id=rp.id,
-            resource_class_id=rc_id,
-            consumer_id=consumer_id,
-            used=alloc.used)
-        res = context.session.execute(ins_stmt)
-        alloc.id = res.lastrowid
+        allocs_to_insert.append(alloc)
+    if allocs_to_insert:
+        _insert_allocations(context, allocs_to_insert)
 
     # Generation checking happens here. If the inventory for this resource
     # provider changed out from under us, this will raise a
@@ -568,19 +602,22 @@ def replace_all(context, alloc_list):
             # We only want to reload each unique resource provider once.
             alloc_rp_uuids = set(
                 alloc.resource_provider.uuid for alloc in alloc_list)
-            seen_rps = {}
-            for rp_uuid in alloc_rp_uuids:
-                # NOTE(melwitt): We use a separate database transaction to read
-                # the resource provider because we might be wrapped in an outer
-                # database transaction when we reach here. We want to get an
-                # up-to-date generation value in case a racing request has
-                # changed it after we began an outer transaction and this is
-                # the first time we are reading the resource provider records
-                # during our transaction.
-                db_context_manager = db_api.placement_context_manager
-                with db_context_manager.reader.independent.using(context):
-                    seen_rps[rp_uuid] = rp_obj.ResourceProvider.get_by_uuid(
-                        context, rp_uuid)
+            # NOTE(melwitt): We use a separate database transaction to read
+            # the resource providers because we might be wrapped in an outer
+            # database transaction when we reach here. We want to get an
+            # up-to-date generation value in case a racing request has
+            # changed it after we began an outer transaction and this is
+            # the first time we are reading the resource provider records
+            # during our transaction.
+            db_context_manager = db_api.placement_context_manager
+            with db_context_manager.reader.independent.using(context):
+                seen_rps = {
+                    rp.uuid: rp for rp in
+                    rp_obj.get_all_by_uuids(context, alloc_rp_uuids)}
+            missing = alloc_rp_uuids - set(seen_rps)
+            if missing:
+                raise exception.NotFound(
+                    'No resource provider with uuid %s found' % missing.pop())
             for alloc in alloc_list:
                 rp_uuid = alloc.resource_provider.uuid
                 alloc.resource_provider = seen_rps[rp_uuid]
@@ -600,5 +637,10 @@ def delete_all(context, alloc_list):
     consumer_uuids = set(alloc.consumer.uuid for alloc in alloc_list)
     alloc_ids = [alloc.id for alloc in alloc_list]
     _delete_allocations_by_ids(context, alloc_ids)
+    db_api.record_writes(
+        context,
+        provider_uuids={alloc.resource_provider.uuid for alloc in alloc_list},
+        project_ids={alloc.consumer.project.external_id
+                     for alloc in alloc_list})
     consumer_obj.delete_consumers_if_no_allocations(
         context, consumer_uuids)
@@ -11,9 +11,13 @@
 #    under the License.
 
 import collections
+from concurrent import futures
+import contextlib
 import copy
-import functools
 import itertools
+import random
+import threading
+import time
 
 import os_traits
 from oslo_log import log as logging
@@ -24,7 +28,7 @@ from placement import db_api
 from placement import exception
 from placement.objects import research_context as res_ctx
 from placement.objects import resource_provider as rp_obj
-from placement.objects import trait as trait_obj
+from placement.objects import usage_snapshot
 from placement import util
 
 
@@ -35,6 +39,92 @@ _RP_TBL = models.ResourceProvider.__table__
 LOG = logging.getLogger(__name__)
 
 
+class _ResultCache(object):
+    """A per-process LRU cache of the results of GET /allocation_candidates
+    requests.
+
+    The results are keyed by the normalized request and the DataVersion of
+    the provider and allocation data they were computed from, so a result is
+    only used while the data is unchanged. Results are kept for
+    [placement]allocation_candidates_cache_ttl seconds at most, and only the
+    [placement]allocation_candidates_cache_size most recently used ones are
+    kept.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # OrderedDict, keyed by (request key, DataVersion), of (result,
+        # expiry) tuples, the least recently used first.
+        self._results = collections.OrderedDict()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is None:
+                return None
+            if cached[1] <= now:
+                del self._results[key]
+                return None
+            self._results.move_to_end(key)
+            return cached[0]
+
+    def put(self, ctx, key, result):
+        conf = ctx.config.placement
+        expiry = time.monotonic() + conf.allocation_candidates_cache_ttl
+        with self._lock:
+            self._results[key] = (result, expiry)
+            self._results.move_to_end(key)
+            while len(self._results) > conf.allocation_candidates_cache_size:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+_RESULTS = _ResultCache()
+
+
+def clear_cached_results():
+    """Drops the allocation candidates cached by this process."""
+    _RESULTS.clear()
+
+
+def _result_cache_key(context, groups, rqparams, nested_aware):
+    """Returns a hashable key of an allocation candidates request that is the
+    same for the requests that only differ in the order of their parameters.
+
+    The options changing which candidates are returned, and in which order,
+    are part of the key, so the results computed before the configuration is
+    reloaded are not used after it.
+    """
+    conf = context.config
+    return (
+        conf.placement.max_allocation_candidates,
+        conf.placement.allocation_candidates_generation_strategy,
+        conf.placement.randomize_allocation_candidates,
+        conf.workarounds.optimize_for_wide_provider_trees,
+        nested_aware,
+        # The limit is an empty list if not requested
+        rqparams.limit or None,
+        rqparams.group_policy,
+        frozenset(rqparams.anchor_required_traits or ()),
+        frozenset(rqparams.anchor_forbidden_traits or ()),
+        frozenset(frozenset(suffixes) for suffixes in rqparams.same_subtrees),
+        frozenset(
+            (suffix,
+             group.use_same_provider,
+             frozenset(group.resources.items()),
+             frozenset(frozenset(traits) for traits in group.required_traits),
+             frozenset(group.forbidden_traits),
+             frozenset(frozenset(aggs) for aggs in group.member_of),
+             group.in_tree,
+             frozenset(group.forbidden_aggs))
+            for suffix, group in groups.items()),
+    )
+
+
 class AllocationCandidates(object):
     """The AllocationCandidates object is a collection of possible allocations
     that match some request for resources, along with some summary information
@@ -70,11 +160,31 @@ class AllocationCandidates(object):
                  and provider_summaries satisfying `requests`, limited
                  according to `limit`.
         """
+        conf = context.config.placement
+        cache_key = None
+        if (conf.allocation_candidates_cache_ttl and
+                not conf.randomize_allocation_candidates):
+            cache_key = (
+                _result_cache_key(context, groups, rqparams, nested_aware),
+                usage_snapshot.get_data_version(context))
+            cached = _RESULTS.get(cache_key)
+            if cached is not None:
+                LOG.debug('Using cached allocation candidates')
+                alloc_reqs, provider_summaries = cached
+                return cls(
+                    allocation_requests=list(alloc_reqs),
+                    provider_summaries=list(provider_summaries),
+                )
+
         try:
             alloc_reqs, provider_summaries = cls._get_by_requests(
                 context, groups, rqparams, nested_aware=nested_aware)
         except exception.ResourceProviderNotFound:
             alloc_reqs, provider_summaries = [], []
+        if cache_key is not None:
+            _RESULTS.put(
+                context, cache_key,
+                (tuple(alloc_reqs), tuple(provider_summaries)))
         return cls(
             allocation_requests=alloc_reqs,
             provider_summaries=provider_summaries,
@@ -108,8 +218,7 @@ class AllocationCandidates(object):
                 # ((A or B) and C) trait request then we check if there is any
                 # RP with either A, B or C. If none then we know that there is
                 # no RP that can satisfy the original query either.
-                trait_rps = res_ctx.get_provider_ids_having_any_trait(
-                    rg_ctx.context,
+                trait_rps = rg_ctx.provider_ids_having_any_trait(
                     {
                         trait
                         for any_traits in rg_ctx.required_traits
@@ -131,42 +240,100 @@ class AllocationCandidates(object):
         return _alloc_candidates_single_provider(rg_ctx, rw_ctx, rp_tuples)
 
     @classmethod
-    @db_api.placement_context_manager.reader
+    def _get_by_group(cls, context, suffix, group, rw_ctx, sharing):
+        """Get allocation candidates for one RequestGroup, marked according
+        to whether the RequestGroup required them to be restricted to a
+        single provider.
+
+        Must be called from within an placement_context_manager.reader
+        (or writer) context.
+        """
+        rg_ctx = res_ctx.RequestGroupSearchContext(
+            context, group, rw_ctx.has_trees, sharing, suffix, rw_ctx=rw_ctx)
+
+        alloc_reqs = cls._get_by_one_request(rg_ctx, rw_ctx)
+        LOG.debug("%s (suffix '%s') returned %d matches",
+                  str(group), str(suffix), len(alloc_reqs))
+        # We'll need use_same_provider later to evaluate group_policy.
+        for areq in alloc_reqs:
+            areq.use_same_provider = group.use_same_provider
+        return alloc_reqs
+
+    @classmethod
+    def _get_by_groups(cls, context, groups, rw_ctx, sharing):
+        """Get allocation candidates for each RequestGroup, searching up to
+        [placement]allocation_candidates_group_workers groups concurrently.
+
+        :return: A dict, keyed by suffix, of the allocation requests of each
+                 RequestGroup, or None if any of the RequestGroups has no
+                 allocation candidates.
+        """
+        workers = min(
+            context.config.placement.allocation_candidates_group_workers,
+            len(groups))
+        candidates = {}
+        if workers <= 1:
+            for suffix, group in groups.items():
+                alloc_reqs = cls._get_by_group(
+                    context, suffix, group, rw_ctx, sharing)
+                if not alloc_reqs:
+                    return None
+                candidates[suffix] = alloc_reqs
+            return candidates
+
+        # NOTE: The database transaction of the request is bound to the
+        # current thread, so each group is searched in a transaction of its
+        # own, reading from the same database.
+        reader = db_api.reader_for(context)
+        # A single connection shared by every thread, like the one of an
+        # in-memory SQLite database, cannot serve concurrent transactions.
+        engine = context.session.get_bind().engine
+        if isinstance(engine.pool, sa.pool.StaticPool):
+            serialize = threading.Lock()
+        else:
+            serialize = contextlib.nullcontext()
+
+        def _search(suffix, group):
+            with serialize, reader.using(context):
+                return cls._get_by_group(
+                    context, suffix, group, rw_ctx, sharing)
+
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            searches = [
+                (suffix, executor.submit(_search, suffix, group))
+                for suffix, group in groups.items()]
+            for suffix, search in searches:
+                alloc_reqs = search.result()
+                if not alloc_reqs:
+                    return None
+                candidates[suffix] = alloc_reqs
+        finally:
+            # Do not start searching the remaining groups if the result is
+            # already known.
+            executor.shutdown(cancel_futures=True)
+        return candidates
+
+    @classmethod
+    @db_api.placement_context_manager.reader.allow_async
     def _get_by_requests(cls, context, groups, rqparams, nested_aware=True):
         rw_ctx = res_ctx.RequestWideSearchContext(
             context, rqparams, nested_aware)
-        sharing = res_ctx.get_sharing_providers(context)
+        rw_ctx.register_traits(
+            name for group in groups.values()
+            for names in list(group.required_traits) + [group.forbidden_traits]
+            for name in names)
+        sharing = res_ctx.get_all_sharing_providers(context)
         # TODO(efried): If we ran anchors_for_sharing_providers here, we could
         #  narrow to only sharing providers associated with our filtered trees.
         #  Unclear whether this would be cheaper than waiting until we've
         #  filtered sharing providers for other things (like resources).
 
-        seen_rcs = set()
-        candidates = {}
-        for suffix, group in groups.items():
-            rg_ctx = res_ctx.RequestGroupSearchContext(
-                context, group, rw_ctx.has_trees, sharing, suffix)
-
-            # Which resource classes are requested in more than one group?
-            for rc in rg_ctx.rcs:
-                if rc in seen_rcs:
-                    rw_ctx.multi_group_rcs.add(rc)
-                else:
-                    seen_rcs.add(rc)
-
-            alloc_reqs = cls._get_by_one_request(rg_ctx, rw_ctx)
-            LOG.debug("%s (suffix '%s') returned %d matches",
-                      str(group), str(suffix), len(alloc_reqs))
-            if not alloc_reqs:
-                # Shortcut: If any one group resulted in no candidates, the
-                # whole operation is shot.
-                return [], []
-            # Mark each allocation request according to whether its
-            # corresponding RequestGroup required it to be restricted to a
-            # single provider.  We'll need this later to evaluate group_policy.
-            for areq in alloc_reqs:
-                areq.use_same_provider = group.use_same_provider
-            candidates[suffix] = alloc_reqs
+        candidates = cls._get_by_groups(context, groups, rw_ctx, sharing)
+        if candidates is None:
+            # Shortcut: If any one group resulted in no candidates, the
+            # whole operation is shot.
+            return [], []
 
         # At this point, each alloc_requests in `candidates` is independent of
         # the others. We need to fold them together such that  each allocation
@@ -179,13 +346,19 @@ class AllocationCandidates(object):
         alloc_request_objs, summary_objs = rw_ctx.exclude_nested_providers(
             alloc_request_objs, summary_objs)
 
-        return rw_ctx.limit_results(alloc_request_objs, summary_objs)
+        alloc_request_objs, summary_objs = rw_ctx.limit_results(
+            alloc_request_objs, summary_objs)
+
+        # Only now that the trees in the result are known, create the
+        # provider summaries of them.
+        return alloc_request_objs, _get_provider_summaries(
+            context, rw_ctx, summary_objs)
 
 
 class AllocationRequest(object):
 
     __slots__ = ('anchor_root_provider_uuid', 'use_same_provider',
-                 'resource_requests', 'mappings')
+                 'resource_requests', 'mappings', '_rr_set', '_hash')
 
     def __init__(self, anchor_root_provider_uuid=None,
                  use_same_provider=None, resource_requests=None,
@@ -203,6 +376,11 @@ class AllocationRequest(object):
         # mappings will be presented as a dict during output, so ensure we have
         # a reasonable default here, despite mappings always being set.
         self.mappings = mappings or dict()
+        # The set of resource_requests and its hash, calculated on first use
+        # by __eq__ and __hash__. The resource_requests must not be changed
+        # after the object is compared or hashed.
+        self._rr_set = None
+        self._hash = None
 
     def __repr__(self):
         anchor = (self.anchor_root_provider_uuid[-8:]
@@ -216,17 +394,32 @@ class AllocationRequest(object):
                      self.mappings))
         return repr_str
 
+    def _resource_request_set(self):
+        if self._rr_set is None:
+            self._rr_set = frozenset(self.resource_requests)
+        return self._rr_set
+
     def __eq__(self, other):
-        return (set(self.resource_requests) == set(other.resource_requests) and
+        return (hash(self) == hash(other) and
+                self._resource_request_set() ==
+                other._resource_request_set() and
                 self.mappings == other.mappings)
 
     def __hash__(self):
-        # We need a stable sort order on the resource requests to get an
-        # accurate hash. To avoid needing to update the method everytime
-        # the structure of an AllocationRequestResource changes, we can
-        # sort on the hash of each request resource.
-        sorted_rr = sorted(self.resource_requests, key=lambda x: hash(x))
-        return hash(tuple(sorted_rr))
+        # AllocationRequests are deduplicated in sets while merging the
+        # candidates, so the hash is only calculated once per object. The
+        # hash of a frozenset does not depend on the order of its items.
+        # In wide trees the candidates that only differ in which of the
+        # identical sibling providers satisfies which request group consume
+        # the same resources, so the mappings are hashed too, otherwise all
+        # of those candidates would collide.
+        if self._hash is None:
+            self._hash = hash((
+                self._resource_request_set(),
+                frozenset(
+                    (suffix, frozenset(rp_uuids))
+                    for suffix, rp_uuids in self.mappings.items())))
+        return self._hash
 
     def __copy__(self):
         # This is shallow copy, so resource_requests and mappings are the
@@ -241,23 +434,28 @@ class AllocationRequest(object):
 
 class AllocationRequestResource(object):
 
-    __slots__ = 'resource_provider', 'resource_class', 'amount'
+    __slots__ = 'resource_provider', 'resource_class', 'amount', '_hash'
 
     def __init__(self, resource_provider=None, resource_class=None,
                  amount=None):
+        # NOTE: The same AllocationRequestResource is shared by many
+        # AllocationRequests, so the fields must not be changed after the
+        # object is created. Create a new object instead.
         self.resource_provider = resource_provider
         self.resource_class = resource_class
         self.amount = amount
+        self._hash = hash((
+            resource_provider.id if resource_provider is not None else None,
+            resource_class, amount))
 
     def __eq__(self, other):
-        return ((self.resource_provider.id == other.resource_provider.id) and
+        return ((self._hash == other._hash) and
+                (self.resource_provider.id == other.resource_provider.id) and
                 (self.resource_class == other.resource_class) and
                 (self.amount == other.amount))
 
     def __hash__(self):
-        return hash((self.resource_provider.id,
-                     self.resource_class,
-                     self.amount))
+        return self._hash
 
     def __copy__(self):
         # This is shallow copy, so resource_provider is the same object as
@@ -275,12 +473,17 @@ class AllocationRequestResource(object):
 
 class ProviderSummary(object):
 
-    __slots__ = 'resource_provider', 'resources', 'traits'
+    __slots__ = 'resource_provider', 'resources', 'traits', 'trait_mask'
 
-    def __init__(self, resource_provider=None, resources=None, traits=None):
+    def __init__(self, resource_provider=None, resources=None, traits=None,
+                 trait_mask=0):
         self.resource_provider = resource_provider
         self.resources = resources or []
         self.traits = traits or []
+        # The bitmask of the traits relevant to the request among traits, see
+        # RequestWideSearchContext.trait_mask(). Internal use only; not
+        # included when the object is serialized for output.
+        self.trait_mask = trait_mask
 
 
 class ProviderSummaryResource(object):
@@ -297,6 +500,16 @@ class ProviderSummaryResource(object):
         self.max_unit = max_unit
 
 
+# What the search for allocation candidates needs to know about a provider:
+# The ResourceProvider object referenced by the AllocationRequestResources,
+# the trait names and the trait mask of them, see
+# RequestWideSearchContext.trait_mask(). ProviderSummary objects with the
+# resources of the providers are only created by _get_provider_summaries for
+# the trees in the final result.
+ProviderEntry = collections.namedtuple(
+    'ProviderEntry', 'resource_provider traits trait_mask')
+
+
 def _alloc_candidates_multiple_providers(rg_ctx, rw_ctx, rp_candidates):
     """Returns a set of allocation requests for a supplied set of requested
     resource amounts and tuples of (rp_id, root_id, rc_id). The supplied
@@ -324,23 +537,27 @@ def _alloc_candidates_multiple_providers(rg_ctx, rw_ctx, rp_candidates):
 
     # Get a dict, keyed by resource provider internal ID, of trait string names
     # that provider has associated with it
-    prov_traits = trait_obj.get_traits_by_provider_tree(
-        rg_ctx.context, root_ids)
+    prov_traits = rw_ctx.traits_by_provider_tree(root_ids)
 
-    # Extend rw_ctx.summaries_by_id dict, keyed by resource provider internal
-    # ID, of ProviderSummary objects for all providers
-    _build_provider_summaries(rg_ctx.context, rw_ctx, root_ids, prov_traits)
+    # Extend rw_ctx.providers_by_id dict, keyed by resource provider internal
+    # ID, of ProviderEntry objects for all providers
+    _build_provider_entries(rg_ctx.context, rw_ctx, root_ids, prov_traits)
 
     # Get a dict, keyed by root provider internal ID, of a dict, keyed by
     # resource class internal ID, of lists of AllocationRequestResource objects
     tree_dict = collections.defaultdict(lambda: collections.defaultdict(list))
 
+    # The trait masks of each OR'd set of required traits
+    required_masks = [
+        rw_ctx.trait_mask(any_traits)
+        for any_traits in rg_ctx.required_trait_names]
+
     rc_cache = rg_ctx.context.rc_cache
+    providers = rw_ctx.providers_by_id
     for rp in rp_candidates.rps_info:
-        rp_summary = rw_ctx.summaries_by_id[rp.id]
         tree_dict[rp.root_id][rp.rc_id].append(
             AllocationRequestResource(
-                resource_provider=rp_summary.resource_provider,
+                resource_provider=providers[rp.id].resource_provider,
                 resource_class=rc_cache.string_from_id(rp.rc_id),
                 amount=rg_ctx.resources[rp.rc_id]))
 
@@ -364,8 +581,7 @@ def _alloc_candidates_multiple_providers(rg_ctx, rw_ctx, rp_candidates):
         # , which should be ordered by the resource class id.
         request_groups = [val for key, val in sorted(alloc_dict.items())]
 
-        root_summary = rw_ctx.summaries_by_id[root_id]
-        root_uuid = root_summary.resource_provider.uuid
+        root_uuid = providers[root_id].resource_provider.uuid
         root_alloc_reqs = set()
 
         # Using itertools.product, we get all the combinations of resource
@@ -376,10 +592,14 @@ def _alloc_candidates_multiple_providers(rg_ctx, rw_ctx, rp_candidates):
         #  (ARR(rc1, ss2), ARR(rc2, ss1), ARR(rc3, ss1)),
         #  (ARR(rc1, ss2), ARR(rc2, ss2), ARR(rc3, ss1))]
         for res_requests in itertools.product(*request_groups):
-            if not _check_traits_for_alloc_request(
-                    res_requests, rw_ctx.summaries_by_id,
-                    rg_ctx.required_trait_names,
-                    rg_ctx.forbidden_traits.keys()):
+            # NOTE: The providers having forbidden traits are already dropped
+            # by res_ctx.get_trees_matching_all(), as are the trees that
+            # cannot satisfy the required traits with any combination. But
+            # a given combination of providers might still lack a required
+            # trait.
+            if required_masks and not _check_traits_for_alloc_request(
+                    res_requests, providers,
+                    rg_ctx.required_trait_names, required_masks):
                 # This combination doesn't satisfy trait constraints
                 continue
 
@@ -421,21 +641,26 @@ def _alloc_candidates_single_provider(rg_ctx, rw_ctx, rp_tuples):
 
     # Get a dict, keyed by resource provider internal ID, of trait string names
     # that provider has associated with it
-    prov_traits = trait_obj.get_traits_by_provider_tree(
-        rg_ctx.context, root_ids)
+    prov_traits = rw_ctx.traits_by_provider_tree(root_ids)
+
+    # Extend rw_ctx.providers_by_id dict, keyed by resource provider internal
+    # ID, of ProviderEntry objects for all providers
+    _build_provider_entries(rg_ctx.context, rw_ctx, root_ids, prov_traits)
 
-    # Extend rw_ctx.summaries_by_id dict, keyed by resource provider internal
-    # ID, of ProviderSummary objects for all providers
-    _build_provider_summaries(rg_ctx.context, rw_ctx, root_ids, prov_traits)
+    # Look up the anchors of all the sharing providers at once
+    anchors_by_rp_id = rw_ctx.anchors_for_sharing_providers(
+        rp_id for rp_id, root_id in rp_tuples
+        if os_traits.MISC_SHARES_VIA_AGGREGATE in
+        rw_ctx.providers_by_id[rp_id].traits)
 
     # Next, build up a list of allocation requests. These allocation requests
     # are AllocationRequest objects, containing resource provider UUIDs,
     # resource class names and amounts to consume from that resource provider
     alloc_requests = []
     for rp_id, root_id in rp_tuples:
-        rp_summary = rw_ctx.summaries_by_id[rp_id]
         req_obj = _allocation_request_for_provider(
-            rg_ctx.context, rg_ctx.resources, rp_summary.resource_provider,
+            rg_ctx.context, rg_ctx.resources,
+            rw_ctx.providers_by_id[rp_id].resource_provider,
             suffix=rg_ctx.suffix)
         # Exclude this if its anchor (which is its root) isn't in our
         # prefiltered list of anchors
@@ -443,11 +668,8 @@ def _alloc_candidates_single_provider(rg_ctx, rw_ctx, rp_tuples):
             alloc_requests.append(req_obj)
         # If this is a sharing provider, we have to include an extra
         # AllocationRequest for every possible anchor.
-        traits = rp_summary.traits
-        if os_traits.MISC_SHARES_VIA_AGGREGATE in traits:
-            anchors = res_ctx.anchors_for_sharing_providers(
-                rg_ctx.context, [rp_summary.resource_provider.id])
-            for anchor in anchors:
+        if rp_id in anchors_by_rp_id:
+            for anchor in anchors_by_rp_id[rp_id]:
                 # We already added self
                 if anchor.anchor_id == root_id:
                     continue
@@ -492,13 +714,14 @@ def _allocation_request_for_provider(context, requested_resources, provider,
         mappings=mappings)
 
 
-def _build_provider_summaries(context, rw_ctx, root_ids, prov_traits):
-    """Given a list of dicts of usage information and a map of providers to
-    their associated string traits, returns a dict, keyed by resource provider
-    ID, of ProviderSummary objects.
+def _build_provider_entries(context, rw_ctx, root_ids, prov_traits):
+    """Given a set of root provider IDs and a map of providers to their
+    associated string traits, records the providers and the usages of their
+    inventories for every tree not seen yet by the request.
 
-    Warning: This is side-effecty: It is extending the rw_ctx.summaries_by_id
-    dict. Nothing is returned.
+    Warning: This is side-effecty: It is extending the rw_ctx.providers_by_id
+    and rw_ctx.usages_by_rp_id dicts and registers the capacity of the
+    inventories with rw_ctx. Nothing is returned.
 
     :param context: placement.context.RequestContext object
     :param rw_ctx: placement.research_context.RequestWideSearchContext
@@ -506,8 +729,15 @@ def _build_provider_summaries(context, rw_ctx, root_ids, prov_traits):
     :param prov_traits: A dict, keyed by internal resource provider ID, of
                         string trait names associated with that provider
     """
+    # NOTE: Request groups might be searched concurrently, see
+    # [placement]allocation_candidates_group_workers.
+    with rw_ctx.lock:
+        _build_new_provider_entries(context, rw_ctx, root_ids, prov_traits)
+
+
+def _build_new_provider_entries(context, rw_ctx, root_ids, prov_traits):
     # Filter resource providers by those we haven't seen yet.
-    new_roots = root_ids - set(rw_ctx.summaries_by_id)
+    new_roots = root_ids - set(rw_ctx.providers_by_id)
     if not new_roots:
         return
 
@@ -522,20 +752,26 @@ def _build_provider_summaries(context, rw_ctx, root_ids, prov_traits):
     #        'reserved': integer,
     #        'allocation_ratio': float,
     #    }
-    usages = res_ctx.get_usages_by_provider_trees(context, new_roots)
-
-    # Before we go creating provider summary objects, first grab all the
-    # provider information (including root, parent and UUID information) for
-    # the providers.
-    provider_ids = _provider_ids_from_root_ids(context, new_roots)
+    #
+    # Before we go creating provider objects, also grab all the provider
+    # information (including root, parent and UUID information) for the
+    # providers.
+    snapshot = rw_ctx.usage_snapshot
+    if snapshot is not None:
+        usages = snapshot.usages_by_provider_trees(new_roots)
+        provider_ids = snapshot.provider_ids_from_root_ids(new_roots)
+    else:
+        usages = res_ctx.get_usages_by_provider_trees(context, new_roots)
+        provider_ids = _provider_ids_from_root_ids(context, new_roots)
 
     # Build up a dict, keyed by internal resource provider ID, of
-    # ProviderSummary objects containing one or more ProviderSummaryResource
-    # objects representing the resources the provider has inventory for.
+    # ProviderEntry objects and another one of the usage rows of the
+    # inventories of the providers.
+    rc_cache = context.rc_cache
     for usage in usages:
         rp_id = usage.resource_provider_id
-        summary = rw_ctx.summaries_by_id.get(rp_id)
-        if not summary:
+        rp_usages = rw_ctx.usages_by_rp_id.get(rp_id)
+        if rp_usages is None:
             pids = provider_ids[rp_id]
             parent_id = pids.parent_id
             # If there is a parent, we can rely on it being in provider_ids
@@ -544,17 +780,17 @@ def _build_provider_summaries(context, rw_ctx, root_ids, prov_traits):
             parent_uuid = provider_ids[parent_id].uuid if parent_id else None
             # Update the parent_uuid_by_rp_uuid cache here. We know that we
             # will visit all providers in all trees in play during
-            # _build_provider_summaries, so now is a good time.
+            # _build_provider_entries, so now is a good time.
             rw_ctx.parent_uuid_by_rp_uuid[pids.uuid] = parent_uuid
-            summary = ProviderSummary(
+            traits = prov_traits.get(rp_id, [])
+            rw_ctx.providers_by_id[rp_id] = ProviderEntry(
                 resource_provider=rp_obj.ResourceProvider(
                     context, id=pids.id, uuid=pids.uuid,
                     root_provider_uuid=provider_ids[pids.root_id].uuid,
                     parent_provider_uuid=parent_uuid),
-                resources=[],
-            )
-            summary.traits = prov_traits[rp_id]
-            rw_ctx.summaries_by_id[rp_id] = summary
+                traits=traits,
+                trait_mask=rw_ctx.trait_mask(traits))
+            rp_usages = rw_ctx.usages_by_rp_id[rp_id] = []
 
         rc_id = usage.resource_class_id
         if rc_id is None:
@@ -564,92 +800,118 @@ def _build_provider_summaries(context, rw_ctx, root_ids, prov_traits):
             # Let's skip the following and leave "ProviderSummary.resources"
             # field empty.
             continue
-        # NOTE(jaypipes): usage.used may be None due to the LEFT JOIN of
-        # the usages subquery, so we coerce NULL values to 0 here. It may
-        # also be a Decimal, as that's the type that mysql tends to return
-        # when func.sum is used in a query. We need an int, otherwise later
-        # JSON serialization will not work.
-        used = int(usage.used or 0)
-        allocation_ratio = usage.allocation_ratio
-        cap = int((usage.total - usage.reserved) * allocation_ratio)
-        rc_name = context.rc_cache.string_from_id(rc_id)
-        rpsr = ProviderSummaryResource(
-            resource_class=rc_name,
-            capacity=cap,
-            used=used,
-            max_unit=usage.max_unit,
-        )
-        # Construct a dict, keyed by resource provider + resource class, of
-        # ProviderSummaryResource. This will be used to do a final capacity
-        # check/filter on each merged AllocationRequest.
-        psum_key = (rp_id, rc_name)
-        rw_ctx.psum_res_by_rp_rc[psum_key] = rpsr
-        summary.resources.append(rpsr)
+        rp_usages.append(usage)
+        # Register the capacity of the provider + resource class. This will
+        # be used to do a final capacity check/filter on each merged
+        # AllocationRequest.
+        capacity, used = _capacity_and_used(usage)
+        rw_ctx.add_provider_capacity(
+            rp_id, rc_cache.string_from_id(rc_id), capacity, used,
+            usage.max_unit)
+
+    # Index the new trees for the same_subtree checks of the allocation
+    # candidates.
+    rw_ctx.index_provider_trees({
+        pids.uuid: provider_ids[pids.parent_id].uuid if pids.parent_id
+        else None
+        for pids in provider_ids.values()})
+
+
+def _capacity_and_used(usage):
+    """Returns a tuple of the capacity and the used amount of an inventory
+    from its usage row.
+    """
+    # NOTE(jaypipes): usage.used may be None due to the LEFT JOIN of
+    # the usages subquery, so we coerce NULL values to 0 here. It may
+    # also be a Decimal, as that's the type that mysql tends to return
+    # when func.sum is used in a query. We need an int, otherwise later
+    # JSON serialization will not work.
+    used = int(usage.used or 0)
+    capacity = int((usage.total - usage.reserved) * usage.allocation_ratio)
+    return capacity, used
+
+
+def _get_provider_summaries(context, rw_ctx, entries):
+    """Returns a list of ProviderSummary objects, one for each of the supplied
+    ProviderEntry objects, with the resources of the providers recorded by
+    _build_provider_entries.
+
+    :param context: placement.context.RequestContext object
+    :param rw_ctx: placement.research_context.RequestWideSearchContext
+    :param entries: An iterable of ProviderEntry objects
+    """
+    rc_cache = context.rc_cache
+    summaries = []
+    for entry in entries:
+        resources = []
+        for usage in rw_ctx.usages_by_rp_id[entry.resource_provider.id]:
+            capacity, used = _capacity_and_used(usage)
+            resources.append(ProviderSummaryResource(
+                resource_class=rc_cache.string_from_id(
+                    usage.resource_class_id),
+                capacity=capacity,
+                used=used,
+                max_unit=usage.max_unit,
+            ))
+        summaries.append(ProviderSummary(
+            resource_provider=entry.resource_provider,
+            resources=resources,
+            traits=entry.traits,
+            trait_mask=entry.trait_mask,
+        ))
+    return summaries
 
 
 def _check_traits_for_alloc_request(res_requests, summaries, required_traits,
-                                    forbidden_traits):
+                                    required_masks):
     """Given a list of AllocationRequestResource objects, check if that
     combination can provide trait constraints. If it can, returns all
     resource provider internal IDs in play, else return an empty list.
 
-    TODO(tetsuro): For optimization, we should move this logic to SQL in
-                   res_ctx.get_trees_matching_all().
+    NOTE: res_ctx.get_trees_matching_all() already drops the providers having
+    forbidden traits and the trees that cannot satisfy the required traits in
+    any combination, this checks the required traits of a single combination.
 
     :param res_requests: a list of AllocationRequestResource objects that have
                          resource providers to be checked if they collectively
-                         satisfy trait constraints in the required_traits and
-                         forbidden_traits parameters.
-    :param summaries: dict, keyed by resource provider id, of ProviderSummary
-                      objects containing usage and trait information for
-                      resource providers involved in the overall request
+                         satisfy trait constraints in the required_traits
+                         parameter.
+    :param summaries: dict, keyed by resource provider id, of ProviderEntry
+                      or ProviderSummary objects containing trait information
+                      for resource providers involved in the overall request
     :param required_traits: A list of set of trait names where traits
                             in the sets are in OR relationship while traits in
                             two different sets are in AND relationship. Each
                             *allocation request's set of providers* must
                             *collectively* fulfill this trait expression.
-    :param forbidden_traits: A set of trait names that a resource provider must
-                            not have.
+    :param required_masks: A list of the trait masks of each set of
+                           required_traits, see
+                           RequestWideSearchContext.trait_mask(). These are
+                           checked, required_traits is only used for logging.
     """
     all_prov_ids = []
-    all_traits = set()
+    all_traits = 0
     for res_req in res_requests:
         rp_id = res_req.resource_provider.id
-        rp_summary = summaries[rp_id]
-        rp_traits = set(rp_summary.traits)
-
-        # Check if there are forbidden_traits
-        conflict_traits = set(forbidden_traits) & set(rp_traits)
-        if conflict_traits:
-            LOG.debug('Excluding resource provider %s, it has '
-                      'forbidden traits: (%s).',
-                      rp_id, ', '.join(conflict_traits))
-            return []
-
         all_prov_ids.append(rp_id)
-        all_traits |= rp_traits
+        all_traits |= summaries[rp_id].trait_mask
 
     # We need a match for *all* the items from the outer list of the
     # required_traits as that describes AND relationship, and we need at least
     # *one match* per nested trait set as that set describes OR relationship
-
-    # so collect all the matches with the nested sets
-    trait_matches = [
-        any_traits.intersection(all_traits) for any_traits in required_traits]
-
-    # if some internal sets do not match to the provided traits then we have
-    # missing trait (trait set)
-    if not all(trait_matches):
-        missing_traits = [
-            '(' + ' or '.join(any_traits) + ')'
-            for any_traits, match in zip(required_traits, trait_matches)
-            if not match
-        ]
-        LOG.debug(
-            'Excluding a set of allocation candidate %s : '
-            'missing traits %s are not satisfied.',
-            all_prov_ids,
-            ' and '.join(any_traits for any_traits in missing_traits))
+    if not all(mask & all_traits for mask in required_masks):
+        # NOTE: Most combinations might be excluded here, so the missing
+        # traits are only collected if they are logged.
+        if LOG.isEnabledFor(logging.DEBUG):
+            missing_traits = [
+                '(' + ' or '.join(any_traits) + ')'
+                for any_traits, mask in zip(required_traits, required_masks)
+                if not mask & all_traits
+            ]
+            LOG.debug(
+                'Excluding a set of allocation candidate %s : '
+                'missing traits %s are not satisfied.',
+                all_prov_ids, ' and '.join(missing_traits))
         return []
 
     return all_prov_ids
@@ -682,10 +944,16 @@ def _consolidate_allocation_requests(areqs, rw_ctx):
                 "anchor!")
         for arr in areq.resource_requests:
             key = (arr.resource_provider.id, arr.resource_class)
-            if key not in arrs_by_rp_rc:
-                arrs_by_rp_rc[key] = rw_ctx.copy_arr_if_needed(arr)
+            prev_arr = arrs_by_rp_rc.get(key)
+            if prev_arr is None:
+                arrs_by_rp_rc[key] = arr
             else:
-                arrs_by_rp_rc[key].amount += arr.amount
+                # The AllocationRequestResources are shared between the
+                # candidates, so the summed amount goes to a new one.
+                arrs_by_rp_rc[key] = AllocationRequestResource(
+                    resource_provider=arr.resource_provider,
+                    resource_class=arr.resource_class,
+                    amount=prev_arr.amount + arr.amount)
         for suffix, providers in areq.mappings.items():
             mappings[suffix].update(providers)
     return AllocationRequest(
@@ -694,38 +962,308 @@ def _consolidate_allocation_requests(areqs, rw_ctx):
         mappings=mappings)
 
 
-def _exceeds_capacity(rw_ctx, areq_list):
-    """Checks if the list of allocation requests combined into a single
-    allocation does not go over the available capacity.
+class _CandidateTracker(object):
+    """Tracks a partial product of allocation requests while the product is
+    extended and shortened by util.tracked_product, so that whether the
+    allocation requests combined into a single allocation candidate go over
+    the available capacity, or break the group_policy or the same_subtree
+    constraints of the request, is checked with only the allocation request
+    added last.
 
-    Note that this is an optimized, side effect and
-    AllocationResourceRequest copy free, version of the following logic:
+    The result is the same as of the following logic for the partial product,
+    but without creating the consolidated allocation request and without
+    going through the whole partial product at every step:
 
         areq = _consolidate_allocation_requests(areq_list, rw_ctx)
-        return rw_ctx.exceeds_capacity(areq)
-
-    This optimized call can only be used if the consolidated areq is not
-    needed after the call just the result of the exceeds_capacity check. In
-    return this is a lot more performant than the former.
+        return (not rw_ctx.exceeds_capacity(areq) and
+                _satisfies_group_policy(areq_list, ...) and
+                _satisfies_same_subtree(areq_list, rw_ctx))
 
-    :return: True if the consolidated allocation requests more resources than
-             available, False otherwise.
+    except that a same_subtree constraint is only checked once the partial
+    product contains all of its request groups, as the providers of the
+    request groups added later might be the root of the subtree.
     """
-    amount_by_rp_rc = collections.defaultdict(int)
 
-    for areq in areq_list:
-        for arr in areq.resource_requests:
-            key = (arr.resource_provider.id, arr.resource_class)
-            amount_by_rp_rc[key] += arr.amount
-            psum = rw_ctx.psum_res_by_rp_rc[key]
+    def __init__(self, rw_ctx, areq_lists=()):
+        self._limits = rw_ctx.capacity_limits
+        self._capacity_demand = rw_ctx.capacity_demand
+        # The amount consumed by the partial product, keyed by the slots of
+        # the capacity limits it has consumed from. Kept sparse as a request
+        # has the slots of every candidate provider while the product of an
+        # anchor only consumes from the few slots of its own tree.
+        self._consumed = {}
+        # The uuids of the providers used by the request groups of the
+        # partial product that need to be isolated from each other.
+        self._isolate = rw_ctx.group_policy == 'isolate'
+        self._isolated_rp_uuids = set()
+        # For each same_subtree constraint, the number of its request groups
+        # in the partial product and a Counter of the uuids of the providers
+        # they use.
+        self._same_subtrees = [
+            frozenset(same_subtree) for same_subtree in rw_ctx.same_subtrees]
+        self._num_in_same_subtrees = [0] * len(self._same_subtrees)
+        self._rp_uuids_by_same_subtree = [
+            collections.Counter() for _ in self._same_subtrees]
+        self._subtree_intervals = rw_ctx.subtree_interval_by_rp_uuid
+        # Dict, keyed by id() of an AllocationRequest, of what it needs to
+        # be checked against group_policy and same_subtree.
+        self._policy_parts = {}
+        # Dict, keyed by internal ID of the resource providers having
+        # interchangeable peers in areq_lists, of the internal ID of one
+        # provider representing all of them.
+        self.interchangeable = _interchangeable_providers(rw_ctx, areq_lists)
+        self._slots_by_rp_id = rw_ctx.capacity_slots_by_provider(
+            self.interchangeable)
+        # Dict, keyed by id() of an AllocationRequest of areq_lists, of the
+        # part of its symmetry key not depending on the partial product.
+        self._symmetry_parts = {}
+
+    def push(self, areq):
+        """Adds areq to the partial product.
+
+        :return: False, leaving the partial product unchanged, if the
+                 consumed resources would exceed the capacity or the
+                 group_policy or a same_subtree constraint would be broken,
+                 True otherwise.
+        """
+        # This is a hot spot, called for every partial product during the
+        # candidate generation.
+        limits = self._limits
+        consumed = self._consumed
+        demand = self._capacity_demand(areq)
+        for i, (slot, amount) in enumerate(demand):
+            amount += consumed.get(slot, 0)
+            if amount > limits[slot]:
+                for slot, amount in demand[:i]:
+                    consumed[slot] -= amount
+                return False
+            consumed[slot] = amount
+        if (self._isolate or self._same_subtrees) and not self._push_policy(
+                areq):
+            for slot, amount in demand:
+                consumed[slot] -= amount
+            return False
+        return True
 
-            if amount_by_rp_rc[key] > psum.capacity:
-                return True
+    def pop(self, areq):
+        """Removes areq from the partial product."""
+        consumed = self._consumed
+        for slot, amount in self._capacity_demand(areq):
+            consumed[slot] -= amount
+        if self._isolate or self._same_subtrees:
+            self._pop_policy(areq)
+
+    def _get_policy_parts(self, areq):
+        """Returns a tuple of the uuid of the provider areq uses that needs to
+        be isolated, or None, and a tuple of (index of a same_subtree
+        constraint, tuple of provider uuids) pairs of the constraints areq is
+        subject to.
+        """
+        parts = self._policy_parts.get(id(areq))
+        if parts is None:
+            isolated_rp_uuid = None
+            if self._isolate and areq.use_same_provider:
+                # All the resource requests of areq are satisfied by the
+                # same provider by definition.
+                isolated_rp_uuid = next(iter(
+                    list(areq.mappings.values())[0]))
+            subtrees = tuple(
+                (idx, tuple(set().union(*(
+                    areq.mappings[suffix] for suffix in same_subtree
+                    if areq.mappings.get(suffix)))))
+                for idx, same_subtree in enumerate(self._same_subtrees)
+                if not same_subtree.isdisjoint(areq.mappings))
+            parts = self._policy_parts[id(areq)] = (
+                isolated_rp_uuid, subtrees)
+        return parts
+
+    def _push_policy(self, areq):
+        isolated_rp_uuid, subtrees = self._get_policy_parts(areq)
+        if isolated_rp_uuid is not None:
+            if isolated_rp_uuid in self._isolated_rp_uuids:
+                return False
+            self._isolated_rp_uuids.add(isolated_rp_uuid)
+        for i, (idx, rp_uuids) in enumerate(subtrees):
+            self._num_in_same_subtrees[idx] += 1
+            self._rp_uuids_by_same_subtree[idx].update(rp_uuids)
+            if (self._num_in_same_subtrees[idx] ==
+                    len(self._same_subtrees[idx]) and
+                    not _check_same_subtree(
+                        self._rp_uuids_by_same_subtree[idx].keys(),
+                        self._subtree_intervals)):
+                self._pop_subtrees(subtrees[:i + 1])
+                if isolated_rp_uuid is not None:
+                    self._isolated_rp_uuids.remove(isolated_rp_uuid)
+                return False
+        return True
 
-            if amount_by_rp_rc[key] > psum.max_unit:
-                return True
+    def _pop_policy(self, areq):
+        isolated_rp_uuid, subtrees = self._get_policy_parts(areq)
+        if isolated_rp_uuid is not None:
+            self._isolated_rp_uuids.remove(isolated_rp_uuid)
+        self._pop_subtrees(subtrees)
+
+    def _pop_subtrees(self, subtrees):
+        for idx, rp_uuids in subtrees:
+            self._num_in_same_subtrees[idx] -= 1
+            counter = self._rp_uuids_by_same_subtree[idx]
+            for rp_uuid in rp_uuids:
+                counter[rp_uuid] -= 1
+                if not counter[rp_uuid]:
+                    del counter[rp_uuid]
+
+    def symmetry_key(self, areq):
+        """Returns a key of areq that is the same for the allocation requests
+        that only differ in which of the interchangeable providers, being in
+        the same state in the partial product, they request resources from,
+        or None if areq does not request resources from such providers.
+
+        As swapping those providers maps the product of areq_lists to itself
+        without changing the partial product, either all or none of such
+        allocation requests can extend the partial product to a valid
+        product, see util.tracked_product.
+
+        This only prunes the dead ends, the valid products are still
+        enumerated one concrete provider at a time instead of once per class
+        of interchangeable providers. Every concrete candidate is returned,
+        and deduplicated, limited and ordered like without the optimization,
+        so enumerating the classes would only defer the same work to their
+        expansion. The combinatorial explosion is in the partial products
+        that cannot be completed, which are tried once per class here.
+        """
+        parts = self._symmetry_parts.get(id(areq))
+        if parts is None:
+            amounts_by_rp = collections.defaultdict(dict)
+            for arr in areq.resource_requests:
+                rp = arr.resource_provider
+                amounts_by_rp[(rp.id, rp.uuid)][
+                    arr.resource_class] = arr.amount
+            parts = self._symmetry_parts[id(areq)] = tuple(
+                (rp_id, rp_uuid, amounts)
+                for (rp_id, rp_uuid), amounts in amounts_by_rp.items()
+            ) if any(
+                rp_id in self.interchangeable for rp_id, _ in amounts_by_rp
+            ) else ()
+        if not parts:
+            return None
+
+        consumed = self._consumed
+        key = []
+        for rp_id, rp_uuid, amounts in parts:
+            rep_id = self.interchangeable.get(rp_id)
+            if rep_id is None:
+                key.append((rp_id, tuple(sorted(amounts.items()))))
+                continue
+            slots = self._slots_by_rp_id[rp_id]
+            key.append((
+                rep_id,
+                tuple(
+                    (rc, consumed.get(slots[rc], 0), amounts.get(rc, 0))
+                    for rc in sorted(slots)),
+                rp_uuid in self._isolated_rp_uuids,
+                tuple(
+                    rp_uuids[rp_uuid]
+                    for rp_uuids in self._rp_uuids_by_same_subtree)))
+        return tuple(sorted(key))
+
+
+def _areq_key(areq, swap):
+    """Returns a hashable key of the resources and the mappings of areq with
+    the resource provider UUIDs replaced according to swap.
+    """
+    return (
+        frozenset(
+            (swap.get(arr.resource_provider.uuid, arr.resource_provider.uuid),
+             arr.resource_class, arr.amount)
+            for arr in areq.resource_requests),
+        frozenset(
+            (suffix, frozenset(swap.get(u, u) for u in rp_uuids))
+            for suffix, rp_uuids in areq.mappings.items()))
+
+
+def _interchangeable_providers(rw_ctx, areq_lists):
+    """Finds the resource providers that are interchangeable in the lists of
+    allocation requests of the request groups, like the many identical child
+    providers of a wide provider tree.
+
+    Two providers are interchangeable if they are leaves of the same parent,
+    they have the same amount of the same resources available for the
+    allocation candidates, and replacing one with the other and vice versa in
+    any of the allocation requests of a request group results in another
+    allocation request of the same request group. As this is verified on the
+    allocation requests, whatever made the request groups select the
+    providers, like their traits and aggregates, is accounted for.
+
+    The classes of interchangeable providers are only used to skip the
+    symmetric dead ends of the product, see _CandidateTracker.symmetry_key.
 
-    return False
+    :param rw_ctx: RequestWideSearchContext.
+    :param areq_lists: A list of lists of AllocationRequests, one for each
+            request group.
+    :return: A dict, keyed by internal ID of the resource providers having
+             interchangeable peers, of the internal ID of one provider
+             representing all of them.
+    """
+    parent_uuid_by_leaf = rw_ctx.parent_uuid_by_sibling_leaf()
+    if not parent_uuid_by_leaf:
+        return {}
+    rps_by_id = {}
+    for areq_list in areq_lists:
+        for areq in areq_list:
+            for arr in areq.resource_requests:
+                rp = arr.resource_provider
+                if rp.uuid in parent_uuid_by_leaf:
+                    rps_by_id[rp.id] = rp
+    limits = rw_ctx.capacity_limits
+    similar = collections.defaultdict(list)
+    for rp_id, slots in sorted(
+            rw_ctx.capacity_slots_by_provider(rps_by_id).items()):
+        parent_uuid = parent_uuid_by_leaf[rps_by_id[rp_id].uuid]
+        similar[(parent_uuid, tuple(
+            (rc, limits[slot]) for rc, slot in sorted(slots.items())))
+        ].append(rp_id)
+    similar = [rp_ids for rp_ids in similar.values() if len(rp_ids) > 1]
+    if not similar:
+        return {}
+
+    keys_by_list = []
+    areqs_by_rp_uuid_by_list = []
+    for areq_list in areq_lists:
+        keys_by_list.append({_areq_key(areq, {}) for areq in areq_list})
+        areqs_by_rp_uuid = collections.defaultdict(list)
+        for areq in areq_list:
+            # The mappings contain the providers of the resource requests
+            # too.
+            for rp_uuid in set().union(*areq.mappings.values()):
+                areqs_by_rp_uuid[rp_uuid].append(areq)
+        areqs_by_rp_uuid_by_list.append(areqs_by_rp_uuid)
+
+    def _swappable(uuid_a, uuid_b):
+        swap = {uuid_a: uuid_b, uuid_b: uuid_a}
+        for keys, areqs_by_rp_uuid in zip(
+                keys_by_list, areqs_by_rp_uuid_by_list):
+            for areq in itertools.chain(
+                    areqs_by_rp_uuid.get(uuid_a, ()),
+                    areqs_by_rp_uuid.get(uuid_b, ())):
+                if _areq_key(areq, swap) not in keys:
+                    return False
+        return True
+
+    rep_by_rp_id = {}
+    for rp_ids in similar:
+        # The swaps of a representative with each other member of a class
+        # generate every permutation of the class.
+        reps = []
+        for rp_id in rp_ids:
+            uuid = rps_by_id[rp_id].uuid
+            for rep_id in reps:
+                if _swappable(rps_by_id[rep_id].uuid, uuid):
+                    rep_by_rp_id[rep_id] = rep_id
+                    rep_by_rp_id[rp_id] = rep_id
+                    break
+            else:
+                reps.append(rp_id)
+    return rep_by_rp_id
 
 
 def _get_product_generator(rw_ctx):
@@ -733,13 +1271,24 @@ def _get_product_generator(rw_ctx):
 
     If optimize_for_wide_provider_trees config is enabled then the returned
     generator will test the product and only returns products that are
-    valid allocation candidates from resource consumption perspective.
+    valid allocation candidates from resource consumption, group_policy and
+    same_subtree perspective.
     Otherwise, it returns the generic itertools.product that does not
     so such testing.
     """
     if rw_ctx.config.workarounds.optimize_for_wide_provider_trees:
-        exceeds_capacity = functools.partial(_exceeds_capacity, rw_ctx)
-        return functools.partial(util.filtered_product, exceeds_capacity)
+        def tracked_product(*iterables):
+            # A generator is created for every anchor, but depending on the
+            # generation strategy and the limit only some of them are ever
+            # consumed, so the tracker is only built on the first next().
+            iterables = tuple(map(tuple, iterables))
+            tracker = _CandidateTracker(rw_ctx, iterables)
+            yield from util.tracked_product(
+                tracker.push, tracker.pop, *iterables,
+                symmetry_key=(
+                    tracker.symmetry_key if tracker.interchangeable
+                    else None))
+        return tracked_product
     else:
         return itertools.product
 
@@ -769,8 +1318,9 @@ def _get_areq_list_generators(rw_ctx, areq_lists_by_anchor, all_suffixes):
         #   ...,
         # ]
         # When optimization is enabled we use a custom product
-        # implementation that can do capacity checks on each partial product
-        # and prune products with invalid prefixes speeding up the generation.
+        # implementation that can do capacity, group_policy and same_subtree
+        # checks on each partial product and prune products with invalid
+        # prefixes speeding up the generation.
         _get_product_generator(rw_ctx)(*list(areq_lists_by_suffix.values()))
         for areq_lists_by_suffix in areq_lists_by_anchor.values()
         # Filter out any entries that don't have allocation requests for
@@ -801,20 +1351,25 @@ def _generate_areq_lists(rw_ctx, areq_lists_by_anchor, all_suffixes):
 
 def _merge_candidates(candidates, rw_ctx):
     """Given a dict, keyed by RequestGroup suffix, of allocation_requests,
-    produce a single tuple of (allocation_requests, provider_summaries) that
+    produce a single tuple of (allocation_requests, provider_entries) that
     appropriately incorporates the elements from each.
 
     Each alloc_reqs in `candidates` satisfies one RequestGroup. This method
     creates a list of alloc_reqs, *each* of which satisfies *all*
     of the RequestGroups.
 
-    For that merged list of alloc_reqs, a corresponding provider_summaries is
-    produced.
+    For that merged list of alloc_reqs, a corresponding list of the
+    ProviderEntry objects of the providers in the trees involved is
+    produced. The ProviderSummary objects are created from them by
+    _get_provider_summaries once the results are final.
+
+    If the request is limited, the merged list contains at most the requested
+    number of alloc_reqs.
 
     :param candidates: A dict, keyed by suffix string or '', of a set of
             allocation_requests to be merged.
     :param rw_ctx: RequestWideSearchContext.
-    :return: A tuple of (allocation_requests, provider_summaries).
+    :return: A tuple of (allocation_requests, provider_entries).
     """
     # Build a dict, keyed by anchor root provider UUID, of dicts, keyed by
     # suffix, of nonempty lists of AllocationRequest.  Each inner dict must
@@ -844,17 +1399,30 @@ def _merge_candidates(candidates, rw_ctx):
     num_granular_groups = len(all_suffixes - set(['']))
     max_a_c = rw_ctx.config.placement.max_allocation_candidates
     optimize = rw_ctx.config.workarounds.optimize_for_wide_provider_trees
+    # If a limit is requested we stop as soon as we have enough unique
+    # allocation requests. Except if they need to be randomly sampled from
+    # all the unique allocation requests, then we only keep a uniform random
+    # sample of the requested size of the ones seen so far (reservoir
+    # sampling).
+    limit = rw_ctx.merge_limit
+    sample = None
+    if limit and rw_ctx.config.placement.randomize_allocation_candidates:
+        sample = []
+        limit = None
     for areq_list in _generate_areq_lists(
         rw_ctx, areq_lists_by_anchor, all_suffixes
     ):
         # At this point, each AllocationRequest in areq_list is still
         # marked as use_same_provider. This is necessary to filter by group
         # policy, which enforces how these interact with each other.
+        #
+        # If optimization is enabled then the product generator has already
+        # applied the group policy and same_subtree to the areq_list.
         # TODO(efried): Move _satisfies_group_policy to rw_ctx?
-        if not _satisfies_group_policy(
+        if not optimize and not _satisfies_group_policy(
                 areq_list, rw_ctx.group_policy, num_granular_groups):
             continue
-        if not _satisfies_same_subtree(areq_list, rw_ctx):
+        if not optimize and not _satisfies_same_subtree(areq_list, rw_ctx):
             continue
         # Now we go from this (where 'arr' is AllocationRequestResource):
         # [ areq__B(arrX, arrY, arrZ),
@@ -884,26 +1452,41 @@ def _merge_candidates(candidates, rw_ctx):
         if not optimize and rw_ctx.exceeds_capacity(areq):
             continue
 
+        if areq in areqs:
+            continue
         areqs.add(areq)
 
+        if sample is not None:
+            if len(sample) < rw_ctx.merge_limit:
+                sample.append(areq)
+            else:
+                idx = random.randrange(len(areqs))
+                if idx < len(sample):
+                    sample[idx] = areq
+
         if max_a_c >= 0 and len(areqs) >= max_a_c:
             break
+        if limit and len(areqs) >= limit:
+            break
+
+    if sample is not None:
+        areqs = sample
 
     # It's possible we've filtered out everything.  If so, short out.
     if not areqs:
         return [], []
 
-    # Now we have to produce provider summaries. The provider summaries in
-    # rw_ctx.summary_by_id contain all the information; we just need to filter
-    # it down to only the providers in trees represented by our merged list of
-    # allocation requests.
+    # Now we have to produce the providers for the provider summaries. The
+    # provider entries in rw_ctx.providers_by_id contain all the information;
+    # we just need to filter it down to only the providers in trees
+    # represented by our merged list of allocation requests.
     tree_uuids = set()
     for areq in areqs:
         for arr in areq.resource_requests:
             tree_uuids.add(arr.resource_provider.root_provider_uuid)
     psums = [
-        psum for psum in rw_ctx.summaries_by_id.values()
-        if psum.resource_provider.root_provider_uuid in tree_uuids]
+        entry for entry in rw_ctx.providers_by_id.values()
+        if entry.resource_provider.root_provider_uuid in tree_uuids]
 
     LOG.debug('Merging candidates yields %d allocation requests and %d '
               'provider summaries', len(areqs), len(psums))
@@ -951,7 +1534,7 @@ def _satisfies_group_policy(areqs, group_policy, num_granular_groups):
               'group_policy=isolate and the number of granular groups in the '
               'set (%d) does not match the number of granular groups in the '
               'request (%d): %s',
-              num_granular_groups_in_areqs, num_granular_groups, str(areqs))
+              num_granular_groups_in_areqs, num_granular_groups, areqs)
     return False
 
 
@@ -968,7 +1551,8 @@ def _satisfies_same_subtree(areqs, rw_ctx):
                  request groups must be rooted at one of the resource providers
                  satisfying the request groups.
 
-            parent_uuid_by_rp_uuid: A dict of parent uuids keyed by rp uuids.
+            subtree_interval_by_rp_uuid: A dict of the subtree intervals
+                 of the providers keyed by rp uuids.
     :return: True if areqs satisfies same_subtree policy; False otherwise.
     """
     for same_subtree in rw_ctx.same_subtrees:
@@ -976,40 +1560,31 @@ def _satisfies_same_subtree(areqs, rw_ctx):
         rp_uuids = set().union(*(areq.mappings.get(suffix) for areq in areqs
                                for suffix in same_subtree
                                if areq.mappings.get(suffix)))
-        if not _check_same_subtree(rp_uuids, rw_ctx.parent_uuid_by_rp_uuid):
+        if not _check_same_subtree(
+                rp_uuids, rw_ctx.subtree_interval_by_rp_uuid):
             return False
     return True
 
 
-def _check_same_subtree(rp_uuids, parent_uuid_by_rp_uuid):
+def _check_same_subtree(rp_uuids, subtree_interval_by_rp_uuid):
     """Returns True if given rp uuids are all in the same subtree.
 
     Note: The rps are in the same subtree means all the providers are
           rooted at one of the providers
+
+    :param rp_uuids: A set of rp uuids.
+    :param subtree_interval_by_rp_uuid: A dict of the subtree intervals of
+            the providers keyed by rp uuids, see
+            RequestWideSearchContext.index_provider_trees.
     """
     if len(rp_uuids) == 1:
         return True
-    # A set of uuids of common ancestors of each rp in question
-    common_ancestors = set.intersection(*(
-        _get_ancestors_by_one_uuid(rp_uuid, parent_uuid_by_rp_uuid)
-        for rp_uuid in rp_uuids))
-    # if any of the rp_uuid is in the common_ancestors set, then
-    # we know that, that rp_uuid is the root of the other rp_uuids
-    # in this same_subtree constraint.
-    return len(common_ancestors.intersection(rp_uuids)) != 0
-
-
-def _get_ancestors_by_one_uuid(
-        rp_uuid, parent_uuid_by_rp_uuid, ancestors=None):
-    """Returns a set of uuids of ancestors for a given rp uuid"""
-    if ancestors is None:
-        ancestors = set([rp_uuid])
-    parent_uuid = parent_uuid_by_rp_uuid[rp_uuid]
-    if parent_uuid is None:
-        return ancestors
-    ancestors.add(parent_uuid)
-    return _get_ancestors_by_one_uuid(
-        parent_uuid, parent_uuid_by_rp_uuid, ancestors=ancestors)
+    intervals = [subtree_interval_by_rp_uuid[rp_uuid] for rp_uuid in rp_uuids]
+    # Only the provider visited first by the depth-first walk can be the
+    # root of the others. All the others are visited later, so they are in
+    # its subtree if they are visited before leaving it.
+    _, subtree_end = min(intervals)
+    return all(position < subtree_end for position, _ in intervals)
 
 
 def _provider_ids_from_root_ids(context, root_ids):
@@ -238,6 +238,8 @@ class Consumer(object):
         if res.rowcount != 1:
             raise exception.ConcurrentUpdateDetected
         self.generation = new_generation
+        db_api.record_writes(
+            self._context, project_ids=(self.project.external_id,))
 
     def delete(self):
         _delete_consumer(self._context, self)
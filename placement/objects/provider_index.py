@@ -0,0 +1,371 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""A per-process index of the traits and aggregates of resource providers.
+
+When [placement]allocation_candidates_provider_index is enabled, the
+allocation candidates search answers its "which providers have these traits"
+and "which providers are members of these aggregates" questions from this
+index instead of joining the resource_provider_traits and
+resource_provider_aggregates tables once per requested trait or aggregate.
+
+The index maps every trait and aggregate to a bitmap of the internal IDs of
+the providers having it, held in a Python integer where bit N is set if the
+provider with internal ID N has the trait or is a member of the aggregate.
+The AND, OR and NOT of the required, any-of and forbidden trait and member_of
+expressions are then bitwise operations on those integers.
+
+Like the usage snapshot, the index is validated on every use with the
+usage_snapshot.get_data_version() probe. The providers whose updated_at
+moved since the index was built are reloaded individually. As updated_at
+comes from the clocks of the API workers and a write may commit after one
+having a later updated_at, the sums of the generations and of the
+update_counts of the providers, which every change of the traits,
+aggregates or tree of a provider increments, are then compared to the probe;
+a mismatch, as well as creating or deleting providers, leads to a full
+reload.
+"""
+import collections
+import copy
+import threading
+
+from oslo_log import log as logging
+import sqlalchemy as sa
+
+from placement.db.sqlalchemy import models
+from placement import db_api
+from placement.objects import usage_snapshot
+
+
+_RP_TBL = models.ResourceProvider.__table__
+_AGG_TBL = models.PlacementAggregate.__table__
+_RP_AGG_TBL = models.ResourceProviderAggregate.__table__
+_RP_TRAIT_TBL = models.ResourceProviderTrait.__table__
+
+LOG = logging.getLogger(__name__)
+
+# The index currently in use by this process, and a lock serializing the
+# (re)loading of it. Readers never need the lock: an index is never mutated
+# once published, refreshing always builds and publishes a new one.
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+# The tree, generation and update_count of an indexed provider
+IndexedProvider = collections.namedtuple(
+    'IndexedProvider', 'root_id generation update_count')
+
+
+def _bitmap(rp_ids):
+    """Returns the bitmap of an iterable of internal provider IDs."""
+    rp_ids = list(rp_ids)
+    if not rp_ids:
+        return 0
+    bits = bytearray(max(rp_ids) // 8 + 1)
+    for rp_id in rp_ids:
+        bits[rp_id >> 3] |= 1 << (rp_id & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def _ids(bitmap):
+    """Returns the set of internal provider IDs of a bitmap."""
+    # The binary representation with the lowest bit first, so the position
+    # of each '1' is a provider ID.
+    bits = bin(bitmap)[:1:-1]
+    rp_ids = set()
+    rp_id = bits.find('1')
+    while rp_id != -1:
+        rp_ids.add(rp_id)
+        rp_id = bits.find('1', rp_id + 1)
+    return rp_ids
+
+
+class ProviderIndex(object):
+    """An immutable index of the trees, traits and aggregates of providers."""
+
+    def __init__(self, version, providers, traits, aggregates):
+        """Create a ProviderIndex.
+
+        :param version: The usage_snapshot.DataVersion the index was loaded
+                at.
+        :param providers: A dict, keyed by internal provider ID, of
+                IndexedProvider for every provider.
+        :param traits: A dict, keyed by internal provider ID, of frozensets
+                of the internal IDs of the traits of the provider.
+        :param aggregates: A dict, keyed by internal provider ID, of
+                frozensets of the uuids of the aggregates of the provider.
+        """
+        self.version = version
+        self.providers = providers
+        self.traits = traits
+        self.aggregates = aggregates
+        # The sum of the generations of all providers
+        self.generations = sum(p.generation for p in providers.values())
+        # The sum of the update_counts of all providers
+        self.update_counts = sum(
+            p.update_count for p in providers.values())
+        # The bitmap of the root providers
+        self.root_bits = _bitmap(
+            rp_id for rp_id, p in providers.items() if p.root_id == rp_id)
+        # Dicts, keyed by internal trait ID and aggregate uuid, of the bitmap
+        # of the providers having that trait or being a member of that
+        # aggregate.
+        self.bits_by_trait = self._index(traits)
+        self.bits_by_aggregate = self._index(aggregates)
+
+    @staticmethod
+    def _index(keys_by_rp_id):
+        rp_ids_by_key = collections.defaultdict(list)
+        for rp_id, keys in keys_by_rp_id.items():
+            for key in keys:
+                rp_ids_by_key[key].append(rp_id)
+        return {key: _bitmap(rp_ids) for key, rp_ids in rp_ids_by_key.items()}
+
+    def updated(self, version, providers, traits, aggregates):
+        """Returns a new ProviderIndex with the records of some providers
+        replaced. This index is left untouched.
+
+        :param version: The DataVersion of the new index.
+        :param providers: A dict, keyed by internal provider ID, of the new
+                IndexedProvider of the providers to replace.
+        :param traits: A dict, keyed by internal provider ID, of the new
+                trait IDs of the providers to replace. Providers in
+                ``providers`` but not in ``traits`` no longer have traits.
+        :param aggregates: Likewise, a dict of the new aggregate uuids of the
+                providers to replace.
+        """
+        new = copy.copy(self)
+        new.version = version
+        new.providers = dict(self.providers)
+        new.providers.update(providers)
+        new.generations = self.generations + sum(
+            p.generation - self.providers[rp_id].generation
+            for rp_id, p in providers.items())
+        new.update_counts = self.update_counts + sum(
+            p.update_count - self.providers[rp_id].update_count
+            for rp_id, p in providers.items())
+        for rp_id, p in providers.items():
+            bit = 1 << rp_id
+            if p.root_id == rp_id:
+                new.root_bits |= bit
+            else:
+                new.root_bits &= ~bit
+        # The bitmaps are integers, so the dicts holding them are copied but
+        # the bitmaps are not modified in place.
+        new.traits, new.bits_by_trait = self._updated(
+            self.traits, self.bits_by_trait, providers, traits)
+        new.aggregates, new.bits_by_aggregate = self._updated(
+            self.aggregates, self.bits_by_aggregate, providers, aggregates)
+        return new
+
+    @staticmethod
+    def _updated(keys_by_rp_id, bits_by_key, providers, new_keys_by_rp_id):
+        keys_by_rp_id = dict(keys_by_rp_id)
+        bits_by_key = dict(bits_by_key)
+        for rp_id in providers:
+            old_keys = keys_by_rp_id.pop(rp_id, frozenset())
+            keys = new_keys_by_rp_id.get(rp_id, frozenset())
+            if keys:
+                keys_by_rp_id[rp_id] = keys
+            bit = 1 << rp_id
+            for key in old_keys - keys:
+                bits_by_key[key] &= ~bit
+                if not bits_by_key[key]:
+                    del bits_by_key[key]
+            for key in keys - old_keys:
+                bits_by_key[key] = bits_by_key.get(key, 0) | bit
+        return keys_by_rp_id, bits_by_key
+
+    def _any_trait_bits(self, traits):
+        bits = 0
+        for trait_id in traits:
+            bits |= self.bits_by_trait.get(trait_id, 0)
+        return bits
+
+    def provider_ids_matching_aggregates(self, member_of):
+        """The in-memory equivalent of
+        research_context.provider_ids_matching_aggregates().
+        """
+        bits = -1
+        for agg_uuids in member_of:
+            any_bits = 0
+            for agg_uuid in agg_uuids:
+                any_bits |= self.bits_by_aggregate.get(agg_uuid, 0)
+            bits &= any_bits
+            if not bits:
+                return set()
+        return _ids(bits)
+
+    def provider_ids_matching_required_traits(self, required_traits):
+        """The in-memory equivalent of
+        research_context.provider_ids_matching_required_traits().
+        """
+        if not required_traits:
+            raise ValueError('required_traits must not be empty')
+        bits = -1
+        for any_traits in required_traits:
+            bits &= self._any_trait_bits(any_traits)
+            if not bits:
+                return set()
+        return _ids(bits)
+
+    def provider_ids_having_any_trait(self, traits):
+        """The in-memory equivalent of
+        research_context.get_provider_ids_having_any_trait().
+        """
+        if not traits:
+            raise ValueError('traits must not be empty')
+        return _ids(self._any_trait_bits(traits))
+
+    def roots_with_traits(self, required_traits, forbidden_traits):
+        """The in-memory equivalent of
+        research_context._get_roots_with_traits().
+        """
+        if not (required_traits or forbidden_traits):
+            raise ValueError("At least one of required_traits or "
+                             "forbidden_traits is required.")
+        bits = self.root_bits
+        for trait_id in required_traits or ():
+            bits &= self.bits_by_trait.get(trait_id, 0)
+        if forbidden_traits:
+            bits &= ~self._any_trait_bits(forbidden_traits)
+        return _ids(bits)
+
+    def trees_with_traits(self, rp_ids, required_traits, forbidden_traits):
+        """The in-memory equivalent of
+        research_context._get_trees_with_traits().
+        """
+        original_rp_ids = {
+            rp_id: self.providers[rp_id].root_id
+            for rp_id in rp_ids if rp_id in self.providers}
+        forbidden_traits = set(forbidden_traits)
+        # The traits of the providers without forbidden traits, per tree
+        root_to_traits = collections.defaultdict(set)
+        for rp_id, root_id in original_rp_ids.items():
+            traits = self.traits.get(rp_id, frozenset())
+            if traits.isdisjoint(forbidden_traits):
+                root_to_traits[root_id] |= traits
+        return {
+            (rp_id, root_id)
+            for rp_id, root_id in original_rp_ids.items()
+            if root_id in root_to_traits and all(
+                any_traits & root_to_traits[root_id]
+                for any_traits in required_traits)
+        }
+
+
+def _get_providers(ctx, rp_ids=None):
+    sel = sa.select(
+        _RP_TBL.c.id, _RP_TBL.c.root_provider_id, _RP_TBL.c.generation,
+        _RP_TBL.c.update_count)
+    if rp_ids is not None:
+        sel = sel.where(_RP_TBL.c.id.in_(rp_ids))
+    return {r[0]: IndexedProvider(r[1], r[2], r[3])
+            for r in ctx.session.execute(sel)}
+
+
+def _get_traits(ctx, rp_ids=None):
+    sel = sa.select(
+        _RP_TRAIT_TBL.c.resource_provider_id, _RP_TRAIT_TBL.c.trait_id)
+    if rp_ids is not None:
+        sel = sel.where(_RP_TRAIT_TBL.c.resource_provider_id.in_(rp_ids))
+    traits = collections.defaultdict(set)
+    for rp_id, trait_id in ctx.session.execute(sel):
+        traits[rp_id].add(trait_id)
+    return {rp_id: frozenset(ids) for rp_id, ids in traits.items()}
+
+
+def _get_aggregates(ctx, rp_ids=None):
+    # SELECT rpa.resource_provider_id, agg.uuid
+    # FROM resource_provider_aggregates AS rpa
+    # INNER JOIN placement_aggregates AS agg
+    #   ON rpa.aggregate_id = agg.id
+    # # If rp_ids specified:
+    # WHERE rpa.resource_provider_id IN ($RP_IDS)
+    rpa_to_agg = sa.join(
+        _RP_AGG_TBL, _AGG_TBL, _RP_AGG_TBL.c.aggregate_id == _AGG_TBL.c.id)
+    sel = sa.select(
+        _RP_AGG_TBL.c.resource_provider_id, _AGG_TBL.c.uuid,
+    ).select_from(rpa_to_agg)
+    if rp_ids is not None:
+        sel = sel.where(_RP_AGG_TBL.c.resource_provider_id.in_(rp_ids))
+    aggregates = collections.defaultdict(set)
+    for rp_id, agg_uuid in ctx.session.execute(sel):
+        aggregates[rp_id].add(agg_uuid)
+    return {rp_id: frozenset(uuids) for rp_id, uuids in aggregates.items()}
+
+
+@db_api.placement_context_manager.reader.allow_async
+def _load(ctx, version):
+    """Loads a complete ProviderIndex."""
+    return ProviderIndex(
+        version, _get_providers(ctx), _get_traits(ctx), _get_aggregates(ctx))
+
+
+@db_api.placement_context_manager.reader.allow_async
+def _refresh(ctx, index, version):
+    """Returns a new ProviderIndex built from index by reloading only the
+    providers updated since index was built, or None if the changes between
+    the two versions cannot be attributed to those providers.
+    """
+    old = index.version
+    if (version.rp_count != old.rp_count or
+            version.rp_max_id != old.rp_max_id or
+            version.rp_max_created_at != old.rp_max_created_at or
+            old.rp_max_updated_at is None):
+        return None
+
+    # Any provider whose traits or aggregates changed since the index was
+    # built has an updated_at of at least the last value we have seen. If
+    # there is none, only allocations were deleted, which the index does not
+    # care about.
+    sel = sa.select(_RP_TBL.c.id).where(
+        _RP_TBL.c.updated_at >= old.rp_max_updated_at)
+    changed = set(r[0] for r in ctx.session.execute(sel))
+    new = index.updated(
+        version, _get_providers(ctx, changed), _get_traits(ctx, changed),
+        _get_aggregates(ctx, changed))
+
+    # A write that committed after another one having a later updated_at, or
+    # an updated_at set from a clock running behind, is not covered by the
+    # above. The generations and update_counts tell.
+    if (new.generations != version.rp_generations or
+            new.update_counts != version.rp_update_counts):
+        return None
+    return new
+
+
+def get_index(ctx):
+    """Returns an up to date ProviderIndex, or None if the index is disabled
+    by [placement]allocation_candidates_provider_index.
+    """
+    global _INDEX
+
+    if not ctx.config.placement.allocation_candidates_provider_index:
+        return None
+
+    version = usage_snapshot.get_data_version(ctx)
+    index = _INDEX
+    if index is not None and index.version == version:
+        return index
+
+    with _INDEX_LOCK:
+        index = _INDEX
+        if index is not None:
+            if index.version == version:
+                return index
+            new = _refresh(ctx, index, version)
+            if new is not None:
+                LOG.debug('Refreshed provider index incrementally')
+                _INDEX = new
+                return new
+        LOG.debug('Loading provider index')
+        _INDEX = _load(ctx, version)
+        return _INDEX
@@ -11,7 +11,8 @@
 #    under the License.
 """Utility methods for getting allocation candidates."""
 import collections
-import copy
+import threading
+import time
 
 import os_traits
 from oslo_log import log as logging
@@ -22,8 +23,10 @@ from sqlalchemy import sql
 from placement.db.sqlalchemy import models
 from placement import db_api
 from placement import exception
+from placement.objects import provider_index
 from placement.objects import rp_candidates
 from placement.objects import trait as trait_obj
+from placement.objects import usage_snapshot
 
 
 # TODO(tetsuro): Move these public symbols in a central place.
@@ -47,15 +50,23 @@ class RequestGroupSearchContext(object):
     for a single request group.
     """
 
-    def __init__(self, context, group, has_trees, sharing, suffix=''):
+    def __init__(self, context, group, has_trees, sharing, suffix='',
+                 snapshot=None, rw_ctx=None):
         """Initializes the object retrieving and caching matching providers
         for each conditions like resource and aggregates from database.
 
+        :param snapshot: An optional usage_snapshot.UsageSnapshot to look up
+                providers with capacity in instead of the database.
+        :param rw_ctx: An optional RequestWideSearchContext whose memos serve
+                the lookups repeated by the request groups of the request.
+                If given, its usage snapshot is used instead of snapshot.
         :raises placement.exception.ResourceProviderNotFound if there is no
                 provider found which satisfies the request.
         """
         # TODO(tetsuro): split this into smaller functions reordering
         self.context = context
+        self._rw_ctx = rw_ctx
+        self._index = rw_ctx.provider_index if rw_ctx is not None else None
 
         # The request group suffix
         self.suffix = suffix
@@ -63,11 +74,8 @@ class RequestGroupSearchContext(object):
         # A dict, keyed by resource class internal ID, of the amounts of that
         # resource class being requested by the group.
         self.resources = {}
-        # A set of string names of all resource classes requested by the group.
-        self.rcs = set()
         for rc, amount in group.resources.items():
             self.resources[context.rc_cache.id_from_string(rc)] = amount
-            self.rcs.add(rc)
 
         # A list of lists of aggregate UUIDs that the providers matching for
         # that request group must be members of
@@ -80,8 +88,8 @@ class RequestGroupSearchContext(object):
         # A set of provider ids that matches the requested positive aggregates
         self.rps_in_aggs = set()
         if self.member_of:
-            self.rps_in_aggs = provider_ids_matching_aggregates(
-                context, self.member_of)
+            self.rps_in_aggs = self.provider_ids_matching_aggregates(
+                self.member_of)
             if not self.rps_in_aggs:
                 LOG.debug('found no providers matching aggregates %s',
                           self.member_of)
@@ -116,7 +124,10 @@ class RequestGroupSearchContext(object):
         # be satisfied by resource provider(s) under the root provider.
         self.tree_root_id = None
         if group.in_tree:
-            tree_ids = provider_ids_from_uuid(context, group.in_tree)
+            if rw_ctx is not None:
+                tree_ids = rw_ctx.provider_ids_from_uuid(group.in_tree)
+            else:
+                tree_ids = provider_ids_from_uuid(context, group.in_tree)
             if tree_ids is None:
                 LOG.debug("No provider found for in_tree%s=%s",
                           suffix, group.in_tree)
@@ -126,7 +137,37 @@ class RequestGroupSearchContext(object):
                       "tree with the root provider %s",
                       self.suffix, tree_ids.root_uuid)
 
+        # a set of resource provider IDs that share some inventory for some
+        # resource class.
+        self._sharing_providers = sharing
+
+        # bool indicating there is some level of nesting in the environment
+        self.has_trees = has_trees
+
         self._rps_with_resource = {}
+        # A set of tuples of (provider ID, root provider ID) of providers
+        # having all the requested resources, or None if the providers are
+        # looked up per requested resource class.
+        self.rps_with_all_resources = None
+        if rw_ctx is not None:
+            snapshot = rw_ctx.usage_snapshot
+        strategy = (
+            context.config.placement.allocation_candidates_matching_strategy)
+        if (self.resources and snapshot is None and
+                strategy == 'single-query' and
+                (self.use_same_provider or
+                 not (self.exists_sharing or self.exists_nested))):
+            # This group is satisfied by single providers, so we only need
+            # the providers having all the requested resources.
+            LOG.debug('getting providers with all the requested resources')
+            self.rps_with_all_resources = get_providers_with_all_resources(
+                context, self.resources, tree_root_id=self.tree_root_id)
+            if not self.rps_with_all_resources:
+                LOG.debug('found no providers with all the requested '
+                          'resources')
+                raise exception.ResourceProviderNotFound()
+            return
+
         for rc_id, amount in self.resources.items():
             # NOTE(tetsuro): We could pass rps in requested aggregates to
             # get_providers_with_resource here once we explicitly put
@@ -135,20 +176,20 @@ class RequestGroupSearchContext(object):
             # that aggregate on root spans the whole tree
             rc_name = context.rc_cache.string_from_id(rc_id)
             LOG.debug('getting providers with %d %s', amount, rc_name)
-            provs_with_resource = get_providers_with_resource(
-                context, rc_id, amount, tree_root_id=self.tree_root_id)
+            if rw_ctx is not None:
+                provs_with_resource = rw_ctx.providers_with_resource(
+                    rc_id, amount, tree_root_id=self.tree_root_id)
+            elif snapshot is not None:
+                provs_with_resource = snapshot.providers_with_resource(
+                    rc_id, amount, tree_root_id=self.tree_root_id)
+            else:
+                provs_with_resource = get_providers_with_resource(
+                    context, rc_id, amount, tree_root_id=self.tree_root_id)
             if not provs_with_resource:
                 LOG.debug('found no providers with %d %s', amount, rc_name)
                 raise exception.ResourceProviderNotFound()
             self._rps_with_resource[rc_id] = provs_with_resource
 
-        # a set of resource provider IDs that share some inventory for some
-        # resource class.
-        self._sharing_providers = sharing
-
-        # bool indicating there is some level of nesting in the environment
-        self.has_trees = has_trees
-
     @property
     def exists_sharing(self):
         """bool indicating there is sharing providers in the environment for
@@ -169,7 +210,9 @@ class RequestGroupSearchContext(object):
     def get_rps_with_shared_capacity(self, rc_id):
         sharing_in_aggs = self._sharing_providers
         if self.rps_in_aggs:
-            sharing_in_aggs &= self.rps_in_aggs
+            # NOTE: Not &= as the set of sharing providers is shared by every
+            # request group, and may be shared by requests as well.
+            sharing_in_aggs = sharing_in_aggs & self.rps_in_aggs
         if not sharing_in_aggs:
             return set()
         rps_with_resource = set(p[0] for p in self._rps_with_resource[rc_id])
@@ -178,6 +221,51 @@ class RequestGroupSearchContext(object):
     def get_rps_with_resource(self, rc_id):
         return self._rps_with_resource.get(rc_id)
 
+    def provider_ids_matching_aggregates(self, member_of):
+        """Returns the internal IDs of the providers matching member_of, see
+        provider_ids_matching_aggregates. The result must not be modified.
+        """
+        if self._rw_ctx is not None:
+            return self._rw_ctx.provider_ids_matching_aggregates(member_of)
+        return provider_ids_matching_aggregates(self.context, member_of)
+
+    def provider_ids_matching_required_traits(self, required_traits):
+        """Returns the internal IDs of the providers individually having
+        the required traits, see provider_ids_matching_required_traits.
+        """
+        if self._index is not None:
+            return self._index.provider_ids_matching_required_traits(
+                required_traits)
+        return provider_ids_matching_required_traits(
+            self.context, required_traits)
+
+    def provider_ids_having_any_trait(self, traits):
+        """Returns the internal IDs of the providers having any of the
+        traits, see get_provider_ids_having_any_trait.
+        """
+        if self._index is not None:
+            return self._index.provider_ids_having_any_trait(traits)
+        return get_provider_ids_having_any_trait(self.context, traits)
+
+    def traits_by_provider_tree(self, root_ids):
+        """Returns the trait names of the providers in the trees of root_ids,
+        see RequestWideSearchContext.traits_by_provider_tree.
+        """
+        if self._rw_ctx is not None:
+            return self._rw_ctx.traits_by_provider_tree(root_ids)
+        return trait_obj.get_traits_by_provider_tree(self.context, root_ids)
+
+    def trees_with_traits(self, rp_ids, required_traits, forbidden_traits):
+        """Returns the (provider ID, root provider ID) tuples of the
+        providers of rp_ids in trees that can satisfy the trait constraints,
+        see _get_trees_with_traits.
+        """
+        if self._index is not None:
+            return self._index.trees_with_traits(
+                rp_ids, required_traits, forbidden_traits)
+        return _get_trees_with_traits(
+            self.context, rp_ids, required_traits, forbidden_traits)
+
 
 class RequestWideSearchContext(object):
     """An adapter object that represents the search for allocation candidates
@@ -196,26 +284,82 @@ class RequestWideSearchContext(object):
         self._limit = rqparams.limit
         self.group_policy = rqparams.group_policy
         self._nested_aware = nested_aware
-        self.has_trees = _has_provider_trees(context)
+        self.has_trees = has_provider_trees(context)
+        # A usage_snapshot.UsageSnapshot to be used instead of querying
+        # inventories and usages, or None if it is disabled.
+        self.usage_snapshot = usage_snapshot.get_snapshot(context)
+        # A provider_index.ProviderIndex to be used instead of querying
+        # provider traits and aggregates, or None if it is disabled.
+        self.provider_index = provider_index.get_index(context)
         # This is set up by _process_anchor_* below. It remains None if no
         # anchor filters were requested. Otherwise it becomes a set of internal
         # IDs of root providers that conform to the requested filters.
         self.anchor_root_ids = None
         self._process_anchor_traits(rqparams)
         self.same_subtrees = rqparams.same_subtrees
-        # A dict, keyed by resource provider id of ProviderSummary objects.
-        # Used as a cache of ProviderSummaries created in this request to
-        # avoid duplication.
-        self.summaries_by_id = {}
-        # A set of resource classes that were requested in more than one group
-        self.multi_group_rcs = set()
+        # A dict, keyed by resource provider id, of the
+        # allocation_candidate.ProviderEntry of every provider in the trees
+        # seen by this request. These carry what the search needs to know
+        # about the providers, the ProviderSummary objects are only created
+        # for the trees in the final result.
+        self.providers_by_id = {}
+        # A dict, keyed by resource provider id, of lists of the usage rows of
+        # the inventories of the provider, see
+        # get_usages_by_provider_trees(). Used to create the ProviderSummary
+        # objects.
+        self.usages_by_rp_id = {}
         # A mapping of resource provider uuid to parent provider uuid, used
         # when merging allocation candidates.
         self.parent_uuid_by_rp_uuid = {}
-        # Dict mapping (resource provier uuid, resource class name) to a
-        # ProviderSummaryResource. Used during _exceeds_capacity in
-        # _merge_candidates.
-        self.psum_res_by_rp_rc = {}
+        # The result of parent_uuid_by_sibling_leaf and the size of
+        # parent_uuid_by_rp_uuid it was computed for.
+        self._parent_uuid_by_sibling_leaf = ({}, 0)
+        # A mapping of resource provider uuid to a tuple of the position of
+        # the provider in a depth-first walk of its tree and the position
+        # following its last descendant, filled by index_provider_trees. A
+        # provider is in the subtree of another one if its position falls
+        # in that interval. Used to check same_subtree while merging
+        # allocation candidates.
+        self.subtree_interval_by_rp_uuid = {}
+        # Dict mapping (resource provider id, resource class name) to a dense
+        # integer slot, and a list, indexed by slot, of the largest amount of
+        # that resource a single allocation candidate can consume from that
+        # provider. Used by exceeds_capacity and capacity_demand.
+        self._capacity_slot_by_rp_rc = {}
+        self.capacity_limits = []
+        # The same slots keyed by resource provider id and resource class
+        # name, see capacity_slots_by_provider.
+        self._capacity_slots_by_rp_id = collections.defaultdict(dict)
+        # Dict, keyed by id() of an AllocationRequest, of a tuple of that
+        # AllocationRequest and its resource requests translated to
+        # (slot, amount) pairs. The AllocationRequest is kept referenced so
+        # its id() is not reused while the cache lives.
+        self._capacity_demands = {}
+        # Dict, keyed by internal ID of a sharing provider, of a set of
+        # AnchorIds of the trees the sharing provider shares resources with.
+        # Filled by anchors_for_sharing_providers.
+        self._anchors_by_sharing_rp_id = {}
+        # Memos of the lookups repeated by the request groups of this
+        # request, filled by the methods of the same names below:
+        # provider_ids_from_uuid results keyed by provider uuid,
+        self._provider_ids_by_uuid = {}
+        # frozensets of (provider ID, root provider ID) tuples keyed by
+        # (resource class ID, amount, root provider ID),
+        self._providers_with_resource = {}
+        # frozensets of provider IDs keyed by a frozenset of frozensets of
+        # aggregate uuids,
+        self._provider_ids_by_aggregates = {}
+        # and dicts, keyed by provider ID, of lists of trait names keyed by
+        # root provider ID.
+        self._traits_by_root_id = {}
+        # A dict, keyed by trait name, of the bit of that trait in the trait
+        # masks of this request, for the traits of its request groups. Filled
+        # by register_traits() before any request group is searched.
+        self._trait_bits = {}
+        # Serializes the changes of the above caches by request groups
+        # searched concurrently, see
+        # [placement]allocation_candidates_group_workers.
+        self.lock = threading.Lock()
 
     def _process_anchor_traits(self, rqparams):
         """Set or filter self.anchor_root_ids according to anchor
@@ -238,8 +382,12 @@ class RequestWideSearchContext(object):
         forbidden_ids = set(trait_obj.ids_from_names(
             self._ctx, forbidden).values()) if forbidden else None
 
-        self.anchor_root_ids = _get_roots_with_traits(
-            self._ctx, required_ids, forbidden_ids)
+        if self.provider_index is not None:
+            self.anchor_root_ids = self.provider_index.roots_with_traits(
+                required_ids, forbidden_ids)
+        else:
+            self.anchor_root_ids = _get_roots_with_traits(
+                self._ctx, required_ids, forbidden_ids)
 
         if not self.anchor_root_ids:
             LOG.debug('found no providers satisfying required traits: %s and '
@@ -256,6 +404,19 @@ class RequestWideSearchContext(object):
             return True
         return anchor_root_id in self.anchor_root_ids
 
+    @property
+    def merge_limit(self):
+        """The number of unique allocation requests _merge_candidates needs to
+        produce to honor the requested limit, or None if it needs to produce
+        all of them.
+
+        Merging can stop early only if no merged allocation request is
+        filtered out afterwards by exclude_nested_providers.
+        """
+        if self._nested_aware or not self.has_trees:
+            return self._limit
+        return None
+
     def exclude_nested_providers(
             self, allocation_requests, provider_summaries):
         """Exclude allocation requests and provider summaries for old
@@ -322,25 +483,244 @@ class RequestWideSearchContext(object):
 
         return alloc_request_objs, summary_objs
 
-    def copy_arr_if_needed(self, arr):
-        """Copy or return arr, depending on the search context.
+    def anchors_for_sharing_providers(self, rp_ids):
+        """Returns the anchors of sharing providers, looking up the anchors
+        of the sharing providers not seen before in this request with a
+        single query.
 
-        In cases with group_policy=none where multiple groups request
-        amounts from the same resource class, we end up using the same
-        AllocationRequestResource more than once when consolidating. So we
-        need to make a copy so we don't overwrite the one used for a
-        different result. But as an optimization, since this copy is not
-        cheap, we don't do it unless it's necessary.
+        :param rp_ids: An iterable of internal IDs of sharing providers.
+        :return: A dict, keyed by each of rp_ids, of a set of AnchorIds
+                 namedtuples, as returned by anchors_for_sharing_providers.
+        """
+        rp_ids = set(rp_ids)
+        anchors_by_rp_id = self._anchors_by_sharing_rp_id
+        with self.lock:
+            missing = rp_ids - set(anchors_by_rp_id)
+        if missing:
+            # NOTE: Do not hold the lock while querying, see
+            # provider_ids_from_uuid.
+            found = {rp_id: set() for rp_id in missing}
+            for anchor in anchors_for_sharing_providers(self._ctx, missing):
+                found[anchor.rp_id].add(anchor)
+            with self.lock:
+                for rp_id, anchors in found.items():
+                    anchors_by_rp_id.setdefault(rp_id, anchors)
+        with self.lock:
+            return {rp_id: anchors_by_rp_id[rp_id] for rp_id in rp_ids}
+
+    def provider_ids_from_uuid(self, uuid):
+        """Returns provider_ids_from_uuid(uuid), looking it up only once per
+        request.
+        """
+        with self.lock:
+            if uuid in self._provider_ids_by_uuid:
+                return self._provider_ids_by_uuid[uuid]
+        # NOTE: Do not hold the lock while querying, so request groups
+        # searched concurrently are not serialized. Another group may look up
+        # the same value meanwhile, which is harmless.
+        ids = provider_ids_from_uuid(self._ctx, uuid)
+        with self.lock:
+            return self._provider_ids_by_uuid.setdefault(uuid, ids)
+
+    def providers_with_resource(self, rc_id, amount, tree_root_id=None):
+        """Returns the (provider ID, root provider ID) tuples of the providers
+        having the capacity for amount of the resource class, looking them up
+        in the usage snapshot if any or in the database only once per request.
+
+        :return: A frozenset of (provider ID, root provider ID) tuples.
+        """
+        key = (rc_id, amount, tree_root_id)
+        with self.lock:
+            if key in self._providers_with_resource:
+                return self._providers_with_resource[key]
+        if self.usage_snapshot is not None:
+            rps = self.usage_snapshot.providers_with_resource(
+                rc_id, amount, tree_root_id=tree_root_id)
+        else:
+            rps = get_providers_with_resource(
+                self._ctx, rc_id, amount, tree_root_id=tree_root_id)
+        with self.lock:
+            return self._providers_with_resource.setdefault(
+                key, frozenset(rps))
+
+    def provider_ids_matching_aggregates(self, member_of):
+        """Returns provider_ids_matching_aggregates(member_of), looking it up
+        only once per request for the same aggregates in any order.
 
-        :param arr: An AllocationRequestResource to be returned or copied and
-                returned.
-        :return: arr or a copy thereof.
+        :return: A frozenset of internal provider IDs.
+        """
+        key = frozenset(frozenset(agg_uuids) for agg_uuids in member_of)
+        with self.lock:
+            if key in self._provider_ids_by_aggregates:
+                return self._provider_ids_by_aggregates[key]
+        if self.provider_index is not None:
+            rp_ids = self.provider_index.provider_ids_matching_aggregates(
+                member_of)
+        else:
+            rp_ids = provider_ids_matching_aggregates(self._ctx, member_of)
+        with self.lock:
+            return self._provider_ids_by_aggregates.setdefault(
+                key, frozenset(rp_ids))
+
+    def traits_by_provider_tree(self, root_ids):
+        """Returns the traits of the providers in the trees of root_ids,
+        looking up the traits of the trees not seen before in this request
+        with a single query.
+
+        :param root_ids: An iterable of internal IDs of root providers. Other
+                provider IDs are ignored like get_traits_by_provider_tree does.
+        :return: A new dict, keyed by internal provider ID, of lists of trait
+                 names, for the providers of the trees of root_ids. Providers
+                 without traits are missing from it.
         """
-        if self.group_policy != 'none':
-            return arr
-        if arr.resource_class in self.multi_group_rcs:
-            return copy.copy(arr)
-        return arr
+        root_ids = set(root_ids)
+        with self.lock:
+            missing = root_ids - self._traits_by_root_id.keys()
+        if missing:
+            traits_by_root_id = get_traits_by_provider_trees(
+                self._ctx, missing)
+            with self.lock:
+                for root_id in missing:
+                    self._traits_by_root_id.setdefault(
+                        root_id, traits_by_root_id.get(root_id, {}))
+        traits_by_rp_id = {}
+        with self.lock:
+            for root_id in root_ids:
+                traits_by_rp_id.update(self._traits_by_root_id[root_id])
+        return traits_by_rp_id
+
+    def register_traits(self, trait_names):
+        """Assigns a bit in the trait masks of this request to each of the
+        trait names not registered yet.
+        """
+        for name in trait_names:
+            self._trait_bits.setdefault(name, 1 << len(self._trait_bits))
+
+    def trait_mask(self, trait_names):
+        """Returns the bitmask of the registered traits among trait_names.
+        Checking whether providers collectively have the required traits of
+        a request group is then a matter of ORing and ANDing integers instead
+        of building sets of trait names.
+        """
+        mask = 0
+        for name in trait_names:
+            mask |= self._trait_bits.get(name, 0)
+        return mask
+
+    def index_provider_trees(self, parent_uuid_by_rp_uuid):
+        """Numbers the providers of whole provider trees in depth-first order
+        and adds their intervals to subtree_interval_by_rp_uuid.
+
+        :param parent_uuid_by_rp_uuid: A dict of parent uuids keyed by rp
+                uuids, of every provider of the trees not indexed yet.
+        """
+        children = collections.defaultdict(list)
+        for rp_uuid, parent_uuid in parent_uuid_by_rp_uuid.items():
+            children[parent_uuid].append(rp_uuid)
+        # The providers in depth-first order, where the subtree of each
+        # provider directly follows it.
+        order = []
+        stack = list(children[None])
+        while stack:
+            rp_uuid = stack.pop()
+            order.append(rp_uuid)
+            stack.extend(children.get(rp_uuid, ()))
+        size_by_rp_uuid = {}
+        for rp_uuid in reversed(order):
+            size_by_rp_uuid[rp_uuid] = 1 + sum(
+                size_by_rp_uuid[child]
+                for child in children.get(rp_uuid, ()))
+        intervals = self.subtree_interval_by_rp_uuid
+        start = len(intervals)
+        for position, rp_uuid in enumerate(order, start):
+            intervals[rp_uuid] = (
+                position, position + size_by_rp_uuid[rp_uuid])
+
+    def add_provider_capacity(self, rp_id, resource_class, capacity, used,
+                              max_unit):
+        """Registers the capacity of an inventory of a resource provider so
+        that allocation requests consuming from it can be checked by
+        exceeds_capacity and capacity_demand.
+
+        :param rp_id: The internal ID of the resource provider.
+        :param resource_class: The name of the resource class.
+        :param capacity: The capacity of the inventory, taking the reserved
+                         amount and the allocation ratio into account.
+        :param used: The amount of the inventory already allocated.
+        :param max_unit: The max_unit of the inventory.
+        """
+        key = (rp_id, resource_class)
+        # An allocation fits if it neither exceeds the capacity not yet used
+        # nor the max_unit of the inventory.
+        limit = min(capacity - used, max_unit)
+        slot = self._capacity_slot_by_rp_rc.get(key)
+        if slot is None:
+            slot = len(self.capacity_limits)
+            self._capacity_slot_by_rp_rc[key] = slot
+            self._capacity_slots_by_rp_id[rp_id][resource_class] = slot
+            self.capacity_limits.append(limit)
+        else:
+            self.capacity_limits[slot] = limit
+
+    def capacity_demand(self, areq):
+        """Returns the resource requests of an AllocationRequest as a tuple
+        of (slot, amount) pairs, where slot indexes capacity_limits.
+
+        The result is cached for the lifetime of this context, so it must
+        only be called with AllocationRequests that are not changed later,
+        i.e. with the ones produced for the individual request groups.
+
+        :param areq: An AllocationRequest whose providers have been
+                registered with add_provider_capacity.
+        """
+        entry = self._capacity_demands.get(id(areq))
+        if entry is None:
+            slots = self._capacity_slot_by_rp_rc
+            demand = tuple(
+                (slots[(arr.resource_provider.id, arr.resource_class)],
+                 arr.amount)
+                for arr in areq.resource_requests)
+            entry = self._capacity_demands[id(areq)] = (areq, demand)
+        return entry[1]
+
+    def capacity_slots_by_provider(self, rp_ids):
+        """Returns the capacity slots of resource providers.
+
+        :param rp_ids: An iterable of internal IDs of resource providers
+                registered with add_provider_capacity.
+        :return: A dict, keyed by each of rp_ids, of a dict, keyed by
+                 resource class name, of the slot indexing capacity_limits.
+                 The inner dicts must not be modified.
+        """
+        slots_by_rp_id = self._capacity_slots_by_rp_id
+        return {rp_id: slots_by_rp_id.get(rp_id, {}) for rp_id in rp_ids}
+
+    def parent_uuid_by_sibling_leaf(self):
+        """Returns a dict, keyed by the uuid of each leaf provider in
+        parent_uuid_by_rp_uuid having at least one sibling that is a leaf
+        too, of the uuid of its parent. Such leaves are the candidates of
+        being interchangeable, so if there are none, like in flat trees,
+        there is no need to look for interchangeable providers.
+
+        The result is computed again only after parent_uuid_by_rp_uuid has
+        grown, and must not be modified.
+        """
+        parent_uuid_by_rp_uuid = self.parent_uuid_by_rp_uuid
+        result, size = self._parent_uuid_by_sibling_leaf
+        if size != len(parent_uuid_by_rp_uuid):
+            parent_uuids = set(parent_uuid_by_rp_uuid.values())
+            leaves_by_parent = collections.defaultdict(list)
+            for rp_uuid, parent_uuid in parent_uuid_by_rp_uuid.items():
+                if parent_uuid is not None and rp_uuid not in parent_uuids:
+                    leaves_by_parent[parent_uuid].append(rp_uuid)
+            result = {
+                rp_uuid: parent_uuid
+                for parent_uuid, rp_uuids in leaves_by_parent.items()
+                if len(rp_uuids) > 1
+                for rp_uuid in rp_uuids}
+            self._parent_uuid_by_sibling_leaf = (
+                result, len(parent_uuid_by_rp_uuid))
+        return result
 
     def exceeds_capacity(self, areq):
         """Checks a (consolidated) AllocationRequest against the provider
@@ -358,12 +738,11 @@ class RequestWideSearchContext(object):
         # GET allocation_candidates query. Please do not add logging in this
         # function permanently as it will cause excessive logging.
 
+        slots = self._capacity_slot_by_rp_rc
+        limits = self.capacity_limits
         for arr in areq.resource_requests:
-            key = (arr.resource_provider.id, arr.resource_class)
-            psum_res = self.psum_res_by_rp_rc[key]
-            if psum_res.used + arr.amount > psum_res.capacity:
-                return True
-            if arr.amount > psum_res.max_unit:
+            slot = slots[(arr.resource_provider.id, arr.resource_class)]
+            if arr.amount > limits[slot]:
                 return True
         return False
 
@@ -372,7 +751,7 @@ class RequestWideSearchContext(object):
         return self._ctx.config
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def provider_ids_from_uuid(context, uuid):
     """Given the UUID of a resource provider, returns a sqlalchemy object with
     the internal ID, the UUID, the parent provider's internal ID, parent
@@ -440,7 +819,7 @@ def _capacity_check_clause(amount, usage, inv_tbl=_INV_TBL):
     )
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def get_providers_with_resource(ctx, rc_id, amount, tree_root_id=None):
     """Returns a set of tuples of (provider ID, root provider ID) of providers
     that satisfy the request for a single resource class.
@@ -496,7 +875,80 @@ def get_providers_with_resource(ctx, rc_id, amount, tree_root_id=None):
     return res
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
+def get_providers_with_all_resources(ctx, resources, tree_root_id=None):
+    """Returns a set of tuples of (provider ID, root provider ID) of providers
+    that satisfy the request for every resource class of a single provider
+    request group, using a single query.
+
+    :param ctx: Session context to use
+    :param resources: A dict, keyed by internal ID of resource class, of the
+                      amount of the resource being requested
+    :param tree_root_id: An optional root provider ID. If provided, the results
+                         are limited to the resource providers under the given
+                         root resource provider.
+    """
+    # SELECT rp.id, rp.root_provider_id
+    # FROM resource_providers AS rp
+    # JOIN inventories AS inv
+    # ON rp.id = inv.resource_provider_id
+    # LEFT JOIN (
+    #  SELECT
+    #    allocs.resource_provider_id,
+    #    allocs.resource_class_id,
+    #    SUM(allocs.used) AS used
+    #  FROM allocations AS allocs
+    #  WHERE allocs.resource_class_id IN ($RC_IDS)
+    #  GROUP BY allocs.resource_provider_id, allocs.resource_class_id
+    # ) AS usage
+    #  ON inv.resource_provider_id = usage.resource_provider_id
+    #  AND inv.resource_class_id = usage.resource_class_id
+    # WHERE (
+    #  inv.resource_class_id = $RC_ID_1
+    #  AND used + $AMOUNT_1 <= ((total - reserved) * inv.allocation_ratio)
+    #  AND inv.min_unit <= $AMOUNT_1
+    #  AND inv.max_unit >= $AMOUNT_1
+    #  AND $AMOUNT_1 % inv.step_size = 0
+    # ) OR (
+    #  inv.resource_class_id = $RC_ID_2
+    #  AND ...
+    # )
+    #  # If tree_root_id specified:
+    #  AND rp.root_provider_id == $tree_root_id
+    # GROUP BY rp.id, rp.root_provider_id
+    # HAVING COUNT(inv.resource_class_id) = $NUM_RCS
+    rpt = sa.alias(_RP_TBL, name="rp")
+    inv = sa.alias(_INV_TBL, name="inv")
+    usage = _usage_select(list(resources))
+    rp_to_inv = sa.join(rpt, inv, rpt.c.id == inv.c.resource_provider_id)
+    inv_to_usage = sa.outerjoin(
+        rp_to_inv, usage, sa.and_(
+            inv.c.resource_provider_id == usage.c.resource_provider_id,
+            inv.c.resource_class_id == usage.c.resource_class_id))
+    sel = sa.select(rpt.c.id, rpt.c.root_provider_id)
+    sel = sel.select_from(inv_to_usage)
+    # As there is at most one inventory per provider and resource class, a
+    # provider satisfies the request if it has an inventory with enough
+    # capacity for as many resource classes as requested.
+    where_conds = sa.or_(*[
+        sa.and_(
+            inv.c.resource_class_id == rc_id,
+            _capacity_check_clause(amount, usage, inv_tbl=inv))
+        for rc_id, amount in resources.items()])
+    if tree_root_id is not None:
+        where_conds = sa.and_(
+            rpt.c.root_provider_id == tree_root_id,
+            where_conds)
+    sel = sel.where(where_conds)
+    sel = sel.group_by(rpt.c.id, rpt.c.root_provider_id)
+    sel = sel.having(
+        sql.func.count(inv.c.resource_class_id) == len(resources))
+    res = ctx.session.execute(sel).fetchall()
+    res = set((r[0], r[1]) for r in res)
+    return res
+
+
+@db_api.placement_context_manager.reader.allow_async
 def get_providers_with_root(ctx, allowed, forbidden):
     """Returns a set of tuples of (provider ID, root provider ID) of given
     resource providers
@@ -523,7 +975,7 @@ def get_providers_with_root(ctx, allowed, forbidden):
     return res
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def get_provider_ids_matching(rg_ctx):
     """Returns a list of tuples of (internal provider ID, root provider ID)
     that have available inventory to satisfy all the supplied requests for
@@ -548,6 +1000,16 @@ def get_provider_ids_matching(rg_ctx):
         # If no providers match the traits/aggs, we can short out
         return []
 
+    provs_with_resource = rg_ctx.rps_with_all_resources
+    if provs_with_resource is not None:
+        LOG.debug("found %d providers with all the requested resources",
+                  len(provs_with_resource))
+        if filtered_rps:
+            return [rpids for rpids in provs_with_resource
+                    if rpids[0] in filtered_rps]
+        return [rpids for rpids in provs_with_resource
+                if rpids[0] not in forbidden_rp_ids]
+
     # Instead of constructing a giant complex SQL statement that joins multiple
     # copies of derived usage tables and inventory tables to each other, we do
     # one query for each requested resource class. This allows us to log a
@@ -610,7 +1072,7 @@ def get_provider_ids_matching(rg_ctx):
     return [rpids for rpids in provs_with_resource if rpids[0] in filtered_rps]
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def get_trees_matching_all(rg_ctx, rw_ctx):
     """Returns a RPCandidates object representing the providers that satisfy
     the request for resources.
@@ -641,8 +1103,8 @@ def get_trees_matching_all(rg_ctx, rw_ctx):
     :param rw_ctx: RequestWideSearchContext
     """
     if rg_ctx.forbidden_aggs:
-        rps_bad_aggs = provider_ids_matching_aggregates(
-            rg_ctx.context, [rg_ctx.forbidden_aggs])
+        rps_bad_aggs = rg_ctx.provider_ids_matching_aggregates(
+            [rg_ctx.forbidden_aggs])
 
     # To get all trees that collectively have all required resource,
     # aggregates and traits, we use `RPCandidateList` which has a list of
@@ -673,10 +1135,12 @@ def get_trees_matching_all(rg_ctx, rw_ctx):
             # got via get_providers_with_resource() above. We must skip this
             # process if tree_root_id is provided via the ?in_tree=<rp_uuid>
             # queryparam, because it restricts resources from another tree.
-            anchors = anchors_for_sharing_providers(
-                rg_ctx.context, sharing_providers)
+            anchors_by_rp_id = rw_ctx.anchors_for_sharing_providers(
+                sharing_providers)
             rc_provs_with_inv = set(
-                (anchor.rp_id, anchor.anchor_id) for anchor in anchors)
+                (anchor.rp_id, anchor.anchor_id)
+                for anchors in anchors_by_rp_id.values()
+                for anchor in anchors)
             provs_with_inv_rc.add_rps(rc_provs_with_inv, rc_id)
             LOG.debug(
                 "considering %d sharing providers with %d %s, "
@@ -730,32 +1194,84 @@ def get_trees_matching_all(rg_ctx, rw_ctx):
         if not provs_with_inv:
             return rp_candidates.RPCandidateList()
 
-    if (not rg_ctx.required_traits and not rg_ctx.forbidden_traits) or (
-            rg_ctx.exists_sharing):
+    if not rg_ctx.required_traits and not rg_ctx.forbidden_traits:
         # If there were no traits required, there's no difference in how we
         # calculate allocation requests between nested and non-nested
-        # environments, so just short-circuit and return. Or if sharing
-        # providers are in play, we check the trait constraints later
-        # in _alloc_candidates_multiple_providers(), so skip.
+        # environments, so just short-circuit and return.
         return provs_with_inv
 
-    # Return the providers where the providers have the available inventory
-    # capacity and that set of providers (grouped by their tree) have all
-    # of the required traits and none of the forbidden traits
-    rp_tuples_with_trait = _get_trees_with_traits(
-        rg_ctx.context, provs_with_inv.rps, rg_ctx.required_traits,
-        rg_ctx.forbidden_traits)
-    provs_with_inv.filter_by_rp(rp_tuples_with_trait)
+    if not rg_ctx.exists_sharing:
+        # Return the providers where the providers have the available
+        # inventory capacity and that set of providers (grouped by their tree)
+        # have all of the required traits and none of the forbidden traits.
+        # With sharing providers in play the trees are formed by the anchors,
+        # not by the root providers, so this is skipped.
+        rp_tuples_with_trait = rg_ctx.trees_with_traits(
+            provs_with_inv.rps, rg_ctx.required_traits,
+            list(rg_ctx.forbidden_traits.values()))
+        provs_with_inv.filter_by_rp(rp_tuples_with_trait)
+        LOG.debug("found %d providers under %d trees after applying "
+                  "traits filter - required: %s, forbidden: %s",
+                  len(provs_with_inv.rps), len(provs_with_inv.trees),
+                  list(rg_ctx.required_trait_names),
+                  list(rg_ctx.forbidden_traits))
+
+    # Drop the providers having forbidden traits and the trees that are left
+    # without providers of a requested resource class or that collectively
+    # lack a required trait. So no combination of providers is generated
+    # that could not satisfy the trait constraints.
+    _filter_candidates_by_traits(rg_ctx, provs_with_inv)
     LOG.debug("found %d providers under %d trees after applying "
-              "traits filter - required: %s, forbidden: %s",
-              len(provs_with_inv.rps), len(provs_with_inv.trees),
-              list(rg_ctx.required_trait_names),
-              list(rg_ctx.forbidden_traits))
+              "per provider traits filter",
+              len(provs_with_inv.rps), len(provs_with_inv.trees))
 
     return provs_with_inv
 
 
-@db_api.placement_context_manager.reader
+def _filter_candidates_by_traits(rg_ctx, provs_with_inv):
+    """Filters a RPCandidateList in place by the trait constraints of a
+    request group, given that the providers of the candidates in a tree
+    collectively have to satisfy the required traits and none of them may
+    have a forbidden trait.
+
+    The trees here are identified by the anchor root provider of each
+    candidate, so sharing providers belong to the trees they are anchored to.
+    A tree surviving this filter might still not be a match, as a given
+    combination of its providers might lack a required trait. That is checked
+    by allocation_candidate._check_traits_for_alloc_request.
+
+    :param rg_ctx: RequestGroupSearchContext
+    :param provs_with_inv: RPCandidateList to filter
+    """
+    if not provs_with_inv:
+        return
+    forbidden = set(rg_ctx.forbidden_traits)
+    # Sharing providers are roots themselves but are anchored to other trees,
+    # so look up the trees of both like _alloc_candidates_multiple_providers
+    # does, which then finds the traits looked up here in the memo.
+    traits_by_rp = rg_ctx.traits_by_provider_tree(provs_with_inv.all_rps)
+
+    rcs_by_tree = collections.defaultdict(set)
+    traits_by_tree = collections.defaultdict(set)
+    forbidden_rps = set()
+    for rp in provs_with_inv.rps_info:
+        rp_traits = set(traits_by_rp.get(rp.id, ()))
+        if rp_traits & forbidden:
+            forbidden_rps.add(rp.id)
+            continue
+        rcs_by_tree[rp.root_id].add(rp.rc_id)
+        traits_by_tree[rp.root_id] |= rp_traits
+
+    good_trees = set(
+        root_id for root_id, rcs in rcs_by_tree.items()
+        if len(rcs) == len(rg_ctx.resources) and all(
+            any_traits & traits_by_tree[root_id]
+            for any_traits in rg_ctx.required_trait_names))
+    provs_with_inv.exclude_rps(forbidden_rps)
+    provs_with_inv.filter_by_tree(good_trees)
+
+
+@db_api.placement_context_manager.reader.allow_async
 def _get_trees_with_traits(ctx, rp_ids, required_traits, forbidden_traits):
     """Given a list of provider IDs, filter them to return a set of tuples of
     (provider ID, root provider ID) of providers which belong to a tree that
@@ -776,8 +1292,7 @@ def _get_trees_with_traits(ctx, rp_ids, required_traits, forbidden_traits):
     The returned tree still might not be a valid tree as this function
     returns a tree even if some providers need to be ignored due to forbidden
     traits. So if those RPs are needed from resource perspective then the tree
-    will be filtered out later by
-    objects.allocation_candidate._check_traits_for_alloc_request
+    will be filtered out later by _filter_candidates_by_traits
 
     :param ctx: Session context to use
     :param rp_ids: a set of resource provider IDs
@@ -876,7 +1391,7 @@ def _get_trees_with_traits(ctx, rp_ids, required_traits, forbidden_traits):
     return result
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_roots_with_traits(ctx, required_traits, forbidden_traits):
     """Return a set of IDs of root providers (NOT trees) that can satisfy trait
     requirements.
@@ -949,7 +1464,7 @@ def _get_roots_with_traits(ctx, required_traits, forbidden_traits):
     return set(row[0] for row in ctx.session.execute(sel).fetchall())
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def provider_ids_matching_aggregates(context, member_of, rp_ids=None):
     """Given a list of lists of aggregate UUIDs, return the internal IDs of all
     resource providers associated with the aggregates.
@@ -1034,7 +1549,7 @@ def provider_ids_matching_aggregates(context, member_of, rp_ids=None):
     return set(r[0] for r in context.session.execute(sel))
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def provider_ids_matching_required_traits(
     context, required_traits, rp_ids=None
 ):
@@ -1106,7 +1621,7 @@ def provider_ids_matching_required_traits(
     return set(r[0] for r in context.session.execute(sel))
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def get_provider_ids_having_any_trait(ctx, traits):
     """Returns a set of resource provider internal IDs that individually
     have ANY of the supplied traits.
@@ -1139,8 +1654,8 @@ def get_provider_ids_for_traits_and_aggs(rg_ctx):
     """
     filtered_rps = set()
     if rg_ctx.required_traits:
-        trait_rps = provider_ids_matching_required_traits(
-            rg_ctx.context, rg_ctx.required_traits)
+        trait_rps = rg_ctx.provider_ids_matching_required_traits(
+            rg_ctx.required_traits)
         filtered_rps = trait_rps
         LOG.debug("found %d providers after applying required traits filter "
                   "(%s)",
@@ -1154,7 +1669,8 @@ def get_provider_ids_for_traits_and_aggs(rg_ctx):
         if filtered_rps:
             filtered_rps &= rg_ctx.rps_in_aggs
         else:
-            filtered_rps = rg_ctx.rps_in_aggs
+            # Copy, as filtered_rps is modified below.
+            filtered_rps = set(rg_ctx.rps_in_aggs)
         LOG.debug("found %d providers after applying required aggregates "
                   "filter (%s)", len(filtered_rps), rg_ctx.member_of)
         if not filtered_rps:
@@ -1162,8 +1678,8 @@ def get_provider_ids_for_traits_and_aggs(rg_ctx):
 
     forbidden_rp_ids = set()
     if rg_ctx.forbidden_aggs:
-        rps_bad_aggs = provider_ids_matching_aggregates(
-            rg_ctx.context, [rg_ctx.forbidden_aggs])
+        rps_bad_aggs = rg_ctx.provider_ids_matching_aggregates(
+            [rg_ctx.forbidden_aggs])
         forbidden_rp_ids |= rps_bad_aggs
         if filtered_rps:
             filtered_rps -= rps_bad_aggs
@@ -1173,8 +1689,8 @@ def get_provider_ids_for_traits_and_aggs(rg_ctx):
                 return None, []
 
     if rg_ctx.forbidden_traits:
-        rps_bad_traits = get_provider_ids_having_any_trait(
-            rg_ctx.context, rg_ctx.forbidden_traits.values())
+        rps_bad_traits = rg_ctx.provider_ids_having_any_trait(
+            rg_ctx.forbidden_traits.values())
         forbidden_rp_ids |= rps_bad_traits
         if filtered_rps:
             filtered_rps -= rps_bad_traits
@@ -1187,7 +1703,7 @@ def get_provider_ids_for_traits_and_aggs(rg_ctx):
     return filtered_rps, forbidden_rp_ids
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def get_sharing_providers(ctx, rp_ids=None):
     """Returns a set of resource provider IDs (internal IDs, not UUIDs)
     that indicate that they share resource via an aggregate association.
@@ -1250,7 +1766,7 @@ def get_sharing_providers(ctx, rp_ids=None):
     return set(r[0] for r in ctx.session.execute(sel))
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def anchors_for_sharing_providers(context, rp_ids):
     """Given a list of internal IDs of sharing providers, returns a set of
     AnchorIds namedtuples, where each anchor is the unique root provider of a
@@ -1296,7 +1812,7 @@ def anchors_for_sharing_providers(context, rp_ids):
         AnchorIds(*res) for res in context.session.execute(sel).fetchall()])
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _has_provider_trees(ctx):
     """Simple method that returns whether provider trees (i.e. nested resource
     providers) are in use in the deployment at all. This information is used to
@@ -1305,6 +1821,7 @@ def _has_provider_trees(ctx):
     non-nested scenarios...
 
     NOTE(jaypipes): The result of this function can be cached extensively.
+    See has_provider_trees().
     """
     sel = sa.select(_RP_TBL.c.id)
     sel = sel.where(_RP_TBL.c.parent_provider_id.isnot(None))
@@ -1313,6 +1830,110 @@ def _has_provider_trees(ctx):
     return len(res) > 0
 
 
+class _ProviderShapeCache(object):
+    """A per-process cache of facts about the shape of the deployment that
+    rarely change but are needed by every allocation candidates request:
+    whether there are provider trees and which providers are sharing
+    providers.
+
+    The facts are kept for [placement]provider_shape_cache_ttl seconds, or
+    are not cached at all if that is 0. Like the usage snapshot, a cached
+    fact is only used while usage_snapshot.get_data_version() returns the
+    same DataVersion as when it was loaded, so changes made via any process
+    are taken into account. Any change of the facts made by this process
+    also drops them immediately, see invalidate_provider_shape().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Dict, keyed by the name of the fact, of (value, DataVersion, expiry)
+        # tuples.
+        self._facts = {}
+        # Incremented by every invalidation, so a value loaded concurrently
+        # with an invalidation is not kept.
+        self._generation = 0
+
+    def get(self, ctx, name, load):
+        ttl = ctx.config.placement.provider_shape_cache_ttl
+        if not ttl:
+            return load(ctx)
+
+        # NOTE: The version is probed before loading the value, so a change
+        # made in between is detected by the next probe.
+        version = usage_snapshot.get_data_version(ctx)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._facts.get(name)
+            generation = self._generation
+        if cached is not None and cached[1] == version and cached[2] > now:
+            return cached[0]
+
+        value = load(ctx)
+        with self._lock:
+            if generation == self._generation:
+                self._facts[name] = (value, version, now + ttl)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._facts.clear()
+            self._generation += 1
+
+
+_PROVIDER_SHAPE = _ProviderShapeCache()
+
+
+def has_provider_trees(ctx):
+    """Returns whether provider trees are in use in the deployment, using the
+    per-process cache if [placement]provider_shape_cache_ttl is set.
+    """
+    return _PROVIDER_SHAPE.get(ctx, 'has_trees', _has_provider_trees)
+
+
+def get_all_sharing_providers(ctx):
+    """Returns a frozenset of the internal IDs of every sharing provider,
+    using the per-process cache if [placement]provider_shape_cache_ttl is set.
+    """
+    return _PROVIDER_SHAPE.get(
+        ctx, 'sharing', lambda ctx: frozenset(get_sharing_providers(ctx)))
+
+
+def invalidate_provider_shape():
+    """Drops the cached facts about the shape of the deployment. Called
+    after creating, re-parenting or deleting a resource provider and after
+    changing the traits of a resource provider.
+    """
+    _PROVIDER_SHAPE.clear()
+
+
+@db_api.placement_context_manager.reader.allow_async
+def get_traits_by_provider_trees(ctx, root_ids):
+    """Returns a dict, keyed by root provider ID, of dicts, keyed by provider
+    ID, of the trait names of the providers in the trees of root_ids. Like
+    trait_obj.get_traits_by_provider_tree, but grouped by tree.
+    """
+    # SELECT rp.root_provider_id, rpt.resource_provider_id, rpt.trait_id
+    # FROM resource_providers AS rp
+    # INNER JOIN resource_provider_traits AS rpt
+    #   ON rp.id = rpt.resource_provider_id
+    # WHERE rp.root_provider_id IN ($root_ids)
+    rp_to_trait = sa.join(
+        _RP_TBL, _RP_TRAIT_TBL,
+        _RP_TBL.c.id == _RP_TRAIT_TBL.c.resource_provider_id)
+    sel = sa.select(
+        _RP_TBL.c.root_provider_id,
+        _RP_TRAIT_TBL.c.resource_provider_id,
+        _RP_TRAIT_TBL.c.trait_id,
+    ).select_from(rp_to_trait).where(
+        _RP_TBL.c.root_provider_id.in_(
+            sa.bindparam('root_ids', expanding=True)))
+    res = collections.defaultdict(lambda: collections.defaultdict(list))
+    for root_id, rp_id, trait_id in ctx.session.execute(
+            sel, {'root_ids': list(root_ids)}):
+        res[root_id][rp_id].append(ctx.trait_cache.string_from_id(trait_id))
+    return res
+
+
 def get_usages_by_provider_trees(ctx, root_ids):
     """Returns a row iterator of usage records grouped by provider ID
     for all resource providers in all trees indicated in the ``root_ids``.
@@ -260,13 +260,9 @@ def _set_inventory(context, rp, inv_list):
     return exceeded
 
 
-@db_api.placement_context_manager.reader
-def _get_provider_by_uuid(context, uuid):
-    """Given a UUID, return a dict of information about the resource provider
-    from the database.
-
-    :raises: NotFound if no such provider was found
-    :param uuid: The UUID to look up
+def _provider_select():
+    """Return a SELECT of the information about resource providers returned
+    by _get_provider_by_uuid and _get_providers_by_uuids.
     """
     rpt = sa.alias(_RP_TBL, name="rp")
     parent = sa.alias(_RP_TBL, name="parent")
@@ -275,7 +271,7 @@ def _get_provider_by_uuid(context, uuid):
     rp_to_parent = sa.outerjoin(
         rp_to_root, parent,
         rpt.c.parent_provider_id == parent.c.id)
-    sel = sa.select(
+    return sa.select(
         rpt.c.id,
         rpt.c.uuid,
         rpt.c.name,
@@ -284,7 +280,19 @@ def _get_provider_by_uuid(context, uuid):
         parent.c.uuid.label("parent_provider_uuid"),
         rpt.c.updated_at,
         rpt.c.created_at,
-    ).select_from(rp_to_parent).where(rpt.c.uuid == uuid)
+    ).select_from(rp_to_parent)
+
+
+@db_api.placement_context_manager.reader.allow_async
+def _get_provider_by_uuid(context, uuid):
+    """Given a UUID, return a dict of information about the resource provider
+    from the database.
+
+    :raises: NotFound if no such provider was found
+    :param uuid: The UUID to look up
+    """
+    sel = _provider_select()
+    sel = sel.where(sel.selected_columns.uuid == uuid)
     res = context.session.execute(sel).fetchone()
     if not res:
         raise exception.NotFound(
@@ -292,7 +300,20 @@ def _get_provider_by_uuid(context, uuid):
     return dict(res._mapping)
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
+def _get_providers_by_uuids(context, uuids):
+    """Given an iterable of UUIDs, return a list of dicts of information about
+    the resource providers found in the database. UUIDs not matching any
+    resource provider are ignored.
+
+    :param uuids: The UUIDs to look up
+    """
+    sel = _provider_select()
+    sel = sel.where(sel.selected_columns.uuid.in_(set(uuids)))
+    return [dict(res._mapping) for res in context.session.execute(sel)]
+
+
+@db_api.placement_context_manager.reader.allow_async
 def _get_aggregates_by_provider_id(context, rp_id):
     """Returns a dict, keyed by internal aggregate ID, of aggregate UUIDs
     associated with the supplied internal resource provider ID.
@@ -407,6 +428,23 @@ def _set_aggregates(context, resource_provider, provided_aggregates,
 
     if increment_generation:
         resource_provider.increment_generation()
+    elif aggs_to_associate or aggs_to_disassociate:
+        # NOTE: Count the update anyway, so the per-process caches validated
+        # by usage_snapshot.get_data_version() see the change.
+        _increment_update_count(context, rp_id)
+        db_api.record_writes(
+            context, provider_uuids=(resource_provider.uuid,
+                                     resource_provider.root_provider_uuid))
+
+
+def _increment_update_count(ctx, rp_id):
+    """Increments the update_count of the provider with the supplied ID, for
+    the updates that change what the allocation candidates search sees of
+    the provider without incrementing its generation.
+    """
+    upd_stmt = _RP_TBL.update().where(_RP_TBL.c.id == rp_id).values(
+        update_count=_RP_TBL.c.update_count + 1)
+    ctx.session.execute(upd_stmt)
 
 
 def _add_traits_to_provider(ctx, rp_id, to_add):
@@ -478,7 +516,7 @@ def _set_traits(context, rp, traits):
     rp.increment_generation()
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _has_child_providers(context, rp_id):
     """Returns True if the supplied resource provider has any child providers,
     False otherwise
@@ -579,9 +617,17 @@ class ResourceProvider(object):
             'parent_provider_uuid': self.parent_provider_uuid,
         }
         self._create_in_db(self._context, updates)
+        db_api.record_writes(
+            self._context,
+            provider_uuids=(self.uuid, self.root_provider_uuid))
+        res_ctx.invalidate_provider_shape()
 
     def destroy(self):
         self._delete(self._context, self.id)
+        db_api.record_writes(
+            self._context,
+            provider_uuids=(self.uuid, self.root_provider_uuid))
+        res_ctx.invalidate_provider_shape()
 
     def save(self, allow_reparenting=False):
         """Save the changes to the database
@@ -598,6 +644,10 @@ class ResourceProvider(object):
             'parent_provider_uuid': self.parent_provider_uuid,
         }
         self._update_in_db(self._context, self.id, updates, allow_reparenting)
+        db_api.record_writes(
+            self._context,
+            provider_uuids=(self.uuid, self.root_provider_uuid))
+        res_ctx.invalidate_provider_shape()
 
     @classmethod
     def get_by_uuid(cls, context, uuid):
@@ -665,6 +715,7 @@ class ResourceProvider(object):
                        associate with the provider.
         """
         _set_traits(self._context, self, traits)
+        res_ctx.invalidate_provider_shape()
 
     def increment_generation(self):
         """Increments this provider's generation value, supplying the
@@ -686,6 +737,9 @@ class ResourceProvider(object):
         if res.rowcount != 1:
             raise exception.ResourceProviderConcurrentUpdateDetected()
         self.generation = new_generation
+        db_api.record_writes(
+            self._context,
+            provider_uuids=(self.uuid, self.root_provider_uuid))
 
     @db_api.placement_context_manager.writer
     def _create_in_db(self, context, updates):
@@ -846,6 +900,11 @@ class ResourceProvider(object):
                     new_root_id = my_ids.id
                     new_root_uuid = my_ids.uuid
 
+        if 'parent_provider_id' in updates:
+            # The generation is not incremented by re-parenting, count the
+            # update so the per-process caches validated by
+            # usage_snapshot.get_data_version() see the change.
+            updates['update_count'] = models.ResourceProvider.update_count + 1
         db_rp = context.session.query(models.ResourceProvider).filter_by(
             id=id).first()
         db_rp.update(updates)
@@ -874,7 +933,7 @@ class ResourceProvider(object):
                 reason='parent provider UUID does not exist.')
 
     @staticmethod
-    @db_api.placement_context_manager.reader
+    @db_api.placement_context_manager.reader.allow_async
     def _from_db_object(context, resource_provider, db_resource_provider):
         for field in ['id', 'uuid', 'name', 'generation',
                       'root_provider_uuid', 'parent_provider_uuid',
@@ -908,7 +967,7 @@ class ResourceProvider(object):
         return subtree
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_all_by_filters_from_db(context, filters):
     # Eg. filters can be:
     #  filters = {
@@ -1024,6 +1083,27 @@ def _get_all_by_filters_from_db(context, filters):
     return context.session.execute(query).fetchall()
 
 
+def get_all_by_uuids(context, uuids):
+    """Returns a list of `ResourceProvider` objects having any of the supplied
+    UUIDs, read with a single query.
+
+    UUIDs not matching any resource provider are ignored, so the caller needs
+    to check the result if they must all exist.
+
+    :param context: `placement.context.RequestContext` that may be used to
+        grab a DB connection.
+    :param uuids: An iterable of resource provider UUIDs.
+    """
+    uuids = set(uuids)
+    if not uuids:
+        return []
+    return [
+        ResourceProvider._from_db_object(context, ResourceProvider(context),
+                                         rp_rec)
+        for rp_rec in _get_providers_by_uuids(context, uuids)
+    ]
+
+
 def get_all_by_filters(context, filters=None):
     """Returns a list of `ResourceProvider` objects that have sufficient
     resources in their inventories to satisfy the amounts specified in the
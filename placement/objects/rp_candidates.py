@@ -12,6 +12,7 @@
 """Utility methods for getting allocation candidates."""
 
 import collections
+import itertools
 
 
 RPCandidate = collections.namedtuple('RPCandidates', 'id root_id rc_id')
@@ -22,13 +23,51 @@ class RPCandidateList(object):
     RPCandidates, which consists of three-tuples with the first element being
     the resource provider ID, the second element being the root provider ID
     and the third being resource class ID.
+
+    The candidates are stored column-wise, in parallel lists of provider IDs,
+    root provider IDs and resource class IDs, so filtering them computes a
+    mask over the columns instead of building a tuple for every candidate.
     """
 
     def __init__(self, rp_candidates=None):
-        self.rp_candidates = rp_candidates or set()
+        self._ids = []
+        self._root_ids = []
+        self._rc_ids = []
+        self._reset_caches()
+        if rp_candidates:
+            self._extend(*zip(*rp_candidates))
+
+    def _reset_caches(self):
+        # The sets of provider IDs and root provider IDs of the candidates,
+        # computed on first use after any change.
+        self._rps = None
+        self._trees = None
+
+    def _extend(self, ids, root_ids, rc_ids):
+        """Adds the candidates given column-wise, skipping the ones already
+        in the list.
+        """
+        if self._ids and not set(self._rc_ids).isdisjoint(rc_ids):
+            existing = set(zip(self._ids, self._root_ids, self._rc_ids))
+            new = [c for c in set(zip(ids, root_ids, rc_ids))
+                   if c not in existing]
+            if not new:
+                return
+            ids, root_ids, rc_ids = zip(*new)
+        self._ids.extend(ids)
+        self._root_ids.extend(root_ids)
+        self._rc_ids.extend(rc_ids)
+        self._reset_caches()
+
+    def _compress(self, mask):
+        """Keeps the candidates whose item in mask is true."""
+        self._ids = list(itertools.compress(self._ids, mask))
+        self._root_ids = list(itertools.compress(self._root_ids, mask))
+        self._rc_ids = list(itertools.compress(self._rc_ids, mask))
+        self._reset_caches()
 
     def __len__(self):
-        return len(self.rp_candidates)
+        return len(self._ids)
 
     def __bool__(self):
         return bool(len(self))
@@ -43,12 +82,12 @@ class RPCandidateList(object):
         all requested resource.
         """
         if not self:
-            self.rp_candidates = other.rp_candidates
+            self._extend(other._ids, other._root_ids, other._rc_ids)
         elif not other:
             pass
         else:
             trees_in_both = self.trees & other.trees
-            self.rp_candidates |= other.rp_candidates
+            self._extend(other._ids, other._root_ids, other._rc_ids)
             self.filter_by_tree(trees_in_both)
 
     def add_rps(self, rps, rc_id):
@@ -58,45 +97,58 @@ class RPCandidateList(object):
         :param rc_id: ID of the class of resource provided by these resource
                       providers
         """
-        self.rp_candidates |= set(
-            RPCandidate(id=rp[0], root_id=rp[1], rc_id=rc_id) for rp in rps)
+        rps = set(rps)
+        if rps:
+            ids, root_ids = zip(*rps)
+            self._extend(ids, root_ids, [rc_id] * len(ids))
 
     def filter_by_tree(self, tree_root_ids):
         """Filter the candidates by given trees"""
-        self.rp_candidates = set(
-            p for p in self.rp_candidates if p.root_id in tree_root_ids)
+        if self.trees <= tree_root_ids:
+            return
+        self._compress([root_id in tree_root_ids
+                        for root_id in self._root_ids])
 
     def filter_by_rp(self, rptuples):
         """Filter the candidates by given resource provider"""
-        self.rp_candidates = set(
-            p for p in self.rp_candidates if (p.id, p.root_id) in rptuples)
+        self._compress([rp in rptuples
+                        for rp in zip(self._ids, self._root_ids)])
 
     def filter_by_rp_or_tree(self, rp_ids):
         """Filter the candidates out if neither itself nor its root is in
         given resource providers
         """
-        self.rp_candidates = set(
-            p for p in self.rp_candidates if set([p.id, p.root_id]) & rp_ids)
+        self._compress([rp_id in rp_ids or root_id in rp_ids
+                        for rp_id, root_id in zip(self._ids, self._root_ids)])
 
     def filter_by_rp_nor_tree(self, rp_ids):
         """Filter the candidates out if either itself or its root is in
         given resource providers
         """
-        self.rp_candidates = set(
-            p for p in self.rp_candidates if not (
-                set([p.id, p.root_id]) & rp_ids))
+        self._compress([not (rp_id in rp_ids or root_id in rp_ids)
+                        for rp_id, root_id in zip(self._ids, self._root_ids)])
+
+    def exclude_rps(self, rp_ids):
+        """Filter the candidates out if itself is in given resource
+        providers
+        """
+        self._compress([rp_id not in rp_ids for rp_id in self._ids])
 
     @property
     def rps(self):
         """Returns a set of IDs of nominated resource providers"""
-        return set(p.id for p in self.rp_candidates)
+        if self._rps is None:
+            self._rps = frozenset(self._ids)
+        return self._rps
 
     @property
     def trees(self):
         """Returns a set of nominated trees each of which are expressed by
         the root provider ID
         """
-        return set(p.root_id for p in self.rp_candidates)
+        if self._trees is None:
+            self._trees = frozenset(self._root_ids)
+        return self._trees
 
     @property
     def all_rps(self):
@@ -105,4 +157,6 @@ class RPCandidateList(object):
 
     @property
     def rps_info(self):
-        return self.rp_candidates
+        """Returns a set of RPCandidates"""
+        return set(map(
+            RPCandidate, self._ids, self._root_ids, self._rc_ids))
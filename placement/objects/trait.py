@@ -168,7 +168,7 @@ def get_all_by_resource_provider(context, rp):
     return [Trait(context, **data._mapping) for data in db_traits]
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def get_traits_by_provider_id(context, rp_id):
     rp_traits_id = _RP_TRAIT_TBL.c.resource_provider_id
     trait_id = _RP_TRAIT_TBL.c.trait_id
@@ -180,7 +180,7 @@ def get_traits_by_provider_id(context, rp_id):
         for r in context.session.execute(sel).fetchall()]
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def get_traits_by_provider_tree(ctx, root_ids):
     """Returns a dict, keyed by provider IDs for all resource providers
     in all trees indicated in the ``root_ids``, of string trait names
@@ -232,7 +232,7 @@ def _get_all_from_db(context, filters):
     return _get_all_filtered_from_db(context, filters)
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_all_filtered_from_db(context, filters):
 
     query = context.session.query(models.Trait)
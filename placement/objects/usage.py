@@ -52,7 +52,7 @@ def get_all_by_project_user(context, project_id, user_id=None):
     return [Usage(**db_item) for db_item in usage_list]
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_all_by_resource_provider_uuid(context, rp_uuid):
     query = (context.session.query(models.Inventory.resource_class_id,
              func.coalesce(func.sum(models.Allocation.used), 0))
@@ -72,7 +72,7 @@ def _get_all_by_resource_provider_uuid(context, rp_uuid):
     return result
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_all_by_project_user(context, project_id, user_id=None,
                              consumer_type=None):
     """Get usages by project, user, and consumer type.
@@ -144,7 +144,7 @@ def _get_all_by_project_user(context, project_id, user_id=None,
     return result
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_by_consumer_type(context, project_id, user_id=None,
                           consumer_type=None):
     if consumer_type in ('all', 'unknown'):
@@ -0,0 +1,401 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""A per-process snapshot of provider inventories and aggregated usage.
+
+When [placement]allocation_candidates_usage_snapshot is enabled, the
+allocation candidates search answers its "which providers have capacity" and
+"what is the usage of these trees" questions from this snapshot instead of
+aggregating the allocations table on every request.
+
+The snapshot is validated on every use by a cheap probe of the
+resource_providers and allocations tables. Providers whose generation changed
+since the snapshot was taken are refreshed individually; any change that
+cannot be attributed to specific providers (providers created or deleted,
+allocations removed without a generation bump) leads to a full reload.
+"""
+import collections
+import copy
+import threading
+
+from oslo_log import log as logging
+import sqlalchemy as sa
+from sqlalchemy import sql
+
+from placement.db.sqlalchemy import models
+from placement import db_api
+
+
+_ALLOC_TBL = models.Allocation.__table__
+_INV_TBL = models.Inventory.__table__
+_RP_TBL = models.ResourceProvider.__table__
+
+LOG = logging.getLogger(__name__)
+
+# The snapshot currently in use by this process, and a lock serializing the
+# (re)loading of it. Readers never need the lock: a snapshot is never mutated
+# once published, refreshing always builds and publishes a new one.
+_SNAPSHOT = None
+_SNAPSHOT_LOCK = threading.Lock()
+
+# The result of the staleness probe. Two snapshots taken with the same
+# version hold the same data.
+DataVersion = collections.namedtuple(
+    'DataVersion',
+    'rp_count rp_max_id rp_max_created_at rp_generations rp_update_counts '
+    'rp_max_updated_at alloc_count alloc_max_id')
+
+# Shaped like the rows returned by research_context.provider_ids_from_uuid()
+# and allocation_candidate._provider_ids_from_root_ids()
+ProviderIds = collections.namedtuple(
+    'ProviderIds', 'id uuid parent_id root_id generation')
+
+# An inventory record together with the usage against it and the number of
+# allocation records making up that usage.
+InventoryUsage = collections.namedtuple(
+    'InventoryUsage',
+    'total reserved min_unit max_unit step_size allocation_ratio used '
+    'allocation_count')
+
+# Shaped like the rows returned by
+# research_context.get_usages_by_provider_trees()
+UsageRow = collections.namedtuple(
+    'UsageRow',
+    'resource_provider_id resource_provider_uuid resource_class_id total '
+    'reserved allocation_ratio max_unit used')
+
+
+class UsageSnapshot(object):
+    """An immutable view of providers, their inventories and their usage."""
+
+    def __init__(self, version, providers, inventories):
+        """Create a UsageSnapshot.
+
+        :param version: The DataVersion the snapshot was loaded at.
+        :param providers: A dict, keyed by internal provider ID, of
+                ProviderIds for every provider.
+        :param inventories: A dict, keyed by internal provider ID, of dicts,
+                keyed by internal resource class ID, of InventoryUsage.
+        """
+        self.version = version
+        self.providers = providers
+        self.inventories = inventories
+        # A dict, keyed by internal resource class ID, of sets of internal IDs
+        # of providers having inventory of that resource class
+        self.rp_ids_by_rc = collections.defaultdict(set)
+        # A dict, keyed by internal root provider ID, of sets of internal IDs
+        # of providers in that tree
+        self.rp_ids_by_root = collections.defaultdict(set)
+        # The sum of the generations of all providers
+        self.generations = 0
+        # The number of allocation records against all inventories
+        self.allocation_count = 0
+        for rp_id, pids in providers.items():
+            self.rp_ids_by_root[pids.root_id].add(rp_id)
+            self.generations += pids.generation
+        for rp_id, invs in inventories.items():
+            for rc_id, inv in invs.items():
+                self.rp_ids_by_rc[rc_id].add(rp_id)
+                self.allocation_count += inv.allocation_count
+
+    def updated(self, version, providers, inventories):
+        """Returns a new UsageSnapshot with the records of some providers
+        replaced. This snapshot is left untouched.
+
+        :param version: The DataVersion of the new snapshot.
+        :param providers: A dict, keyed by internal provider ID, of the new
+                ProviderIds of the providers to replace.
+        :param inventories: A dict, keyed by internal provider ID, of dicts,
+                keyed by internal resource class ID, of the new InventoryUsage
+                of the providers to replace. Providers in ``providers`` but
+                not in ``inventories`` no longer have any inventory.
+        """
+        new = copy.copy(self)
+        new.version = version
+        new.providers = dict(self.providers)
+        new.inventories = dict(self.inventories)
+        new.rp_ids_by_rc = copy.copy(self.rp_ids_by_rc)
+        new.rp_ids_by_root = copy.copy(self.rp_ids_by_root)
+
+        # The sets in the indexes are shared with this snapshot, so they are
+        # copied before the first modification.
+        def _index(index, key, copied):
+            if key not in copied:
+                index[key] = set(index[key])
+                copied.add(key)
+            return index[key]
+
+        rcs_copied = set()
+        roots_copied = set()
+        for rp_id, pids in providers.items():
+            old_pids = new.providers[rp_id]
+            new.providers[rp_id] = pids
+            new.generations += pids.generation - old_pids.generation
+            if pids.root_id != old_pids.root_id:
+                _index(new.rp_ids_by_root, old_pids.root_id,
+                       roots_copied).discard(rp_id)
+                _index(new.rp_ids_by_root, pids.root_id,
+                       roots_copied).add(rp_id)
+
+            old_invs = new.inventories.pop(rp_id, {})
+            invs = inventories.get(rp_id, {})
+            if invs:
+                new.inventories[rp_id] = invs
+            for rc_id in set(old_invs) - set(invs):
+                _index(new.rp_ids_by_rc, rc_id, rcs_copied).discard(rp_id)
+            for rc_id in set(invs) - set(old_invs):
+                _index(new.rp_ids_by_rc, rc_id, rcs_copied).add(rp_id)
+            new.allocation_count += (
+                sum(inv.allocation_count for inv in invs.values()) -
+                sum(inv.allocation_count for inv in old_invs.values()))
+        return new
+
+    def providers_with_resource(self, rc_id, amount, tree_root_id=None):
+        """The in-memory equivalent of
+        research_context.get_providers_with_resource().
+
+        :returns: A set of tuples of (provider ID, root provider ID) of
+                providers that have capacity for amount of rc_id.
+        """
+        res = set()
+        for rp_id in self.rp_ids_by_rc.get(rc_id, ()):
+            root_id = self.providers[rp_id].root_id
+            if tree_root_id is not None and root_id != tree_root_id:
+                continue
+            inv = self.inventories[rp_id][rc_id]
+            if (inv.used + amount <=
+                    (inv.total - inv.reserved) * inv.allocation_ratio and
+                    inv.min_unit <= amount <= inv.max_unit and
+                    amount % inv.step_size == 0):
+                res.add((rp_id, root_id))
+        return res
+
+    def usages_by_provider_trees(self, root_ids):
+        """The in-memory equivalent of
+        research_context.get_usages_by_provider_trees().
+
+        :returns: A list of UsageRow, one for each inventory of each provider
+                in the given trees, and one with None inventory fields for
+                each provider in those trees not having any inventory.
+        """
+        rows = []
+        for root_id in root_ids:
+            for rp_id in self.rp_ids_by_root.get(root_id, ()):
+                rp_uuid = self.providers[rp_id].uuid
+                invs = self.inventories.get(rp_id)
+                if not invs:
+                    rows.append(UsageRow(
+                        rp_id, rp_uuid, None, None, None, None, None, None))
+                    continue
+                for rc_id, inv in invs.items():
+                    rows.append(UsageRow(
+                        rp_id, rp_uuid, rc_id, inv.total, inv.reserved,
+                        inv.allocation_ratio, inv.max_unit, inv.used))
+        return rows
+
+    def provider_ids_from_root_ids(self, root_ids):
+        """The in-memory equivalent of
+        allocation_candidate._provider_ids_from_root_ids().
+
+        :returns: A dict, keyed by internal provider ID, of ProviderIds for
+                every provider in the given trees.
+        """
+        return {
+            rp_id: self.providers[rp_id]
+            for root_id in root_ids
+            for rp_id in self.rp_ids_by_root.get(root_id, ())
+        }
+
+
+@db_api.placement_context_manager.reader.allow_async
+def get_data_version(ctx):
+    """Returns the current DataVersion of the provider and allocation data.
+
+    Every write path that changes inventory or adds allocations increments
+    the generation of the affected providers, re-parenting and changing
+    aggregates without incrementing the generation increment the
+    update_count of the provider instead, and creating or deleting providers
+    changes their count or their latest created_at. Removing allocations
+    does not necessarily increment any generation, so the number of
+    allocation records is probed as well. None of these depend on the clocks
+    of the API workers, updated_at is only used to find the providers to
+    reload incrementally.
+    """
+    # SELECT
+    #   (SELECT COUNT(id) FROM resource_providers),
+    #   (SELECT MAX(id) FROM resource_providers),
+    #   (SELECT MAX(created_at) FROM resource_providers),
+    #   (SELECT SUM(generation) FROM resource_providers),
+    #   (SELECT SUM(update_count) FROM resource_providers),
+    #   (SELECT MAX(updated_at) FROM resource_providers),
+    #   (SELECT COUNT(id) FROM allocations),
+    #   (SELECT MAX(id) FROM allocations)
+    sel = sa.select(
+        sa.select(sql.func.count(_RP_TBL.c.id)).scalar_subquery(),
+        sa.select(sql.func.max(_RP_TBL.c.id)).scalar_subquery(),
+        sa.select(sql.func.max(_RP_TBL.c.created_at)).scalar_subquery(),
+        sa.select(sql.func.sum(_RP_TBL.c.generation)).scalar_subquery(),
+        sa.select(sql.func.sum(_RP_TBL.c.update_count)).scalar_subquery(),
+        sa.select(sql.func.max(_RP_TBL.c.updated_at)).scalar_subquery(),
+        sa.select(sql.func.count(_ALLOC_TBL.c.id)).scalar_subquery(),
+        sa.select(sql.func.max(_ALLOC_TBL.c.id)).scalar_subquery(),
+    )
+    res = ctx.session.execute(sel).fetchone()
+    # NOTE: SUM() may come back as a Decimal on mysql
+    return DataVersion(
+        res[0], res[1], res[2], int(res[3] or 0), int(res[4] or 0), res[5],
+        res[6], res[7])
+
+
+def _get_providers(ctx, rp_ids=None):
+    sel = sa.select(
+        _RP_TBL.c.id,
+        _RP_TBL.c.uuid,
+        _RP_TBL.c.parent_provider_id,
+        _RP_TBL.c.root_provider_id,
+        _RP_TBL.c.generation,
+    )
+    if rp_ids is not None:
+        sel = sel.where(_RP_TBL.c.id.in_(rp_ids))
+    return {r[0]: ProviderIds(*r) for r in ctx.session.execute(sel)}
+
+
+def _get_inventories(ctx, rp_ids=None):
+    # SELECT
+    #   inv.resource_provider_id, inv.resource_class_id, inv.total,
+    #   inv.reserved, inv.min_unit, inv.max_unit, inv.step_size,
+    #   inv.allocation_ratio, usage.used, usage.allocation_count
+    # FROM inventories AS inv
+    # LEFT JOIN (
+    #   SELECT resource_provider_id, resource_class_id, SUM(used) AS used,
+    #     COUNT(id) AS allocation_count
+    #   FROM allocations
+    #   # If rp_ids specified:
+    #   WHERE resource_provider_id IN ($RP_IDS)
+    #   GROUP BY resource_provider_id, resource_class_id
+    # ) AS usage
+    #   ON inv.resource_provider_id = usage.resource_provider_id
+    #   AND inv.resource_class_id = usage.resource_class_id
+    # # If rp_ids specified:
+    # WHERE inv.resource_provider_id IN ($RP_IDS)
+    usage = sa.select(
+        _ALLOC_TBL.c.resource_provider_id,
+        _ALLOC_TBL.c.resource_class_id,
+        sql.func.sum(_ALLOC_TBL.c.used).label('used'),
+        sql.func.count(_ALLOC_TBL.c.id).label('allocation_count'),
+    )
+    if rp_ids is not None:
+        usage = usage.where(_ALLOC_TBL.c.resource_provider_id.in_(rp_ids))
+    usage = usage.group_by(
+        _ALLOC_TBL.c.resource_provider_id,
+        _ALLOC_TBL.c.resource_class_id,
+    ).subquery(name='usage')
+    inv = sa.alias(_INV_TBL, name='inv')
+    inv_to_usage = sa.outerjoin(
+        inv, usage,
+        sa.and_(
+            inv.c.resource_provider_id == usage.c.resource_provider_id,
+            inv.c.resource_class_id == usage.c.resource_class_id))
+    sel = sa.select(
+        inv.c.resource_provider_id,
+        inv.c.resource_class_id,
+        inv.c.total,
+        inv.c.reserved,
+        inv.c.min_unit,
+        inv.c.max_unit,
+        inv.c.step_size,
+        inv.c.allocation_ratio,
+        usage.c.used,
+        usage.c.allocation_count,
+    ).select_from(inv_to_usage)
+    if rp_ids is not None:
+        sel = sel.where(inv.c.resource_provider_id.in_(rp_ids))
+
+    inventories = collections.defaultdict(dict)
+    for r in ctx.session.execute(sel):
+        # NOTE(jaypipes): usage.used may be None due to the LEFT JOIN of the
+        # usages subquery, or a Decimal on mysql. Either way we want an int.
+        inventories[r[0]][r[1]] = InventoryUsage(
+            r.total, r.reserved, r.min_unit, r.max_unit, r.step_size,
+            r.allocation_ratio, int(r.used or 0),
+            int(r.allocation_count or 0))
+    return inventories
+
+
+@db_api.placement_context_manager.reader.allow_async
+def _load(ctx, version):
+    """Loads a complete UsageSnapshot."""
+    return UsageSnapshot(version, _get_providers(ctx), _get_inventories(ctx))
+
+
+@db_api.placement_context_manager.reader.allow_async
+def _refresh(ctx, snapshot, version):
+    """Returns a new UsageSnapshot built from snapshot by reloading only the
+    providers updated since snapshot was taken, or None if the changes
+    between the two versions cannot be attributed to those providers.
+    """
+    old = snapshot.version
+    if (version.rp_count != old.rp_count or
+            version.rp_max_id != old.rp_max_id or
+            version.rp_max_created_at != old.rp_max_created_at or
+            version.rp_update_counts != old.rp_update_counts or
+            old.rp_max_updated_at is None):
+        return None
+
+    # Any provider whose generation was incremented since the snapshot was
+    # taken has an updated_at of at least the last value we have seen.
+    # Re-parenting is rare, so it is left to a full reload above.
+    sel = sa.select(_RP_TBL.c.id).where(
+        _RP_TBL.c.updated_at >= old.rp_max_updated_at)
+    changed = set(r[0] for r in ctx.session.execute(sel))
+    if not changed:
+        return None
+    new = snapshot.updated(
+        version, _get_providers(ctx, changed), _get_inventories(ctx, changed))
+
+    # A write that committed after another one having a later updated_at, or
+    # allocations removed from a provider without incrementing its
+    # generation, are not covered by the above. The totals tell.
+    if (new.generations - snapshot.generations !=
+            version.rp_generations - old.rp_generations or
+            new.allocation_count - snapshot.allocation_count !=
+            version.alloc_count - old.alloc_count):
+        return None
+    return new
+
+
+def get_snapshot(ctx):
+    """Returns an up to date UsageSnapshot, or None if the snapshot is
+    disabled by [placement]allocation_candidates_usage_snapshot.
+    """
+    global _SNAPSHOT
+
+    if not ctx.config.placement.allocation_candidates_usage_snapshot:
+        return None
+
+    version = get_data_version(ctx)
+    snapshot = _SNAPSHOT
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+
+    with _SNAPSHOT_LOCK:
+        snapshot = _SNAPSHOT
+        if snapshot is not None:
+            if snapshot.version == version:
+                return snapshot
+            new = _refresh(ctx, snapshot, version)
+            if new is not None:
+                LOG.debug('Refreshed usage snapshot incrementally')
+                _SNAPSHOT = new
+                return new
+        LOG.debug('Loading usage snapshot')
+        _SNAPSHOT = _load(ctx, version)
+        return _SNAPSHOT
@@ -0,0 +1,602 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""In-process benchmarks of the placement API hot paths.
+
+The placement service is run in-process via PlacementDirect against an
+in-memory SQLite database set up the same way as in the functional tests.
+For each topology of resource providers the benchmark measures the latency,
+the number of database queries and the peak Python memory allocation of
+
+* GET /allocation_candidates
+* PUT /allocations/{consumer_uuid}
+* POST /allocations, moving the allocations to a migration consumer
+* DELETE /allocations/{consumer_uuid}
+* POST /reshaper
+
+Run the benchmarks and save the results::
+
+    python -m placement.tests.benchmark run --output before.json
+
+Compare the results of two runs, flagging the regressions::
+
+    python -m placement.tests.benchmark compare before.json after.json
+
+SQLite has very different performance characteristics than the databases
+used in production, so the results are only useful for comparing two runs
+on the same machine, not as absolute numbers.
+"""
+
+import argparse
+import collections
+import contextlib
+import json
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+
+import fixtures
+from oslo_config import cfg
+from oslo_config import fixture as config_fixture
+from oslo_utils import uuidutils
+import sqlalchemy as sa
+
+from placement import conf
+from placement import direct
+from placement.tests import fixtures as placement_fixtures
+from placement.tests.unit import policy_fixture
+
+
+PROJECT_ID = uuidutils.generate_uuid()
+USER_ID = uuidutils.generate_uuid()
+CONSUMER_TYPE = 'INSTANCE'
+# POST /reshaper is only allowed for the service role.
+SERVICE_HEADERS = {'X-Roles': 'admin,service'}
+
+# The operations of a single iteration are first run this many times without
+# recording, to warm up the caches.
+DEFAULT_WARMUP = 2
+DEFAULT_ITERATIONS = 20
+# The relative growth of a latency or memory metric that is reported as a
+# regression by compare.
+DEFAULT_THRESHOLD = 0.2
+
+# The metrics compared between two runs. The query counts are compared
+# without a threshold, any increase is a regression.
+_TIMING_METRICS = ('p50', 'p90')
+_MEMORY_METRICS = ('peak_memory_kib',)
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def _check(resp, expected=(200, 201, 204)):
+    if resp.status_code not in expected:
+        raise BenchmarkError(
+            '%s %s failed with %d: %s' % (
+                resp.request.method, resp.request.path_url,
+                resp.status_code, resp.text))
+    return resp
+
+
+class _Providers(object):
+    """Creates resource providers via the API, keeping track of their
+    generations.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.generations = {}
+
+    def create(self, name, parent=None, inventories=None, traits=None,
+               aggregates=None):
+        rp_uuid = uuidutils.generate_uuid()
+        body = {'name': name, 'uuid': rp_uuid}
+        if parent:
+            body['parent_provider_uuid'] = parent
+        resp = _check(self.client.post('/resource_providers', json=body))
+        self.generations[rp_uuid] = resp.json()['generation']
+        if inventories:
+            self.set_inventories(rp_uuid, inventories)
+        if traits:
+            for trait in traits:
+                if trait.startswith('CUSTOM_'):
+                    _check(self.client.put('/traits/%s' % trait))
+            self._put(rp_uuid, 'traits', {'traits': traits})
+        if aggregates:
+            self._put(rp_uuid, 'aggregates', {'aggregates': aggregates})
+        return rp_uuid
+
+    def set_inventories(self, rp_uuid, inventories):
+        self._put(rp_uuid, 'inventories', {
+            'inventories': {
+                rc: inv if isinstance(inv, dict) else {'total': inv}
+                for rc, inv in inventories.items()}})
+
+    def refresh(self, rp_uuid):
+        resp = _check(self.client.get('/resource_providers/%s' % rp_uuid))
+        self.generations[rp_uuid] = resp.json()['generation']
+        return self.generations[rp_uuid]
+
+    def _put(self, rp_uuid, what, body):
+        body['resource_provider_generation'] = self.generations[rp_uuid]
+        resp = _check(self.client.put(
+            '/resource_providers/%s/%s' % (rp_uuid, what), json=body))
+        self.generations[rp_uuid] = resp.json()[
+            'resource_provider_generation']
+
+
+def _flat(providers, scale):
+    """Compute nodes without nested or sharing providers."""
+    for i in range(_scaled(200, scale)):
+        providers.create(
+            'cn%d' % i,
+            inventories={
+                'VCPU': {'total': 32, 'allocation_ratio': 4.0},
+                'MEMORY_MB': 131072,
+                'DISK_GB': 2048},
+            traits=['HW_CPU_X86_AVX2'] if i % 2 else None)
+    return ('resources=VCPU:2,MEMORY_MB:2048,DISK_GB:20'
+            '&required=HW_CPU_X86_AVX2&limit=1000')
+
+
+def _nested(providers, scale):
+    """Compute nodes with NUMA nodes, each having an SR-IOV capable NIC and
+    a physical GPU.
+    """
+    for i in range(_scaled(50, scale)):
+        cn = providers.create('cn%d' % i, inventories={'DISK_GB': 2048})
+        for n in range(2):
+            numa = providers.create(
+                'cn%d_numa%d' % (i, n), parent=cn,
+                inventories={'VCPU': 16, 'MEMORY_MB': 65536})
+            providers.create(
+                'cn%d_numa%d_pf' % (i, n), parent=numa,
+                inventories={'SRIOV_NET_VF': 8},
+                traits=['CUSTOM_PHYSNET_NET1'])
+            providers.create(
+                'cn%d_numa%d_pgpu' % (i, n), parent=numa,
+                inventories={'VGPU': 4})
+    return ('resources=DISK_GB:20'
+            '&resources_NUMA=VCPU:2,MEMORY_MB:2048'
+            '&resources_NIC=SRIOV_NET_VF:1&required_NIC=CUSTOM_PHYSNET_NET1'
+            '&resources_GPU=VGPU:1'
+            '&same_subtree=_NUMA,_NIC&group_policy=none&limit=1000')
+
+
+def _sharing(providers, scale):
+    """Compute nodes getting their disk from shared storage providers."""
+    aggregates = [uuidutils.generate_uuid()
+                  for i in range(_scaled(4, scale))]
+    for i, agg in enumerate(aggregates):
+        providers.create(
+            'ss%d' % i, inventories={'DISK_GB': 100000},
+            traits=['MISC_SHARES_VIA_AGGREGATE'], aggregates=[agg])
+    for i in range(_scaled(100, scale)):
+        providers.create(
+            'cn%d' % i, inventories={'VCPU': 32, 'MEMORY_MB': 131072},
+            aggregates=[aggregates[i % len(aggregates)]])
+    return 'resources=VCPU:2,MEMORY_MB:2048,DISK_GB:20&limit=1000'
+
+
+def _wide(providers, scale):
+    """Compute nodes with many symmetric children, like the mdev GPUs in nova,
+    and a request for multiple devices in separate groups.
+    """
+    for i in range(_scaled(10, scale)):
+        cn = providers.create(
+            'cn%d' % i, inventories={'VCPU': 32, 'MEMORY_MB': 131072})
+        for d in range(6):
+            providers.create(
+                'cn%d_mdev%d' % (i, d), parent=cn,
+                inventories={'VGPU': 1})
+    return ('resources=VCPU:2,MEMORY_MB:2048'
+            '&resources1=VGPU:1&resources2=VGPU:1&resources3=VGPU:1'
+            '&resources4=VGPU:1&group_policy=none&limit=1000')
+
+
+TOPOLOGIES = collections.OrderedDict([
+    ('flat', _flat),
+    ('nested', _nested),
+    ('sharing', _sharing),
+    ('wide', _wide),
+])
+
+
+def _scaled(count, scale):
+    return max(1, int(count * scale))
+
+
+class _Environment(fixtures.Fixture):
+    """An in-memory placement database and a PlacementDirect client using
+    it, counting the database queries.
+    """
+
+    def __init__(self, config_overrides):
+        super(_Environment, self).__init__()
+        self.config_overrides = config_overrides
+        self.queries = 0
+
+    def _setUp(self):
+        self.conf_fixture = self.useFixture(
+            config_fixture.Config(cfg.ConfigOpts()))
+        conf.register_opts(self.conf_fixture.conf)
+        self.useFixture(placement_fixtures.Database(
+            self.conf_fixture, set_config=True))
+        self.conf_fixture.conf([], default_config_files=[])
+        self.useFixture(policy_fixture.PolicyFixture(self.conf_fixture))
+        for (group, name), value in self.config_overrides.items():
+            self.conf_fixture.config(**{name: value, 'group': group})
+
+        sa.event.listen(
+            sa.engine.Engine, 'before_cursor_execute', self._count_query)
+        self.addCleanup(
+            sa.event.remove, sa.engine.Engine, 'before_cursor_execute',
+            self._count_query)
+
+        placement = direct.PlacementDirect(
+            self.conf_fixture.conf, latest_microversion=True)
+        self.client = placement.__enter__()
+        self.addCleanup(placement.__exit__, None, None, None)
+
+    def _count_query(self, *args, **kwargs):
+        self.queries += 1
+
+
+class _Recorder(object):
+    """Collects the latency, query count and peak memory of the measured
+    operations.
+
+    Every scenario runs warmup + iterations + 1 rounds of its operations.
+    The warmup rounds are not recorded, the last round is run with
+    tracemalloc enabled to record the peak memory of each operation but its
+    latency is not recorded as tracing slows down the code considerably.
+    """
+
+    def __init__(self, env, iterations, warmup):
+        self.env = env
+        self.iterations = iterations
+        self.warmup = warmup
+        self.latencies = collections.defaultdict(list)
+        self.queries = collections.defaultdict(list)
+        self.peak_memory = {}
+
+    def rounds(self):
+        for i in range(self.warmup):
+            yield 'warmup'
+        for i in range(self.iterations):
+            yield 'timed'
+        yield 'memory'
+
+    @contextlib.contextmanager
+    def measure(self, name, phase):
+        if phase == 'warmup':
+            yield
+            return
+        if phase == 'memory':
+            tracemalloc.start()
+            try:
+                yield
+                self.peak_memory[name] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            return
+        queries = self.env.queries
+        start = time.perf_counter()
+        yield
+        self.latencies[name].append(time.perf_counter() - start)
+        self.queries[name].append(self.env.queries - queries)
+
+    def results(self, prefix):
+        results = {}
+        for name, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            results['%s %s' % (prefix, name)] = {
+                'count': len(latencies),
+                'mean': _ms(sum(latencies) / len(latencies)),
+                'p50': _ms(_percentile(latencies, 50)),
+                'p90': _ms(_percentile(latencies, 90)),
+                'p99': _ms(_percentile(latencies, 99)),
+                'max': _ms(latencies[-1]),
+                'queries': (
+                    sum(self.queries[name]) / len(self.queries[name])),
+                'peak_memory_kib': self.peak_memory.get(name, 0) // 1024,
+            }
+        return results
+
+
+def _percentile(sorted_values, percent):
+    """Returns the nearest-rank percentile of a sorted list of values."""
+    rank = -(-len(sorted_values) * percent // 100)
+    return sorted_values[max(rank, 1) - 1]
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def _allocation_candidates(client, recorder, query):
+    for phase in recorder.rounds():
+        with recorder.measure('GET /allocation_candidates', phase):
+            resp = _check(client.get('/allocation_candidates?' + query))
+    return resp.json()['allocation_requests']
+
+
+def _write_allocations(client, recorder, allocation_requests):
+    """PUT allocations of the first allocation candidate for a new consumer,
+    move them to another consumer with POST, like a migration does, then
+    DELETE them so the capacity is not exhausted by the rounds.
+    """
+    allocations = allocation_requests[0]['allocations']
+    for phase in recorder.rounds():
+        consumer = uuidutils.generate_uuid()
+        migration = uuidutils.generate_uuid()
+        body = {
+            'allocations': allocations,
+            'project_id': PROJECT_ID,
+            'user_id': USER_ID,
+            'consumer_generation': None,
+            'consumer_type': CONSUMER_TYPE,
+        }
+        with recorder.measure('PUT /allocations', phase):
+            _check(client.put('/allocations/%s' % consumer, json=body))
+
+        allocs = _check(client.get('/allocations/%s' % consumer)).json()
+        body = {
+            consumer: {
+                'allocations': {},
+                'project_id': PROJECT_ID,
+                'user_id': USER_ID,
+                'consumer_generation': allocs['consumer_generation'],
+                'consumer_type': CONSUMER_TYPE,
+            },
+            migration: {
+                'allocations': allocations,
+                'project_id': PROJECT_ID,
+                'user_id': USER_ID,
+                'consumer_generation': None,
+                'consumer_type': 'MIGRATION',
+            },
+        }
+        with recorder.measure('POST /allocations', phase):
+            _check(client.post('/allocations', json=body))
+
+        with recorder.measure('DELETE /allocations', phase):
+            _check(client.delete('/allocations/%s' % migration))
+
+
+def _reshape(client, providers, recorder):
+    """Moves an inventory and the allocation consuming it back and forth
+    between a root provider and its child.
+    """
+    rc = 'CUSTOM_BENCHMARK_RESHAPE'
+    _check(client.put('/resource_classes/%s' % rc))
+    root = providers.create('reshape_root', inventories={rc: 10})
+    child = providers.create('reshape_child', parent=root)
+    consumer = uuidutils.generate_uuid()
+    _check(client.put('/allocations/%s' % consumer, json={
+        'allocations': {root: {'resources': {rc: 1}}},
+        'project_id': PROJECT_ID,
+        'user_id': USER_ID,
+        'consumer_generation': None,
+        'consumer_type': CONSUMER_TYPE,
+    }))
+
+    source, target = root, child
+    for phase in recorder.rounds():
+        allocs = _check(client.get('/allocations/%s' % consumer)).json()
+        body = {
+            'inventories': {
+                source: {
+                    'resource_provider_generation': providers.refresh(source),
+                    'inventories': {},
+                },
+                target: {
+                    'resource_provider_generation': providers.refresh(target),
+                    'inventories': {rc: {'total': 10}},
+                },
+            },
+            'allocations': {
+                consumer: {
+                    'allocations': {target: {'resources': {rc: 1}}},
+                    'project_id': PROJECT_ID,
+                    'user_id': USER_ID,
+                    'consumer_generation': allocs['consumer_generation'],
+                    'consumer_type': CONSUMER_TYPE,
+                },
+            },
+        }
+        with recorder.measure('POST /reshaper', phase):
+            _check(client.post(
+                '/reshaper', json=body, headers=SERVICE_HEADERS))
+        source, target = target, source
+
+
+def run_topology(topology, scale=1.0, iterations=DEFAULT_ITERATIONS,
+                 warmup=DEFAULT_WARMUP, config_overrides=None):
+    """Runs the benchmarks on a fresh database populated with a topology.
+
+    :param topology: The name of the topology, one of TOPOLOGIES.
+    :param scale: Multiplier of the number of providers in the topology.
+    :param iterations: The number of recorded rounds of each operation.
+    :param warmup: The number of rounds of each operation run before the
+                   recorded ones.
+    :param config_overrides: A dict, keyed by (group, name) tuples, of config
+                             option values to use.
+    :return: A dict, keyed by "<topology> <operation>", of dicts of metrics.
+    """
+    with _Environment(config_overrides or {}) as env:
+        providers = _Providers(env.client)
+        query = TOPOLOGIES[topology](providers, scale)
+        recorder = _Recorder(env, iterations, warmup)
+        allocation_requests = _allocation_candidates(
+            env.client, recorder, query)
+        if not allocation_requests:
+            raise BenchmarkError(
+                'No allocation candidates for %s topology' % topology)
+        _write_allocations(env.client, recorder, allocation_requests)
+        _reshape(env.client, providers, recorder)
+        return recorder.results(topology)
+
+
+def run(topologies=None, scale=1.0, iterations=DEFAULT_ITERATIONS,
+        warmup=DEFAULT_WARMUP, config_overrides=None):
+    """Runs the benchmarks for each topology.
+
+    :return: A dict with the metadata of the run and the results keyed by
+             "<topology> <operation>".
+    """
+    config_overrides = config_overrides or {}
+    results = {}
+    for topology in topologies or TOPOLOGIES:
+        results.update(run_topology(
+            topology, scale=scale, iterations=iterations, warmup=warmup,
+            config_overrides=config_overrides))
+    return {
+        'metadata': {
+            'python': platform.python_version(),
+            'scale': scale,
+            'iterations': iterations,
+            'config': {
+                '%s.%s' % key: value
+                for key, value in config_overrides.items()},
+        },
+        'results': results,
+    }
+
+
+def compare(old, new, threshold=DEFAULT_THRESHOLD):
+    """Compares the results of two runs.
+
+    :param old: The result of the baseline run.
+    :param new: The result of the run to be checked for regressions.
+    :param threshold: The relative growth of the latency and memory metrics
+                      that is considered a regression.
+    :return: A list of (name, metric, old value, new value, regressed)
+             tuples for every metric present in both runs.
+    """
+    comparison = []
+    old_results = old['results']
+    for name, new_metrics in sorted(new['results'].items()):
+        old_metrics = old_results.get(name)
+        if old_metrics is None:
+            continue
+        for metric in _TIMING_METRICS + _MEMORY_METRICS + ('queries',):
+            old_value = old_metrics[metric]
+            new_value = new_metrics[metric]
+            if metric == 'queries':
+                regressed = new_value > old_value
+            else:
+                regressed = new_value > old_value * (1 + threshold)
+            comparison.append(
+                (name, metric, old_value, new_value, regressed))
+    return comparison
+
+
+def _parse_config_override(value):
+    try:
+        option, value = value.split('=', 1)
+        group, name = option.split('.', 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Expected GROUP.OPTION=VALUE, got %s' % value)
+    return (group, name), value
+
+
+def _print_results(results):
+    print('%-45s %8s %10s %10s %10s %9s %11s' % (
+        'benchmark', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'queries',
+        'memory KiB'))
+    for name, metrics in sorted(results['results'].items()):
+        print('%-45s %8d %10.3f %10.3f %10.3f %9.1f %11d' % (
+            name, metrics['count'], metrics['p50'], metrics['p90'],
+            metrics['p99'], metrics['queries'], metrics['peak_memory_kib']))
+
+
+def _print_comparison(comparison):
+    print('%-45s %16s %12s %12s %8s' % (
+        'benchmark', 'metric', 'old', 'new', 'change'))
+    for name, metric, old_value, new_value, regressed in comparison:
+        change = ((new_value - old_value) / old_value * 100
+                  if old_value else 0.0)
+        print('%-45s %16s %12.3f %12.3f %+7.1f%%%s' % (
+            name, metric, old_value, new_value, change,
+            ' REGRESSION' if regressed else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m placement.tests.benchmark',
+        description='Benchmark the placement API in-process.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser(
+        'run', help='Run the benchmarks.')
+    run_parser.add_argument(
+        '--topology', action='append', choices=list(TOPOLOGIES),
+        help='The topology to benchmark. Can be repeated. All topologies '
+             'are benchmarked by default.')
+    run_parser.add_argument(
+        '--scale', type=float, default=1.0,
+        help='Multiplier of the number of resource providers created.')
+    run_parser.add_argument(
+        '--iterations', type=int, default=DEFAULT_ITERATIONS,
+        help='The number of measured rounds of each operation.')
+    run_parser.add_argument(
+        '--warmup', type=int, default=DEFAULT_WARMUP,
+        help='The number of rounds of each operation run before the '
+             'measured ones.')
+    run_parser.add_argument(
+        '--config', action='append', type=_parse_config_override,
+        default=[], metavar='GROUP.OPTION=VALUE',
+        help='Override a configuration option. Can be repeated.')
+    run_parser.add_argument(
+        '--output', help='Write the results to this file as JSON.')
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare the results of two runs.')
+    compare_parser.add_argument('old', help='The baseline results.')
+    compare_parser.add_argument('new', help='The results to check.')
+    compare_parser.add_argument(
+        '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='The relative growth of the latency and memory metrics '
+             'reported as a regression. Any growth of the number of queries '
+             'is reported as a regression.')
+
+    args = parser.parse_args(argv)
+    # Conflicts and other expected failures are logged as warnings by the
+    # placement service, that is just noise here.
+    logging.basicConfig(level=logging.ERROR)
+    if args.command == 'run':
+        results = run(
+            topologies=args.topology, scale=args.scale,
+            iterations=args.iterations, warmup=args.warmup,
+            config_overrides=dict(args.config))
+        _print_results(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    comparison = compare(old, new, threshold=args.threshold)
+    _print_comparison(comparison)
+    return 1 if any(c[-1] for c in comparison) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,11 +20,16 @@
 from oslo_config import cfg
 from oslo_db.sqlalchemy import test_fixtures
 
+from placement import attribute_cache
 from placement.db.sqlalchemy import migration
 from placement import db_api as placement_db
 from placement import deploy
+from placement.objects import allocation_candidate
+from placement.objects import provider_index
+from placement.objects import research_context
 from placement.objects import resource_class
 from placement.objects import trait
+from placement.objects import usage_snapshot
 
 
 class Database(test_fixtures.GeneratesSchema, test_fixtures.AdHocDbFixture):
@@ -74,4 +79,10 @@ class Database(test_fixtures.GeneratesSchema, test_fixtures.AdHocDbFixture):
 
     def cleanup(self):
         trait._TRAITS_SYNCED = False
+        placement_db._RECENT_WRITES.clear()
         resource_class._RESOURCE_CLASSES_SYNCED = False
+        usage_snapshot._SNAPSHOT = None
+        provider_index._INDEX = None
+        attribute_cache._SHARED.clear()
+        research_context.invalidate_provider_shape()
+        allocation_candidate.clear_cached_results()
@@ -72,6 +72,41 @@ class TestAllocation(tb.PlacementDbBaseTestCase):
         allocs = alloc_obj.get_all_by_resource_provider(self.ctx, cn1)
         self.assertEqual(0, len(allocs))
 
+    def test_replace_all_multiple_consumers_sets_ids(self):
+        cn1 = self._create_provider('cn1')
+        tb.add_inventory(cn1, orc.VCPU, 8)
+        tb.add_inventory(cn1, orc.MEMORY_MB, 1024)
+        cn2 = self._create_provider('cn2')
+        tb.add_inventory(cn2, orc.VCPU, 8)
+
+        # The first consumer already has an allocation which gets replaced.
+        self.allocate_from_provider(
+            cn2, orc.VCPU, 2, consumer_id=uuidsentinel.consumer1)
+        consumers = [
+            tb.ensure_consumer(
+                self.ctx, self.user_obj, self.project_obj, c_uuid)
+            for c_uuid in (uuidsentinel.consumer1, uuidsentinel.consumer2)]
+        alloc_list = [
+            alloc_obj.Allocation(
+                resource_provider=rp, consumer=consumer,
+                resource_class=rc, used=1)
+            for consumer in consumers
+            for rp, rc in ((cn1, orc.VCPU), (cn1, orc.MEMORY_MB),
+                           (cn2, orc.VCPU))]
+        alloc_obj.replace_all(self.ctx, alloc_list)
+
+        for consumer in consumers:
+            db_allocs = alloc_obj.get_all_by_consumer_id(
+                self.ctx, consumer.uuid)
+            expected = {
+                (a.resource_provider.id, a.resource_class): a.id
+                for a in db_allocs}
+            actual = {
+                (a.resource_provider.id, a.resource_class): a.id
+                for a in alloc_list if a.consumer is consumer}
+            self.assertEqual(3, len(actual))
+            self.assertEqual(expected, actual)
+
     def test_multi_provider_allocation(self):
         """Tests that an allocation that includes more than one resource
         provider can be created, listed and deleted properly.
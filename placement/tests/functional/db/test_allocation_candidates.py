@@ -11,9 +11,12 @@
 #    under the License.
 
 import collections
+import threading
+from unittest import mock
 
 import os_resource_classes as orc
 import os_traits
+from oslo_utils import fixture as utils_fixture
 from oslo_utils.fixture import uuidsentinel as uuids
 import sqlalchemy as sa
 
@@ -450,6 +453,55 @@ class ProviderDBHelperTestCase(tb.PlacementDbBaseTestCase):
         run([{'HW_CPU_X86_TBM'}, {'HW_CPU_X86_TSX', 'CUSTOM_FOO'}], [cn3.id])
 
 
+class ProviderDBHelperSingleQueryTestCase(ProviderDBHelperTestCase):
+    """Runs the ProviderDBHelperTestCase tests with the providers having all
+    the requested resources looked up in a single query.
+    """
+
+    def setUp(self):
+        super(ProviderDBHelperSingleQueryTestCase, self).setUp()
+        self.conf_fixture.config(
+            allocation_candidates_matching_strategy='single-query',
+            group='placement')
+        # The per resource class lookup is not used at all
+        patcher = mock.patch.object(
+            res_ctx, 'get_providers_with_resource',
+            new=mock.NonCallableMock())
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def test_get_providers_with_all_resources(self):
+        cn1 = self._create_provider('cn1')
+        tb.add_inventory(cn1, orc.VCPU, 8)
+        tb.add_inventory(cn1, orc.MEMORY_MB, 4096, step_size=256)
+        cn2 = self._create_provider('cn2')
+        tb.add_inventory(cn2, orc.VCPU, 8)
+        tb.add_inventory(cn2, orc.MEMORY_MB, 4096, max_unit=1024)
+        self.allocate_from_provider(cn2, orc.VCPU, 6)
+        # No memory at all
+        cn3 = self._create_provider('cn3')
+        tb.add_inventory(cn3, orc.VCPU, 8)
+
+        vcpu = self.ctx.rc_cache.id_from_string(orc.VCPU)
+        mem = self.ctx.rc_cache.id_from_string(orc.MEMORY_MB)
+
+        def run(resources, expected, tree_root_id=None):
+            self.assertEqual(
+                {(cn.id, cn.id) for cn in expected},
+                res_ctx.get_providers_with_all_resources(
+                    self.ctx, resources, tree_root_id=tree_root_id))
+
+        run({vcpu: 2}, [cn1, cn2, cn3])
+        run({vcpu: 2, mem: 1024}, [cn1, cn2])
+        # Exceeds the capacity left on cn2
+        run({vcpu: 3, mem: 1024}, [cn1])
+        # Exceeds the max_unit of cn2
+        run({vcpu: 2, mem: 2048}, [cn1])
+        # Not a multiple of the step_size of cn1
+        run({vcpu: 2, mem: 1000}, [cn2])
+        run({vcpu: 2, mem: 1024}, [cn2], tree_root_id=cn2.id)
+
+
 class ProviderTreeDBHelperTestCase(tb.PlacementDbBaseTestCase):
 
     def _get_rp_ids_matching_names(self, names):
@@ -791,6 +843,56 @@ class ProviderTreeDBHelperTestCase(tb.PlacementDbBaseTestCase):
 
         return rp_ids, avx2_t, ssd_t, geneve_t, ssl_t
 
+    def test_get_trees_matching_all_traits_with_sharing(self):
+        """Checks that with sharing providers in play the providers having
+        forbidden traits and the trees that cannot satisfy the required
+        traits are dropped by get_trees_matching_all().
+        """
+        cn1, cn2 = (self._create_provider(name, uuids.agg1)
+                    for name in ('cn1', 'cn2'))
+        for cn in (cn1, cn2):
+            tb.add_inventory(cn, orc.VCPU, 8)
+        tb.set_traits(cn1, os_traits.HW_CPU_X86_AVX2)
+        ss1 = self._create_provider('ss1', uuids.agg1)
+        ss2 = self._create_provider('ss2', uuids.agg1)
+        for ss, trait in ((ss1, os_traits.STORAGE_DISK_HDD),
+                          (ss2, os_traits.STORAGE_DISK_SSD)):
+            tb.add_inventory(ss, orc.DISK_GB, 100)
+            tb.set_traits(ss, os_traits.MISC_SHARES_VIA_AGGREGATE, trait)
+
+        def _run_test(expected_trees, expected_rps, **kwargs):
+            rg_ctx = _req_group_search_context(
+                self.ctx, resources={orc.VCPU: 1, orc.DISK_GB: 10}, **kwargs)
+            rw_ctx = res_ctx.RequestWideSearchContext(
+                self.ctx, placement_lib.RequestWideParams(), True)
+            results = res_ctx.get_trees_matching_all(rg_ctx, rw_ctx)
+
+            self.assertEqual(
+                self._get_rp_ids_matching_names(expected_trees),
+                results.trees)
+            self.assertEqual(
+                self._get_rp_ids_matching_names(expected_rps), results.rps)
+
+        _run_test(['cn1', 'cn2'], ['cn1', 'cn2', 'ss1', 'ss2'])
+        # The sharing provider having the forbidden trait is dropped
+        _run_test(['cn1', 'cn2'], ['cn1', 'cn2', 'ss2'],
+                  forbidden_traits={os_traits.STORAGE_DISK_HDD})
+        # The tree lacking the required trait is dropped
+        _run_test(['cn1'], ['cn1', 'ss1', 'ss2'],
+                  required_traits=[{os_traits.HW_CPU_X86_AVX2}])
+        _run_test(['cn1'], ['cn1', 'ss1'],
+                  required_traits=[{os_traits.HW_CPU_X86_AVX2}],
+                  forbidden_traits={os_traits.STORAGE_DISK_SSD})
+        # Any of the providers of the tree can have the required trait
+        _run_test(['cn1', 'cn2'], ['cn1', 'cn2', 'ss2'],
+                  required_traits=[{os_traits.HW_CPU_X86_AVX2,
+                                    os_traits.STORAGE_DISK_SSD}],
+                  forbidden_traits={os_traits.STORAGE_DISK_HDD})
+        # No tree is left with a provider of DISK_GB
+        _run_test([], [],
+                  forbidden_traits={os_traits.STORAGE_DISK_HDD,
+                                    os_traits.STORAGE_DISK_SSD})
+
     def test_get_trees_with_traits(self):
         """Creates a few provider trees having different traits and tests the
         _get_trees_with_traits() utility function to ensure that only the
@@ -1211,16 +1313,11 @@ class ProviderTreeDBHelperTestCase(tb.PlacementDbBaseTestCase):
         do_test(required=[avx2_t, ssd_t], forbidden=[ssd_t, geneve_t])
 
 
-class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
-    """Tests a variety of scenarios with both shared and non-shared resource
-    providers that the AllocationCandidates.get_by_requests() method returns a
-    set of alternative allocation requests and provider summaries that may be
-    used by the scheduler to sort/weigh the options it has for claiming
-    resources against providers.
-    """
+class AllocationCandidatesBaseTestCase(tb.PlacementDbBaseTestCase):
+    """Helpers for requesting allocation candidates and validating them."""
 
     def setUp(self):
-        super(AllocationCandidatesTestCase, self).setUp()
+        super(AllocationCandidatesBaseTestCase, self).setUp()
         self.requested_resources = {
             orc.VCPU: 1,
             orc.MEMORY_MB: 64,
@@ -1357,6 +1454,172 @@ class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
 
         self.assertEqual(expected, observed)
 
+    def _normalize_candidates(self, candidates):
+        """Returns the allocation requests and provider summaries of
+        allocation candidates in a form that compares equal regardless of
+        their order.
+        """
+        alloc_reqs = sorted(
+            (sorted((self.rp_uuid_to_name[rr.resource_provider.uuid],
+                     rr.resource_class, rr.amount)
+                    for rr in ar.resource_requests),
+             sorted((suffix, sorted(self.rp_uuid_to_name[rp_uuid]
+                                    for rp_uuid in rp_uuids))
+                    for suffix, rp_uuids in ar.mappings.items()))
+            for ar in candidates.allocation_requests)
+        summaries = sorted(
+            (self.rp_uuid_to_name[psum.resource_provider.uuid],
+             sorted((res.resource_class, res.capacity, res.used)
+                    for res in psum.resources),
+             sorted(psum.traits))
+            for psum in candidates.provider_summaries)
+        return alloc_reqs, summaries
+
+    def _create_option_trees(self):
+        """Creates the providers the option scenarios are run against."""
+        # Two compute trees with a PF per NUMA node, some of them used,
+        # having traits and being members of aggregates, and a sharing
+        # provider of disk:
+        #
+        #           cn1 (agg1)                      cn2 (agg2)
+        #          /          \                    /          \
+        #     cn1_numa0    cn1_numa1          cn2_numa0    cn2_numa1
+        #         |            |                  |            |
+        #  cn1_numa0_pf0  cn1_numa1_pf1    cn2_numa0_pf0  cn2_numa1_pf1
+        #                                                    (agg3)
+        #
+        #                         ss (agg1, agg2)
+        #
+        self.option_rps = {}
+        for cn_name, agg in (('cn1', uuids.agg1), ('cn2', uuids.agg2)):
+            cn = self._create_provider(cn_name, agg)
+            tb.add_inventory(cn, orc.VCPU, 16)
+            tb.add_inventory(cn, orc.MEMORY_MB, 2048)
+            self.option_rps[cn_name] = cn
+            for i in (0, 1):
+                numa = self._create_provider(
+                    '%s_numa%d' % (cn_name, i), parent=cn.uuid)
+                pf_name = '%s_numa%d_pf%d' % (cn_name, i, i)
+                pf_aggs = (uuids.agg3,) if pf_name == 'cn2_numa1_pf1' else ()
+                pf = self._create_provider(
+                    pf_name, *pf_aggs, parent=numa.uuid)
+                tb.add_inventory(pf, orc.SRIOV_NET_VF, 8)
+                self.option_rps[pf_name] = pf
+        tb.set_traits(self.option_rps['cn1'], os_traits.HW_CPU_X86_AVX2)
+        tb.add_inventory(self.option_rps['cn2'], orc.DISK_GB, 500)
+        for pf_name in ('cn1_numa0_pf0', 'cn2_numa0_pf0'):
+            tb.set_traits(
+                self.option_rps[pf_name], os_traits.HW_NIC_OFFLOAD_GENEVE)
+        ss = self._create_provider('ss', uuids.agg1, uuids.agg2)
+        tb.add_inventory(ss, orc.DISK_GB, 2000)
+        tb.set_traits(ss, os_traits.MISC_SHARES_VIA_AGGREGATE,
+                      os_traits.STORAGE_DISK_SSD)
+        self.option_rps['ss'] = ss
+
+        self.allocate_from_provider(self.option_rps['cn1'], orc.VCPU, 14)
+        self.allocate_from_provider(
+            self.option_rps['cn1_numa1_pf1'], orc.SRIOV_NET_VF, 7)
+
+    def _option_scenarios(self):
+        """Returns a dict, keyed by name, of (groups, rqparams) tuples of the
+        requests run against the providers of _create_option_trees().
+        """
+        def _group(use_same_provider=True, **kwargs):
+            return placement_lib.RequestGroup(
+                use_same_provider=use_same_provider, **kwargs)
+
+        def _vf_groups(**kwargs):
+            return {
+                '': _group(False, resources={orc.VCPU: 1}),
+                '_NET1': _group(resources={orc.SRIOV_NET_VF: 1}, **kwargs),
+                '_NET2': _group(resources={orc.SRIOV_NET_VF: 1}, **kwargs),
+            }
+
+        return {
+            'resources': (
+                {'': _group(False, resources={
+                    orc.VCPU: 2, orc.MEMORY_MB: 512, orc.DISK_GB: 100})},
+                placement_lib.RequestWideParams()),
+            'used_resources': (
+                {'': _group(False, resources={
+                    orc.VCPU: 3, orc.SRIOV_NET_VF: 2})},
+                placement_lib.RequestWideParams()),
+            'isolated_groups': (
+                _vf_groups(),
+                placement_lib.RequestWideParams(group_policy='isolate')),
+            'overlapping_groups': (
+                _vf_groups(),
+                placement_lib.RequestWideParams(group_policy='none')),
+            'sharing_groups': (
+                {'': _group(False, resources={orc.VCPU: 1}),
+                 '1': _group(resources={orc.DISK_GB: 100}),
+                 '2': _group(resources={orc.DISK_GB: 100})},
+                placement_lib.RequestWideParams(group_policy='none')),
+            'traits': (
+                {'': _group(False, resources={orc.VCPU: 1},
+                            required_traits=[{os_traits.HW_CPU_X86_AVX2,
+                                              os_traits.HW_CPU_X86_SSE}]),
+                 '1': _group(resources={orc.SRIOV_NET_VF: 1},
+                             required_traits=[
+                                 {os_traits.HW_NIC_OFFLOAD_GENEVE}]),
+                 '2': _group(resources={orc.SRIOV_NET_VF: 1},
+                             forbidden_traits={
+                                 os_traits.HW_NIC_OFFLOAD_GENEVE})},
+                placement_lib.RequestWideParams(group_policy='none')),
+            'anchor_traits': (
+                _vf_groups(),
+                placement_lib.RequestWideParams(
+                    group_policy='isolate',
+                    anchor_forbidden_traits={os_traits.HW_CPU_X86_AVX2})),
+            'aggregates': (
+                {'': _group(False, resources={orc.VCPU: 1, orc.DISK_GB: 100},
+                            member_of=[[uuids.agg1, uuids.agg2]]),
+                 '1': _group(resources={orc.SRIOV_NET_VF: 1},
+                             forbidden_aggs=[uuids.agg3])},
+                placement_lib.RequestWideParams(group_policy='none')),
+            'in_tree': (
+                _vf_groups(in_tree=self.option_rps['cn2'].uuid),
+                placement_lib.RequestWideParams(group_policy='none')),
+            'same_subtree': (
+                _vf_groups(),
+                placement_lib.RequestWideParams(
+                    group_policy='none', same_subtrees=[{'_NET1', '_NET2'}])),
+        }
+
+    def _assert_same_candidates(self, scenarios, group='placement',
+                                **options):
+        """Asserts that overriding some options does not change the
+        allocation candidates of the named scenarios of _option_scenarios().
+        Without options, asserts that requesting them again does not change
+        them.
+        """
+        self._create_option_trees()
+        requests = self._option_scenarios()
+        expected = {
+            name: self._normalize_candidates(
+                self._get_allocation_candidates(*requests[name]))
+            for name in scenarios}
+        for name, candidates in expected.items():
+            self.assertNotEqual(
+                ([], []), candidates, 'Scenario %s has no candidates' % name)
+
+        self.conf_fixture.config(group=group, **options)
+        for name in scenarios:
+            self.assertEqual(
+                expected[name],
+                self._normalize_candidates(
+                    self._get_allocation_candidates(*requests[name])),
+                'Scenario %s' % name)
+
+
+class AllocationCandidatesTestCase(AllocationCandidatesBaseTestCase):
+    """Tests a variety of scenarios with both shared and non-shared resource
+    providers that the AllocationCandidates.get_by_requests() method returns a
+    set of alternative allocation requests and provider summaries that may be
+    used by the scheduler to sort/weigh the options it has for claiming
+    resources against providers.
+    """
+
     def test_unknown_traits(self):
         missing = [{'UNKNOWN_TRAIT'}]
         requests = {'': placement_lib.RequestGroup(
@@ -1676,6 +1939,102 @@ class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
         # provider summaries should have two rps
         self.assertEqual(expected_length, len(alloc_cands.provider_summaries))
 
+    def test_limit_summaries_of_result_trees_only(self):
+        for name in ('cn1', 'cn2', 'cn3'):
+            cn = self._create_provider(name)
+            tb.add_inventory(cn, orc.VCPU, 8)
+            pf = self._create_provider(name + '_pf', parent=cn.uuid)
+            tb.add_inventory(pf, orc.SRIOV_NET_VF, 8)
+        groups = {
+            '': placement_lib.RequestGroup(
+                use_same_provider=False,
+                resources={orc.VCPU: 1, orc.SRIOV_NET_VF: 1}),
+        }
+
+        with mock.patch.object(
+                ac_obj, 'ProviderSummaryResource',
+                wraps=ac_obj.ProviderSummaryResource) as mock_psr:
+            alloc_cands = self._get_allocation_candidates(
+                groups, rqparams=placement_lib.RequestWideParams(limit=1))
+
+        # The provider summaries are only created for the tree of the
+        # returned allocation request although all trees were candidates.
+        self.assertEqual(1, len(alloc_cands.allocation_requests))
+        self.assertEqual(2, len(alloc_cands.provider_summaries))
+        self.assertEqual(2, mock_psr.call_count)
+        root_name = self.rp_uuid_to_name[
+            alloc_cands.allocation_requests[0].anchor_root_provider_uuid]
+        self._validate_provider_summary_resources({
+            root_name: set([(orc.VCPU, 8, 0)]),
+            root_name + '_pf': set([(orc.SRIOV_NET_VF, 8, 0)]),
+        }, alloc_cands)
+
+    def _create_wide_tree(self):
+        cn = self._create_provider('cn')
+        tb.add_inventory(cn, orc.VCPU, 8)
+        for i in range(4):
+            pf = self._create_provider('pf%d' % i, parent=cn.uuid)
+            tb.add_inventory(pf, orc.SRIOV_NET_VF, 2)
+        # Each of the two groups can be satisfied by any of the four PFs so
+        # there are 16 candidates.
+        return {
+            '': placement_lib.RequestGroup(
+                use_same_provider=False, resources={orc.VCPU: 1}),
+            '1': placement_lib.RequestGroup(
+                use_same_provider=True, resources={orc.SRIOV_NET_VF: 1}),
+            '2': placement_lib.RequestGroup(
+                use_same_provider=True, resources={orc.SRIOV_NET_VF: 1}),
+        }
+
+    def test_limit_stops_candidate_generation(self):
+        groups = self._create_wide_tree()
+        rqparams = placement_lib.RequestWideParams(
+            limit=3, group_policy='none')
+
+        with mock.patch.object(
+                ac_obj, '_consolidate_allocation_requests',
+                wraps=ac_obj._consolidate_allocation_requests) as mock_cons:
+            alloc_cands = ac_obj.AllocationCandidates.get_by_requests(
+                self.ctx, groups, rqparams)
+        self.assertEqual(3, len(alloc_cands.allocation_requests))
+        self.assertEqual(3, mock_cons.call_count)
+        self.assertEqual(5, len(alloc_cands.provider_summaries))
+
+        # Without nested awareness candidates involving more than one
+        # provider of the same tree are filtered out after merging, so
+        # generation cannot stop early.
+        with mock.patch.object(
+                ac_obj, '_consolidate_allocation_requests',
+                wraps=ac_obj._consolidate_allocation_requests) as mock_cons:
+            alloc_cands = ac_obj.AllocationCandidates.get_by_requests(
+                self.ctx, groups, rqparams, nested_aware=False)
+        self.assertEqual([], alloc_cands.allocation_requests)
+        self.assertEqual(16, mock_cons.call_count)
+
+    def test_limit_randomized_sample(self):
+        groups = self._create_wide_tree()
+        all_areqs = ac_obj.AllocationCandidates.get_by_requests(
+            self.ctx, groups,
+            placement_lib.RequestWideParams(group_policy='none'),
+        ).allocation_requests
+        self.assertEqual(16, len(all_areqs))
+
+        self.conf_fixture.config(randomize_allocation_candidates=True,
+                                 group='placement')
+        rqparams = placement_lib.RequestWideParams(
+            limit=5, group_policy='none')
+        with mock.patch.object(
+                ac_obj, '_consolidate_allocation_requests',
+                wraps=ac_obj._consolidate_allocation_requests) as mock_cons:
+            alloc_cands = ac_obj.AllocationCandidates.get_by_requests(
+                self.ctx, groups, rqparams)
+        # All the candidates are generated to sample from them.
+        self.assertEqual(16, mock_cons.call_count)
+        areqs = alloc_cands.allocation_requests
+        self.assertEqual(5, len(areqs))
+        self.assertEqual(5, len(set(areqs)))
+        self.assertTrue(set(areqs) <= set(all_areqs))
+
     def test_local_with_shared_disk(self):
         """Create some resource providers that can satisfy the request for
         resources with local VCPU and MEMORY_MB but rely on a shared storage
@@ -2056,6 +2415,186 @@ class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
         }
         self._validate_provider_summary_resources(expected, alloc_cands)
 
+    def test_anchors_of_sharing_providers_looked_up_once(self):
+        cn1, cn2 = (self._create_provider(name, uuids.agg1, uuids.agg2)
+                    for name in ('cn1', 'cn2'))
+        for cn in (cn1, cn2):
+            tb.add_inventory(cn, orc.VCPU, 24)
+        ss1 = self._create_provider('ss1', uuids.agg1)
+        ss2 = self._create_provider('ss2', uuids.agg2)
+        for ss in (ss1, ss2):
+            tb.add_inventory(ss, orc.DISK_GB, 2000)
+            tb.set_traits(ss, "MISC_SHARES_VIA_AGGREGATE")
+
+        groups = {
+            '': placement_lib.RequestGroup(
+                use_same_provider=False,
+                resources={orc.VCPU: 1}),
+            '1': placement_lib.RequestGroup(
+                use_same_provider=True,
+                resources={orc.DISK_GB: 100}),
+            '2': placement_lib.RequestGroup(
+                use_same_provider=True,
+                resources={orc.DISK_GB: 100}),
+        }
+        with mock.patch.object(
+                res_ctx, 'anchors_for_sharing_providers',
+                wraps=res_ctx.anchors_for_sharing_providers) as mock_anchors:
+            alloc_cands = self._get_allocation_candidates(groups)
+
+        # Every sharing provider's anchors are looked up with a single query
+        # and reused by the other request groups.
+        mock_anchors.assert_called_once_with(mock.ANY, {ss1.id, ss2.id})
+        # The candidates splitting the disk between the sharing providers
+        # are listed twice, as either request group can use either of them.
+        expected = []
+        for cn in ('cn1', 'cn2'):
+            expected += [
+                [(cn, orc.VCPU, 1), ('ss1', orc.DISK_GB, 100),
+                 ('ss2', orc.DISK_GB, 100)],
+                [(cn, orc.VCPU, 1), ('ss1', orc.DISK_GB, 100),
+                 ('ss2', orc.DISK_GB, 100)],
+                [(cn, orc.VCPU, 1), ('ss1', orc.DISK_GB, 200)],
+                [(cn, orc.VCPU, 1), ('ss2', orc.DISK_GB, 200)],
+            ]
+        self._validate_allocation_requests(expected, alloc_cands)
+
+    def test_anchors_not_looked_up_holding_lock(self):
+        cn = self._create_provider('cn', uuids.agg1)
+        tb.add_inventory(cn, orc.VCPU, 8)
+        ss = self._create_provider('ss', uuids.agg1)
+        tb.add_inventory(ss, orc.DISK_GB, 2000)
+        tb.set_traits(ss, "MISC_SHARES_VIA_AGGREGATE")
+        rw_ctxs = []
+        lock_held = []
+        lookup = res_ctx.RequestWideSearchContext.anchors_for_sharing_providers
+        query = res_ctx.anchors_for_sharing_providers
+
+        def _lookup(rw_ctx, rp_ids):
+            rw_ctxs.append(rw_ctx)
+            return lookup(rw_ctx, rp_ids)
+
+        def _query(context, rp_ids):
+            lock_held.append(rw_ctxs[-1].lock.locked())
+            return query(context, rp_ids)
+
+        with mock.patch.object(
+                res_ctx.RequestWideSearchContext,
+                'anchors_for_sharing_providers', autospec=True,
+                side_effect=_lookup), \
+            mock.patch.object(
+                res_ctx, 'anchors_for_sharing_providers',
+                side_effect=_query):
+            alloc_cands = self._get_allocation_candidates({
+                '': placement_lib.RequestGroup(
+                    use_same_provider=False, resources={orc.DISK_GB: 100}),
+            })
+
+        # Request groups searched concurrently are not serialized by the
+        # query
+        self.assertEqual([False], lock_held)
+        self._validate_allocation_requests(
+            [[('ss', orc.DISK_GB, 100)]], alloc_cands)
+
+    def test_repeated_lookups_looked_up_once(self):
+        cn = self._create_provider('cn', uuids.agg1)
+        for name in ('pf1', 'pf2'):
+            pf = self._create_provider(name, uuids.agg1, parent=cn.uuid)
+            tb.add_inventory(pf, orc.SRIOV_NET_VF, 8)
+            tb.set_traits(pf, 'HW_NIC_OFFLOAD_GENEVE')
+
+        groups = {
+            suffix: placement_lib.RequestGroup(
+                use_same_provider=True,
+                resources={orc.SRIOV_NET_VF: 1},
+                member_of=[[uuids.agg1]],
+                forbidden_aggs=[uuids.agg2],
+                in_tree=cn.uuid)
+            for suffix in ('1', '2', '3')
+        }
+        with mock.patch.object(
+                res_ctx, 'provider_ids_from_uuid',
+                wraps=res_ctx.provider_ids_from_uuid) as mock_in_tree, \
+            mock.patch.object(
+                res_ctx, 'provider_ids_matching_aggregates',
+                wraps=res_ctx.provider_ids_matching_aggregates) as mock_aggs, \
+            mock.patch.object(
+                res_ctx, 'get_providers_with_resource',
+                wraps=res_ctx.get_providers_with_resource) as mock_rps, \
+            mock.patch.object(
+                res_ctx, 'get_traits_by_provider_trees',
+                wraps=res_ctx.get_traits_by_provider_trees) as mock_traits:
+            alloc_cands = self._get_allocation_candidates(groups)
+
+        # The lookups repeated by every request group are served by the
+        # memos of the request after the first one.
+        mock_in_tree.assert_called_once_with(mock.ANY, cn.uuid)
+        self.assertEqual(2, mock_aggs.call_count)
+        mock_rps.assert_called_once()
+        mock_traits.assert_called_once()
+        # Each request group can use either PF.
+        self.assertEqual(8, len(alloc_cands.allocation_requests))
+        for summary in alloc_cands.provider_summaries:
+            if summary.resource_provider.uuid != cn.uuid:
+                self.assertEqual(
+                    ['HW_NIC_OFFLOAD_GENEVE'], summary.traits)
+
+    def test_traits_of_requested_trees_only(self):
+        cn1 = self._create_provider('cn1')
+        pf1 = self._create_provider('pf1', parent=cn1.uuid)
+        cn2 = self._create_provider('cn2')
+        tb.set_traits(cn1, 'HW_CPU_X86_AVX2')
+        tb.set_traits(pf1, 'HW_NIC_OFFLOAD_GENEVE')
+        tb.set_traits(cn2, 'HW_CPU_X86_AVX2')
+        rw_ctx = res_ctx.RequestWideSearchContext(
+            self.ctx, placement_lib.RequestWideParams(), True)
+
+        with mock.patch.object(
+                res_ctx, 'get_traits_by_provider_trees',
+                wraps=res_ctx.get_traits_by_provider_trees) as mock_traits:
+            traits1 = rw_ctx.traits_by_provider_tree([cn1.id])
+            traits12 = rw_ctx.traits_by_provider_tree([cn1.id, cn2.id])
+            traits2 = rw_ctx.traits_by_provider_tree([cn2.id])
+
+        # Only the trees not seen before are looked up, but every call gets
+        # its own dict of the trees it asked for.
+        self.assertEqual(2, mock_traits.call_count)
+        self.assertEqual(
+            {cn1.id: ['HW_CPU_X86_AVX2'], pf1.id: ['HW_NIC_OFFLOAD_GENEVE']},
+            traits1)
+        self.assertEqual(
+            {cn1.id: ['HW_CPU_X86_AVX2'], pf1.id: ['HW_NIC_OFFLOAD_GENEVE'],
+             cn2.id: ['HW_CPU_X86_AVX2']},
+            traits12)
+        self.assertEqual({cn2.id: ['HW_CPU_X86_AVX2']}, traits2)
+
+    def test_traits_of_candidate_trees_looked_up_once(self):
+        cn1, cn2 = (self._create_provider(name, uuids.agg)
+                    for name in ('cn1', 'cn2'))
+        for cn in (cn1, cn2):
+            tb.add_inventory(cn, orc.VCPU, 24)
+        ss = self._create_provider('ss', uuids.agg)
+        tb.add_inventory(ss, orc.DISK_GB, 2000)
+        tb.set_traits(ss, 'MISC_SHARES_VIA_AGGREGATE', 'STORAGE_DISK_SSD')
+        tb.set_traits(cn2, 'HW_CPU_X86_AVX2')
+
+        with mock.patch.object(
+                res_ctx, 'get_traits_by_provider_trees',
+                wraps=res_ctx.get_traits_by_provider_trees) as mock_traits:
+            alloc_cands = self._get_allocation_candidates({
+                '': placement_lib.RequestGroup(
+                    use_same_provider=False,
+                    resources={orc.VCPU: 1, orc.DISK_GB: 100},
+                    required_traits=[{'STORAGE_DISK_SSD'}],
+                    forbidden_traits={'HW_CPU_X86_AVX2'}),
+            })
+
+        # The traits the candidate trees are filtered by, including those of
+        # the sharing provider, are those of the memo of the request.
+        mock_traits.assert_called_once()
+        self._validate_allocation_requests(
+            [[('cn1', orc.VCPU, 1), ('ss', orc.DISK_GB, 100)]], alloc_cands)
+
     def test_mix_local_and_shared(self):
         # Create three compute node providers with VCPU and RAM, but only
         # the third compute node has DISK. The first two computes will
@@ -3790,3 +4329,256 @@ class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
         self.assertEqual(8, len(alloc_cands.allocation_requests))
         self._validate_allocation_requests(
             expected, alloc_cands, expect_suffixes=True)
+
+
+class AllocationCandidatesUsageSnapshotTestCase(
+        AllocationCandidatesBaseTestCase):
+    """Tests that serving inventories and usages from the in-memory usage
+    snapshot does not change the allocation candidates.
+    """
+
+    def test_same_candidates(self):
+        self._assert_same_candidates(
+            ('resources', 'used_resources', 'isolated_groups',
+             'sharing_groups', 'in_tree', 'same_subtree'),
+            allocation_candidates_usage_snapshot=True)
+
+    def test_usages_not_queried(self):
+        self.conf_fixture.config(
+            allocation_candidates_usage_snapshot=True, group='placement')
+        self._create_option_trees()
+        groups, rqparams = self._option_scenarios()['used_resources']
+        with mock.patch.object(
+                res_ctx, 'get_providers_with_resource') as mock_rps, \
+            mock.patch.object(
+                res_ctx, 'get_usages_by_provider_trees') as mock_usages:
+            alloc_cands = self._get_allocation_candidates(groups, rqparams)
+
+        mock_rps.assert_not_called()
+        mock_usages.assert_not_called()
+        # cn1 and cn1_numa1_pf1 are used up
+        self._validate_allocation_requests([
+            [('cn2', orc.VCPU, 3), ('cn2_numa0_pf0', orc.SRIOV_NET_VF, 2)],
+            [('cn2', orc.VCPU, 3), ('cn2_numa1_pf1', orc.SRIOV_NET_VF, 2)],
+        ], alloc_cands)
+
+
+class AllocationCandidatesProviderIndexTestCase(
+        AllocationCandidatesBaseTestCase):
+    """Tests that serving the traits and aggregates of providers from the
+    in-memory provider index does not change the allocation candidates.
+    """
+
+    def test_same_candidates(self):
+        self._assert_same_candidates(
+            ('sharing_groups', 'traits', 'anchor_traits', 'aggregates',
+             'in_tree'),
+            allocation_candidates_provider_index=True)
+
+    def test_aggregates_not_queried(self):
+        self.conf_fixture.config(
+            allocation_candidates_provider_index=True, group='placement')
+        self._create_option_trees()
+        groups, rqparams = self._option_scenarios()['aggregates']
+        with mock.patch.object(
+                res_ctx, 'provider_ids_matching_aggregates') as mock_aggs:
+            alloc_cands = self._get_allocation_candidates(groups, rqparams)
+
+        mock_aggs.assert_not_called()
+        # cn2_numa1_pf1 is a member of the forbidden aggregate
+        self.assertEqual(
+            {'cn1_numa0_pf0', 'cn1_numa1_pf1', 'cn2_numa0_pf0'},
+            {self.rp_uuid_to_name[rp_uuid]
+             for ar in alloc_cands.allocation_requests
+             for rp_uuid in ar.mappings['1']})
+
+
+class AllocationCandidatesGroupWorkersTestCase(
+        AllocationCandidatesBaseTestCase):
+    """Tests that searching the request groups concurrently does not change
+    the allocation candidates.
+    """
+
+    def test_same_candidates(self):
+        self._assert_same_candidates(
+            ('isolated_groups', 'overlapping_groups', 'sharing_groups',
+             'traits', 'aggregates', 'same_subtree'),
+            allocation_candidates_group_workers=4)
+
+    def test_anchors_of_sharing_providers_looked_up_concurrently(self):
+        self.conf_fixture.config(
+            allocation_candidates_group_workers=4, group='placement')
+        self._create_option_trees()
+        ss = self.option_rps['ss']
+        groups, rqparams = self._option_scenarios()['sharing_groups']
+        with mock.patch.object(
+                res_ctx, 'anchors_for_sharing_providers',
+                wraps=res_ctx.anchors_for_sharing_providers) as mock_anchors:
+            self._get_allocation_candidates(groups, rqparams)
+
+        # Request groups searched concurrently might look the anchors of the
+        # sharing provider up at the same time, but all of them look up the
+        # same ones.
+        self.assertGreaterEqual(mock_anchors.call_count, 1)
+        self.assertEqual(
+            [mock.call(mock.ANY, {ss.id})] * mock_anchors.call_count,
+            mock_anchors.call_args_list)
+
+    def test_groups_searched_in_worker_threads(self):
+        self.conf_fixture.config(
+            allocation_candidates_group_workers=4, group='placement')
+        cn = self._create_provider('cn')
+        tb.add_inventory(cn, orc.VCPU, 8)
+        tb.add_inventory(cn, orc.MEMORY_MB, 2048)
+        groups = {
+            '1': placement_lib.RequestGroup(
+                use_same_provider=True, resources={orc.VCPU: 1}),
+            '2': placement_lib.RequestGroup(
+                use_same_provider=True, resources={orc.MEMORY_MB: 512}),
+        }
+        threads = set()
+        get_by_group = ac_obj.AllocationCandidates._get_by_group
+
+        def _get_by_group(*args, **kwargs):
+            threads.add(threading.get_ident())
+            return get_by_group(*args, **kwargs)
+
+        with mock.patch.object(ac_obj.AllocationCandidates, '_get_by_group',
+                               side_effect=_get_by_group):
+            alloc_cands = self._get_allocation_candidates(
+                groups, rqparams=placement_lib.RequestWideParams(
+                    group_policy='none'))
+
+        self.assertNotIn(threading.get_ident(), threads)
+        expected = [
+            [('cn', orc.VCPU, 1), ('cn', orc.MEMORY_MB, 512)],
+        ]
+        self._validate_allocation_requests(expected, alloc_cands)
+
+
+class AllocationCandidatesResultCacheTestCase(
+        AllocationCandidatesBaseTestCase):
+    """Tests that the results of the allocation candidates requests are
+    cached and that the cached results are the same as the computed ones.
+    """
+
+    def setUp(self):
+        super(AllocationCandidatesResultCacheTestCase, self).setUp()
+        self.conf_fixture.config(
+            allocation_candidates_cache_ttl=60, group='placement')
+        self.groups = {
+            '': placement_lib.RequestGroup(
+                use_same_provider=False, resources={orc.VCPU: 2}),
+        }
+
+    def _create_cn(self):
+        self.cn = self._create_provider('cn')
+        tb.add_inventory(self.cn, orc.VCPU, 8)
+
+    def _get_cached_allocation_candidates(self, groups):
+        with mock.patch.object(
+                ac_obj.AllocationCandidates, '_get_by_requests',
+                wraps=ac_obj.AllocationCandidates._get_by_requests
+        ) as mock_get:
+            alloc_cands = self._get_allocation_candidates(groups)
+        return alloc_cands, not mock_get.called
+
+    def test_same_candidates(self):
+        scenarios = ('resources', 'isolated_groups', 'sharing_groups',
+                     'traits', 'anchor_traits', 'aggregates', 'in_tree')
+        # The results of the first run of the scenarios are cached and
+        # returned by the second run.
+        with mock.patch.object(
+                ac_obj.AllocationCandidates, '_get_by_requests',
+                wraps=ac_obj.AllocationCandidates._get_by_requests
+        ) as mock_get:
+            self._assert_same_candidates(scenarios)
+        self.assertEqual(len(scenarios), mock_get.call_count)
+
+    def test_result_cached(self):
+        self._create_cn()
+        alloc_cands, cached = self._get_cached_allocation_candidates(
+            self.groups)
+        self.assertFalse(cached)
+        self._validate_allocation_requests(
+            [[('cn', orc.VCPU, 2)]], alloc_cands)
+
+        alloc_cands, cached = self._get_cached_allocation_candidates({
+            '': placement_lib.RequestGroup(
+                use_same_provider=False, resources={orc.VCPU: 2}),
+        })
+        self.assertTrue(cached)
+        self._validate_allocation_requests(
+            [[('cn', orc.VCPU, 2)]], alloc_cands)
+
+    def test_result_not_cached_after_data_changed(self):
+        self._create_cn()
+        self._get_cached_allocation_candidates(self.groups)
+
+        consumer = tb.ensure_consumer(
+            self.ctx, self.user_obj, self.project_obj)
+        tb.set_allocation(self.ctx, self.cn, consumer, {orc.VCPU: 7})
+        alloc_cands, cached = self._get_cached_allocation_candidates(
+            self.groups)
+        self.assertFalse(cached)
+        self._validate_allocation_requests([], alloc_cands)
+
+        # Removing the allocation is noticed as well
+        tb.set_allocation(self.ctx, self.cn, consumer, {orc.VCPU: 0})
+        alloc_cands, cached = self._get_cached_allocation_candidates(
+            self.groups)
+        self.assertFalse(cached)
+        self._validate_allocation_requests(
+            [[('cn', orc.VCPU, 2)]], alloc_cands)
+
+    def test_result_not_cached_after_aggregates_changed(self):
+        # The change is seen even if updated_at does not move forward
+        self.useFixture(utils_fixture.TimeFixture())
+        self._create_cn()
+        groups = {
+            '': placement_lib.RequestGroup(
+                use_same_provider=False, resources={orc.VCPU: 2},
+                member_of=[[uuids.agg1]]),
+        }
+        alloc_cands, _ = self._get_cached_allocation_candidates(groups)
+        self._validate_allocation_requests([], alloc_cands)
+
+        # Setting the aggregates with old microversions does not increment
+        # the provider generation
+        self.cn.set_aggregates([uuids.agg1])
+        alloc_cands, cached = self._get_cached_allocation_candidates(groups)
+        self.assertFalse(cached)
+        self._validate_allocation_requests(
+            [[('cn', orc.VCPU, 2)]], alloc_cands)
+
+    def test_result_expires(self):
+        self._create_cn()
+        with mock.patch.object(ac_obj.time, 'monotonic', return_value=100):
+            self._get_cached_allocation_candidates(self.groups)
+        with mock.patch.object(ac_obj.time, 'monotonic', return_value=159):
+            _, cached = self._get_cached_allocation_candidates(self.groups)
+            self.assertTrue(cached)
+        with mock.patch.object(ac_obj.time, 'monotonic', return_value=160):
+            _, cached = self._get_cached_allocation_candidates(self.groups)
+            self.assertFalse(cached)
+
+    def test_least_recently_used_result_dropped(self):
+        self._create_cn()
+        self.conf_fixture.config(
+            allocation_candidates_cache_size=1, group='placement')
+        other_groups = {
+            '': placement_lib.RequestGroup(
+                use_same_provider=False, resources={orc.VCPU: 1}),
+        }
+        self._get_cached_allocation_candidates(self.groups)
+        self._get_cached_allocation_candidates(other_groups)
+        _, cached = self._get_cached_allocation_candidates(self.groups)
+        self.assertFalse(cached)
+
+    def test_result_not_cached_if_randomized(self):
+        self._create_cn()
+        self.conf_fixture.config(
+            randomize_allocation_candidates=True, group='placement')
+        self._get_cached_allocation_candidates(self.groups)
+        _, cached = self._get_cached_allocation_candidates(self.groups)
+        self.assertFalse(cached)
@@ -127,3 +127,90 @@ class TestResourceClassCache(base.TestCase):
                           cache.string_from_id, 99999999)
         self.assertRaises(exception.ResourceClassNotFound,
                           cache.id_from_string, 'UNKNOWN')
+
+
+class TestSharedAttributeCache(base.TestCase):
+
+    def setUp(self):
+        super(TestSharedAttributeCache, self).setUp()
+        self.conf_fixture.config(
+            shared_attribute_cache=True, group='placement')
+
+    def _insert_rc(self, rc_id, name):
+        with self.placement_db.get_engine().connect() as conn:
+            ins_stmt = attribute_cache._RC_TBL.insert().values(
+                id=rc_id, name=name)
+            with conn.begin():
+                conn.execute(ins_stmt)
+
+    def test_shared_between_caches(self):
+        cache1 = attribute_cache.ResourceClassCache(self.context)
+        self.assertEqual(0, cache1.id_from_string('VCPU'))
+
+        cache2 = attribute_cache.ResourceClassCache(self.context)
+        self.assertEqual(0, cache2.id_from_string('VCPU'))
+        self.assertIs(cache1._id_cache, cache2._id_cache)
+
+        # Other attribute types are not mixed up
+        trait_cache = attribute_cache.TraitCache(self.context)
+        self.assertIsNotNone(trait_cache.id_from_string('HW_CPU_X86_AVX2'))
+        self.assertIsNot(cache1._id_cache, trait_cache._id_cache)
+
+    def test_not_shared_if_disabled(self):
+        self.conf_fixture.config(
+            shared_attribute_cache=False, group='placement')
+        cache1 = attribute_cache.ResourceClassCache(self.context)
+        cache1.id_from_string('VCPU')
+        cache2 = attribute_cache.ResourceClassCache(self.context)
+        cache2.id_from_string('VCPU')
+        self.assertIsNot(cache1._id_cache, cache2._id_cache)
+        self.assertEqual({}, attribute_cache._SHARED)
+
+    def test_changed_table_is_read(self):
+        cache1 = attribute_cache.ResourceClassCache(self.context)
+        cache1.id_from_string('VCPU')
+
+        # Created by another process, so the cache is not cleared
+        self._insert_rc(1001, 'CUSTOM_IRON_NFV')
+
+        cache2 = attribute_cache.ResourceClassCache(self.context)
+        self.assertEqual(0, cache2.id_from_string('VCPU'))
+        self.assertIsNot(cache1._id_cache, cache2._id_cache)
+        self.assertEqual(1001, cache2.id_from_string('CUSTOM_IRON_NFV'))
+
+        # Updated by another process
+        with self.placement_db.get_engine().connect() as conn:
+            upd_stmt = attribute_cache._RC_TBL.update().where(
+                attribute_cache._RC_TBL.c.id == 1001).values(
+                    name='CUSTOM_IRON_SILVER', updated_at=timeutils.utcnow())
+            with conn.begin():
+                conn.execute(upd_stmt)
+
+        cache3 = attribute_cache.ResourceClassCache(self.context)
+        self.assertEqual(
+            'CUSTOM_IRON_SILVER', cache3.string_from_id(1001))
+
+    def test_miss_reads_table(self):
+        cache1 = attribute_cache.ResourceClassCache(self.context)
+        cache1.id_from_string('VCPU')
+
+        cache2 = attribute_cache.ResourceClassCache(self.context)
+        cache2.id_from_string('VCPU')
+        # Created after cache2 used the shared content
+        self._insert_rc(1001, 'CUSTOM_IRON_NFV')
+        self.assertEqual(1001, cache2.id_from_string('CUSTOM_IRON_NFV'))
+
+        # And the shared content is updated
+        cache3 = attribute_cache.ResourceClassCache(self.context)
+        cache3.id_from_string('VCPU')
+        self.assertIs(cache2._id_cache, cache3._id_cache)
+
+    def test_clear_invalidates_shared(self):
+        cache1 = attribute_cache.ConsumerTypeCache(self.context)
+        self.assertIsNone(cache1.id_from_string('unknown'))
+        self.assertIn(attribute_cache.ConsumerTypeCache,
+                      attribute_cache._SHARED)
+
+        cache1.clear()
+        self.assertNotIn(attribute_cache.ConsumerTypeCache,
+                         attribute_cache._SHARED)
@@ -273,6 +273,23 @@ class MigrationCheckersMixin(object):
         names = [r['name'] for r in ind]
         self.assertIn('consumers_consumer_type_id_idx', names)
 
+    def test_update_count_c9d3a4e7f1b2(self):
+        self.migration_api.upgrade('a082b8bb98d0')
+        rps = db_utils.get_table(self.engine, 'resource_providers')
+        ins_stmt = rps.insert().values(
+            name='fake-rp-name',
+            uuid=uuids.rp_uuid,
+            root_provider_id=1,
+        )
+        with self.engine.connect() as conn, conn.begin():
+            conn.execute(ins_stmt)
+        self.migration_api.upgrade('c9d3a4e7f1b2')
+        # Existing providers start counting from zero
+        rps = db_utils.get_table(self.engine, 'resource_providers')
+        with self.engine.connect() as conn:
+            rp = conn.execute(rps.select()).fetchone()
+        self.assertEqual(0, rp.update_count)
+
 
 class PlacementOpportunisticFixture(object):
     def get_enginefacade(self):
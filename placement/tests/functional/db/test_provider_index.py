@@ -0,0 +1,171 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+from unittest import mock
+
+import os_traits
+from oslo_utils import fixture as utils_fixture
+from oslo_utils.fixture import uuidsentinel as uuids
+
+from placement.objects import provider_index
+from placement.objects import research_context as res_ctx
+from placement.objects import trait as trait_obj
+from placement.tests.functional.db import test_base as tb
+
+
+class ProviderIndexTestCase(tb.PlacementDbBaseTestCase):
+
+    def setUp(self):
+        super(ProviderIndexTestCase, self).setUp()
+        self.conf_fixture.config(
+            allocation_candidates_provider_index=True, group='placement')
+
+        self.cn1 = self._create_provider('cn1', uuids.agg1)
+        tb.set_traits(self.cn1, os_traits.HW_CPU_X86_AVX2)
+        self.pf1 = self._create_provider(
+            'pf1', uuids.agg2, parent=self.cn1.uuid)
+        tb.set_traits(self.pf1, os_traits.HW_NIC_OFFLOAD_GENEVE,
+                      os_traits.HW_NIC_SRIOV)
+        self.cn2 = self._create_provider('cn2', uuids.agg1, uuids.agg2)
+        tb.set_traits(self.cn2, os_traits.HW_CPU_X86_AVX2,
+                      os_traits.HW_NIC_SRIOV)
+        self.ss = self._create_provider('ss', uuids.agg1)
+        tb.set_traits(self.ss, os_traits.MISC_SHARES_VIA_AGGREGATE)
+        self.trait_ids = trait_obj.ids_from_names(self.ctx, [
+            os_traits.HW_CPU_X86_AVX2, os_traits.HW_NIC_OFFLOAD_GENEVE,
+            os_traits.HW_NIC_SRIOV, os_traits.MISC_SHARES_VIA_AGGREGATE])
+
+    def _assert_matches_db(self, index):
+        avx2, geneve, sriov, shares = (
+            self.trait_ids[name] for name in (
+                os_traits.HW_CPU_X86_AVX2, os_traits.HW_NIC_OFFLOAD_GENEVE,
+                os_traits.HW_NIC_SRIOV, os_traits.MISC_SHARES_VIA_AGGREGATE))
+        for member_of in ([[uuids.agg1]], [[uuids.agg1], [uuids.agg2]],
+                          [[uuids.agg2, uuids.agg3]], [[uuids.agg3]]):
+            self.assertEqual(
+                res_ctx.provider_ids_matching_aggregates(self.ctx, member_of),
+                index.provider_ids_matching_aggregates(member_of))
+        for required in ([{avx2}], [{avx2}, {sriov}], [{geneve, shares}]):
+            self.assertEqual(
+                res_ctx.provider_ids_matching_required_traits(
+                    self.ctx, required),
+                index.provider_ids_matching_required_traits(required))
+        for traits in ({avx2}, {geneve, shares}):
+            self.assertEqual(
+                res_ctx.get_provider_ids_having_any_trait(self.ctx, traits),
+                index.provider_ids_having_any_trait(traits))
+        for required, forbidden in (({avx2}, None), ({avx2}, {sriov}),
+                                    (None, {shares})):
+            self.assertEqual(
+                res_ctx._get_roots_with_traits(self.ctx, required, forbidden),
+                index.roots_with_traits(required, forbidden))
+        rp_ids = {self.cn1.id, self.pf1.id, self.cn2.id}
+        for required, forbidden in (([], [sriov]), ([{geneve}], []),
+                                    ([{avx2}, {sriov}], [geneve])):
+            self.assertEqual(
+                res_ctx._get_trees_with_traits(
+                    self.ctx, rp_ids, required, forbidden),
+                index.trees_with_traits(rp_ids, required, forbidden))
+
+    def test_disabled(self):
+        self.conf_fixture.config(
+            allocation_candidates_provider_index=False, group='placement')
+        self.assertIsNone(provider_index.get_index(self.ctx))
+
+    def test_bitmap(self):
+        rp_ids = {1, 7, 8, 64, 1000}
+        bitmap = provider_index._bitmap(rp_ids)
+        self.assertEqual(sum(1 << rp_id for rp_id in rp_ids), bitmap)
+        self.assertEqual(rp_ids, provider_index._ids(bitmap))
+        self.assertEqual(0, provider_index._bitmap([]))
+        self.assertEqual(set(), provider_index._ids(0))
+
+    def test_matches_db(self):
+        index = provider_index.get_index(self.ctx)
+        self._assert_matches_db(index)
+
+        self.assertEqual(
+            {self.pf1.id, self.cn2.id},
+            index.provider_ids_matching_aggregates([[uuids.agg2]]))
+        self.assertEqual(
+            {self.cn2.id},
+            index.provider_ids_matching_required_traits([
+                {self.trait_ids[os_traits.HW_CPU_X86_AVX2]},
+                {self.trait_ids[os_traits.HW_NIC_SRIOV]}]))
+
+    def test_reused_while_unchanged(self):
+        index = provider_index.get_index(self.ctx)
+        self.assertIs(index, provider_index.get_index(self.ctx))
+
+    def test_refresh_changed_providers(self):
+        index = provider_index.get_index(self.ctx)
+        tb.set_traits(self.cn1, os_traits.HW_NIC_SRIOV)
+        # Setting the aggregates with old microversions does not increment
+        # the provider generation
+        self.cn2.set_aggregates([uuids.agg3])
+
+        with mock.patch.object(
+                provider_index, '_load',
+                wraps=provider_index._load) as mock_load:
+            new = provider_index.get_index(self.ctx)
+        mock_load.assert_not_called()
+        self.assertIsNot(index, new)
+        self._assert_matches_db(new)
+        # The previous index is left untouched
+        self.assertEqual(
+            {self.cn1.id, self.cn2.id},
+            index.provider_ids_having_any_trait(
+                {self.trait_ids[os_traits.HW_CPU_X86_AVX2]}))
+
+    def test_reload_on_change_missed_by_updated_at(self):
+        index = provider_index.get_index(self.ctx)
+        # The clock of the API worker setting the aggregates runs behind, so
+        # the updated_at of the provider does not move forward.
+        self.useFixture(utils_fixture.TimeFixture(
+            datetime.datetime(2000, 1, 1)))
+        self.cn2.set_aggregates([uuids.agg3])
+
+        with mock.patch.object(
+                provider_index, '_load',
+                wraps=provider_index._load) as mock_load:
+            new = provider_index.get_index(self.ctx)
+        mock_load.assert_called_once()
+        self._assert_matches_db(new)
+        self.assertEqual(
+            {self.cn2.id},
+            new.provider_ids_matching_aggregates([[uuids.agg3]]))
+        self.assertEqual(index.update_counts + 1, new.update_counts)
+
+    def test_refresh_reparented_provider(self):
+        provider_index.get_index(self.ctx)
+        self.pf1.parent_provider_uuid = self.cn2.uuid
+        self.pf1.save(allow_reparenting=True)
+
+        with mock.patch.object(
+                provider_index, '_load',
+                wraps=provider_index._load) as mock_load:
+            new = provider_index.get_index(self.ctx)
+        mock_load.assert_not_called()
+        self._assert_matches_db(new)
+        self.assertEqual(self.cn2.id, new.providers[self.pf1.id].root_id)
+
+    def test_reload_on_new_provider(self):
+        provider_index.get_index(self.ctx)
+        cn3 = self._create_provider('cn3', uuids.agg1)
+
+        new = provider_index.get_index(self.ctx)
+        self.assertIn(cn3.id, new.providers)
+        self.assertIn(
+            cn3.id, new.provider_ids_matching_aggregates([[uuids.agg1]]))
+        self.assertIn(cn3.id, new.roots_with_traits(
+            None, {self.trait_ids[os_traits.HW_CPU_X86_AVX2]}))
@@ -509,6 +509,45 @@ class ResourceProviderTestCase(tb.PlacementDbBaseTestCase):
         # OK, now we've got a parent, so should be True
         self.assertTrue(res_ctx._has_provider_trees(self.ctx))
 
+    def test_has_provider_trees_cached(self):
+        self.conf_fixture.config(
+            provider_shape_cache_ttl=300, group='placement')
+        cn = self._create_provider('cn')
+        with mock.patch.object(
+                res_ctx, '_has_provider_trees',
+                wraps=res_ctx._has_provider_trees) as mock_has_trees:
+            self.assertFalse(res_ctx.has_provider_trees(self.ctx))
+            self.assertFalse(res_ctx.has_provider_trees(self.ctx))
+            self.assertEqual(1, mock_has_trees.call_count)
+
+            # Creating a provider drops the cached value
+            numa0 = self._create_provider('numa0', parent=cn.uuid)
+            self.assertTrue(res_ctx.has_provider_trees(self.ctx))
+            self.assertTrue(res_ctx.has_provider_trees(self.ctx))
+            self.assertEqual(2, mock_has_trees.call_count)
+
+            # So does re-parenting one
+            numa0.parent_provider_uuid = None
+            numa0.save(allow_reparenting=True)
+            self.assertFalse(res_ctx.has_provider_trees(self.ctx))
+            self.assertEqual(3, mock_has_trees.call_count)
+
+            # And deleting one
+            numa0.parent_provider_uuid = cn.uuid
+            numa0.save(allow_reparenting=True)
+            self.assertTrue(res_ctx.has_provider_trees(self.ctx))
+            numa0.destroy()
+            self.assertFalse(res_ctx.has_provider_trees(self.ctx))
+            self.assertEqual(5, mock_has_trees.call_count)
+
+    def test_has_provider_trees_not_cached_by_default(self):
+        with mock.patch.object(
+                res_ctx, '_has_provider_trees',
+                return_value=False) as mock_has_trees:
+            self.assertFalse(res_ctx.has_provider_trees(self.ctx))
+            self.assertFalse(res_ctx.has_provider_trees(self.ctx))
+        self.assertEqual(2, mock_has_trees.call_count)
+
     def test_destroy_resource_provider(self):
         created_resource_provider = self._create_provider(
             uuidsentinel.fake_resource_name,
@@ -900,6 +939,25 @@ class ResourceProviderListTestCase(tb.PlacementDbBaseTestCase):
         expected_rps = ['rp_2']
         self._run_get_all_by_filters(expected_rps, filters=filters)
 
+    def test_get_all_by_uuids(self):
+        root = self._create_provider('root')
+        child = self._create_provider('child', parent=root.uuid)
+        self._create_provider('other')
+
+        rps = rp_obj.get_all_by_uuids(
+            self.ctx, [root.uuid, child.uuid, uuidsentinel.missing])
+
+        rps_by_uuid = {rp.uuid: rp for rp in rps}
+        self.assertEqual({root.uuid, child.uuid}, set(rps_by_uuid))
+        for expected in (root, child):
+            rp = rps_by_uuid[expected.uuid]
+            for field in ('id', 'name', 'generation', 'root_provider_uuid',
+                          'parent_provider_uuid'):
+                self.assertEqual(
+                    getattr(expected, field), getattr(rp, field))
+
+        self.assertEqual([], rp_obj.get_all_by_uuids(self.ctx, []))
+
     def test_get_all_by_filters_with_resources(self):
         for rp_i in ['1', '2']:
             rp = self._create_provider('rp_' + rp_i)
@@ -1314,6 +1372,8 @@ class SharedProviderTestCase(tb.PlacementDbBaseTestCase):
         # the shared storage pool
         got_ids = res_ctx.get_sharing_providers(self.ctx)
         self.assertEqual(set([ss1.id, ss2.id]), got_ids)
+        self.assertEqual(
+            set([ss1.id, ss2.id]), res_ctx.get_all_sharing_providers(self.ctx))
 
         request = placement_lib.RequestGroup(
             use_same_provider=False,
@@ -1334,6 +1394,49 @@ class SharedProviderTestCase(tb.PlacementDbBaseTestCase):
         rps_sharing_dist = rg_ctx.get_rps_with_shared_capacity(DISK_GB_ID)
         self.assertEqual(set([ss1.id]), rps_sharing_dist)
 
+    def test_sharing_providers_cached(self):
+        self.conf_fixture.config(
+            provider_shape_cache_ttl=300, group='placement')
+        ss = self._create_provider('shared storage')
+        with mock.patch.object(
+                res_ctx, 'get_sharing_providers',
+                wraps=res_ctx.get_sharing_providers) as mock_sharing:
+            self.assertEqual(
+                frozenset(), res_ctx.get_all_sharing_providers(self.ctx))
+
+            # Changing the traits of a provider drops the cached value
+            tb.set_traits(ss, "MISC_SHARES_VIA_AGGREGATE")
+            for _ in range(2):
+                self.assertEqual(
+                    frozenset([ss.id]),
+                    res_ctx.get_all_sharing_providers(self.ctx))
+            self.assertEqual(2, mock_sharing.call_count)
+
+            ss.destroy()
+            self.assertEqual(
+                frozenset(), res_ctx.get_all_sharing_providers(self.ctx))
+            self.assertEqual(3, mock_sharing.call_count)
+
+    def test_sharing_providers_changed_by_other_process(self):
+        self.conf_fixture.config(
+            provider_shape_cache_ttl=300, group='placement')
+        ss = self._create_provider('shared storage', uuidsentinel.agg)
+        tb.set_traits(ss, "MISC_SHARES_VIA_AGGREGATE")
+        self.assertEqual(
+            frozenset([ss.id]), res_ctx.get_all_sharing_providers(self.ctx))
+
+        # Changes made via another process do not invalidate the cached value
+        # of this process but are noticed by the DataVersion probe.
+        with mock.patch.object(res_ctx, 'invalidate_provider_shape'):
+            tb.set_traits(ss)
+            self.assertEqual(
+                frozenset(), res_ctx.get_all_sharing_providers(self.ctx))
+
+            cn = self._create_provider('cn')
+            self.assertFalse(res_ctx.has_provider_trees(self.ctx))
+            self._create_provider('numa0', parent=cn.uuid)
+            self.assertTrue(res_ctx.has_provider_trees(self.ctx))
+
 
 # We don't want to waste time sleeping in these tests. It would add
 # tens of seconds.
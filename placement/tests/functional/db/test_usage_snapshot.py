@@ -0,0 +1,159 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+import os_resource_classes as orc
+from oslo_utils import fixture as utils_fixture
+
+from placement import db_api
+from placement.objects import allocation as alloc_obj
+from placement.objects import allocation_candidate as ac_obj
+from placement.objects import research_context as res_ctx
+from placement.objects import usage_snapshot
+from placement.tests.functional.db import test_base as tb
+
+
+class UsageSnapshotTestCase(tb.PlacementDbBaseTestCase):
+
+    def setUp(self):
+        super(UsageSnapshotTestCase, self).setUp()
+        self.conf_fixture.config(
+            allocation_candidates_usage_snapshot=True, group='placement')
+
+        self.cn1 = self._create_provider('cn1')
+        tb.add_inventory(self.cn1, orc.VCPU, 8)
+        tb.add_inventory(self.cn1, orc.MEMORY_MB, 4096, step_size=64)
+        self.pf1 = self._create_provider('pf1', parent=self.cn1.uuid)
+        tb.add_inventory(self.pf1, orc.SRIOV_NET_VF, 4, reserved=1)
+        # A provider without inventory
+        self.pf2 = self._create_provider('pf2', parent=self.cn1.uuid)
+        self.cn2 = self._create_provider('cn2')
+        tb.add_inventory(self.cn2, orc.VCPU, 4, allocation_ratio=2.0)
+        self.allocate_from_provider(self.cn1, orc.VCPU, 6)
+        self.allocate_from_provider(self.cn2, orc.VCPU, 2)
+
+    @db_api.placement_context_manager.reader
+    def _get_trees_from_db(self, ctx, root_ids):
+        # NOTE: The usage is NULL in the database if there are no allocations
+        usages = set(
+            tuple(row[:-1]) + (
+                row.used if row.resource_class_id is None else
+                int(row.used or 0),)
+            for row in res_ctx.get_usages_by_provider_trees(ctx, root_ids))
+        provider_ids = {
+            rp_id: tuple(pids) for rp_id, pids in
+            ac_obj._provider_ids_from_root_ids(ctx, root_ids).items()}
+        return usages, provider_ids
+
+    def _assert_matches_db(self, snapshot):
+        for rc in (orc.VCPU, orc.MEMORY_MB, orc.SRIOV_NET_VF, orc.DISK_GB):
+            rc_id = self.ctx.rc_cache.id_from_string(rc)
+            for amount in (1, 2, 3, 64, 100):
+                self.assertEqual(
+                    res_ctx.get_providers_with_resource(
+                        self.ctx, rc_id, amount),
+                    snapshot.providers_with_resource(rc_id, amount))
+
+        root_ids = {self.cn1.id, self.cn2.id}
+        usages, provider_ids = self._get_trees_from_db(self.ctx, root_ids)
+        self.assertEqual(
+            usages,
+            set(tuple(row) for row in
+                snapshot.usages_by_provider_trees(root_ids)))
+        self.assertEqual(
+            provider_ids,
+            {rp_id: tuple(pids)[:4] for rp_id, pids in
+             snapshot.provider_ids_from_root_ids(root_ids).items()})
+
+    def test_disabled(self):
+        self.conf_fixture.config(
+            allocation_candidates_usage_snapshot=False, group='placement')
+        self.assertIsNone(usage_snapshot.get_snapshot(self.ctx))
+
+    def test_matches_db(self):
+        snapshot = usage_snapshot.get_snapshot(self.ctx)
+        self._assert_matches_db(snapshot)
+
+        vcpu_id = self.ctx.rc_cache.id_from_string(orc.VCPU)
+        self.assertEqual(
+            {(self.cn1.id, self.cn1.id), (self.cn2.id, self.cn2.id)},
+            snapshot.providers_with_resource(vcpu_id, 2))
+        self.assertEqual(
+            {(self.cn2.id, self.cn2.id)},
+            snapshot.providers_with_resource(vcpu_id, 4))
+        self.assertEqual(
+            {(self.cn1.id, self.cn1.id)},
+            snapshot.providers_with_resource(
+                vcpu_id, 1, tree_root_id=self.cn1.id))
+
+    def test_reused_while_unchanged(self):
+        snapshot = usage_snapshot.get_snapshot(self.ctx)
+        self.assertIs(snapshot, usage_snapshot.get_snapshot(self.ctx))
+
+    def test_refresh_changed_providers(self):
+        snapshot = usage_snapshot.get_snapshot(self.ctx)
+        self.allocate_from_provider(self.pf1, orc.SRIOV_NET_VF, 2)
+        tb.add_inventory(self.cn2, orc.DISK_GB, 100)
+
+        with mock.patch.object(
+                usage_snapshot, '_load',
+                wraps=usage_snapshot._load) as mock_load:
+            new = usage_snapshot.get_snapshot(self.ctx)
+        mock_load.assert_not_called()
+        self.assertIsNot(snapshot, new)
+        self._assert_matches_db(new)
+        # The previous snapshot is left untouched
+        self.assertNotIn(self.cn2.id, snapshot.rp_ids_by_rc[
+            self.ctx.rc_cache.id_from_string(orc.DISK_GB)])
+
+    def test_reload_on_reparented_provider(self):
+        usage_snapshot.get_snapshot(self.ctx)
+        # Re-parenting does not increment the provider generation, nor depend
+        # on updated_at moving forward.
+        self.useFixture(utils_fixture.TimeFixture())
+        self.pf1.parent_provider_uuid = self.cn2.uuid
+        self.pf1.save(allow_reparenting=True)
+
+        with mock.patch.object(
+                usage_snapshot, '_load',
+                wraps=usage_snapshot._load) as mock_load:
+            new = usage_snapshot.get_snapshot(self.ctx)
+        mock_load.assert_called_once()
+        self._assert_matches_db(new)
+        self.assertEqual(self.cn2.id, new.providers[self.pf1.id].root_id)
+
+    def test_reload_on_deleted_allocations(self):
+        consumer = tb.ensure_consumer(
+            self.ctx, self.user_obj, self.project_obj)
+        allocs = tb.set_allocation(
+            self.ctx, self.cn1, consumer, {orc.VCPU: 1})
+        self.allocate_from_provider(self.cn2, orc.VCPU, 1)
+        usage_snapshot.get_snapshot(self.ctx)
+        # Deleting allocations does not increment the provider generation
+        alloc_obj.delete_all(self.ctx, allocs)
+
+        with mock.patch.object(
+                usage_snapshot, '_load',
+                wraps=usage_snapshot._load) as mock_load:
+            new = usage_snapshot.get_snapshot(self.ctx)
+        mock_load.assert_called_once()
+        self._assert_matches_db(new)
+
+    def test_reload_on_new_provider(self):
+        usage_snapshot.get_snapshot(self.ctx)
+        cn3 = self._create_provider('cn3')
+
+        new = usage_snapshot.get_snapshot(self.ctx)
+        self.assertIn(cn3.id, new.providers)
+        self.assertEqual(
+            (None,) * 6, new.usages_by_provider_trees([cn3.id])[0][2:])
@@ -11,6 +11,8 @@
 #    under the License.
 import collections
 
+import fixtures
+
 from placement import direct
 from placement.tests.functional import base
 from placement.tests.functional.db import test_base as tb
@@ -53,21 +55,22 @@ class TestWideTreeAllocationCandidateExplosion(base.TestCase):
                 tb.add_inventory(child, 'CUSTOM_VF', num_res_per_child)
 
     @staticmethod
-    def get_candidate_query(num_groups, num_res, limit):
+    def get_candidate_query(num_groups, num_res, limit, group_policy="none"):
         query = ("/allocation_candidates?"
                  "resources=DISK_GB%3A20%2CMEMORY_MB%3A2048%2CVCPU%3A2")
 
         for g in range(num_groups):
             query += f"&resources{g}=CUSTOM_VF%3A{num_res}"
 
-        query += "&group_policy=none"
+        query += f"&group_policy={group_policy}"
         query += f"&limit={limit}"
 
         return query
 
     def _test_num_candidates_and_computes(
         self, computes, pfs, vfs_per_pf, req_groups, req_res_per_group,
-        req_limit, expected_candidates, expected_computes_with_candidates
+        req_limit, expected_candidates, expected_computes_with_candidates,
+        group_policy="none"
     ):
         self.create_tree(
             num_roots=computes, num_child=pfs, num_res_per_child=vfs_per_pf)
@@ -77,7 +80,7 @@ class TestWideTreeAllocationCandidateExplosion(base.TestCase):
             resp = client.get(
                 self.get_candidate_query(
                     num_groups=req_groups, num_res=req_res_per_group,
-                    limit=req_limit),
+                    limit=req_limit, group_policy=group_policy),
                 headers=self.headers)
             self.assertEqual(200, resp.status_code)
 
@@ -349,3 +352,118 @@ class TestWideTreeAllocationCandidateExplosion(base.TestCase):
             req_res_per_group=1,
             req_limit=10,
             expected_candidates=10, expected_computes_with_candidates=2)
+
+    def test_no_viable_candidates_16_17(self):
+        # There are more request groups than VFs. Without noticing that the
+        # PFs are interchangeable all the ways of satisfying the first 16
+        # groups from the 16 PFs would be tried before giving up.
+        self.conf_fixture.conf.set_override(
+            "optimize_for_wide_provider_trees", True, group="workarounds")
+        self.conf_fixture.conf.set_override(
+            "max_allocation_candidates", 1000, group="placement")
+        self._test_num_candidates_and_computes(
+            computes=1, pfs=16, vfs_per_pf=1, req_groups=17,
+            req_res_per_group=1,
+            req_limit=1000,
+            expected_candidates=0, expected_computes_with_candidates=0)
+
+    def test_no_viable_candidates_8_2_17_two_computes(self):
+        self.conf_fixture.conf.set_override(
+            "optimize_for_wide_provider_trees", True, group="workarounds")
+        self.conf_fixture.conf.set_override(
+            "max_allocation_candidates", 1000, group="placement")
+        self._test_num_candidates_and_computes(
+            computes=2, pfs=8, vfs_per_pf=2, req_groups=17,
+            req_res_per_group=1,
+            req_limit=1000,
+            expected_candidates=0, expected_computes_with_candidates=0)
+
+    def test_isolated_candidates_8_4_8(self):
+        # Each group needs a PF of its own, so only the 8! ways of assigning
+        # the PFs to the groups are valid out of the 8^8 combinations.
+        self.conf_fixture.conf.set_override(
+            "optimize_for_wide_provider_trees", True, group="workarounds")
+        self.conf_fixture.conf.set_override(
+            "max_allocation_candidates", 100, group="placement")
+        self._test_num_candidates_and_computes(
+            computes=1, pfs=8, vfs_per_pf=4, req_groups=8,
+            req_res_per_group=1,
+            req_limit=100,
+            expected_candidates=100, expected_computes_with_candidates=1,
+            group_policy="isolate")
+
+    def test_no_isolated_candidates_8_4_9_two_computes(self):
+        # There would be enough VFs for the groups but not enough PFs to
+        # isolate them.
+        self.conf_fixture.conf.set_override(
+            "optimize_for_wide_provider_trees", True, group="workarounds")
+        self.conf_fixture.conf.set_override(
+            "max_allocation_candidates", 1000, group="placement")
+        self._test_num_candidates_and_computes(
+            computes=2, pfs=8, vfs_per_pf=4, req_groups=9,
+            req_res_per_group=1,
+            req_limit=1000,
+            expected_candidates=0, expected_computes_with_candidates=0,
+            group_policy="isolate")
+
+
+class TestStreamedAllocationCandidates(base.TestCase):
+    """Test that the streamed GET /allocation_candidates response is identical
+    to the non-streamed one.
+    """
+
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            compute = tb.create_provider(self.context, f'compute{i}')
+            tb.add_inventory(compute, 'VCPU', 8)
+            tb.add_inventory(compute, 'MEMORY_MB', 4096)
+            tb.set_traits(compute, 'HW_CPU_X86_AVX2')
+            for j in range(2):
+                child = tb.create_provider(
+                    self.context, f'compute{i}:PF{j}', parent=compute.uuid)
+                tb.add_inventory(child, 'CUSTOM_VF', 4)
+
+    def _get(self, version, query):
+        headers = {
+            'x-auth-token': 'admin',
+            'OpenStack-API-Version': 'placement %s' % version,
+        }
+        with direct.PlacementDirect(self.conf_fixture.conf) as client:
+            resp = client.get('/allocation_candidates?' + query,
+                              headers=headers)
+        self.assertEqual(200, resp.status_code)
+        return resp
+
+    def _assert_streamed_identical(self, version, query):
+        self.conf_fixture.config(
+            allocation_candidates_stream_response=False, group='placement')
+        expected = self._get(version, query)
+        self.conf_fixture.config(
+            allocation_candidates_stream_response=True, group='placement')
+        actual = self._get(version, query)
+
+        self.assertEqual(expected.content, actual.content)
+        self.assertEqual(
+            expected.headers['content-type'], actual.headers['content-type'])
+        return actual
+
+    def test_streamed_identical(self):
+        for version, query in (
+                ('1.10', 'resources=VCPU:1'),
+                ('1.17', 'resources=VCPU:1&required=HW_CPU_X86_AVX2'),
+                ('1.29', 'resources=VCPU:1&resources1=CUSTOM_VF:1'),
+                ('1.36', 'resources=VCPU:1&resources1=CUSTOM_VF:1'
+                         '&resources2=CUSTOM_VF:1&group_policy=none'),
+                ('1.36', 'resources=VCPU:100')):
+            resp = self._assert_streamed_identical(version, query)
+            # The body is still valid JSON
+            resp.json()
+
+    def test_streamed_identical_small_chunks(self):
+        # Produce a chunk for every serialized item
+        self.useFixture(fixtures.MockPatch(
+            'placement.handlers.allocation_candidate._STREAM_CHUNK_SIZE', 1))
+        self._assert_streamed_identical(
+            '1.36', 'resources=VCPU:1&resources1=CUSTOM_VF:1'
+                    '&resources2=CUSTOM_VF:1&group_policy=none')
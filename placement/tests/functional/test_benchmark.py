@@ -0,0 +1,62 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import argparse
+import copy
+
+from placement.tests import benchmark
+from placement.tests.functional import base
+
+
+class TestBenchmark(base.NoDBTestCase):
+    """Runs the benchmarks with the smallest topologies so that they do not
+    rot.
+    """
+
+    def test_run_and_compare(self):
+        results = benchmark.run(scale=0.01, iterations=2, warmup=0)
+
+        operations = ('GET /allocation_candidates', 'PUT /allocations',
+                      'POST /allocations', 'DELETE /allocations',
+                      'POST /reshaper')
+        self.assertEqual(
+            {'%s %s' % (topology, op)
+             for topology in benchmark.TOPOLOGIES for op in operations},
+            set(results['results']))
+        for metrics in results['results'].values():
+            self.assertEqual(2, metrics['count'])
+            self.assertGreater(metrics['queries'], 0)
+            self.assertGreater(metrics['peak_memory_kib'], 0)
+            self.assertLessEqual(metrics['p50'], metrics['max'])
+
+        self.assertFalse(
+            any(regressed for *_, regressed in
+                benchmark.compare(results, results)))
+
+        slower = copy.deepcopy(results)
+        metrics = slower['results']['flat GET /allocation_candidates']
+        metrics['p90'] = metrics['p90'] * 2
+        metrics['queries'] += 1
+        self.assertEqual(
+            [('flat GET /allocation_candidates', 'p90'),
+             ('flat GET /allocation_candidates', 'queries')],
+            [(name, metric) for name, metric, _, _, regressed in
+             benchmark.compare(results, slower) if regressed])
+
+    def test_parse_config_override(self):
+        self.assertEqual(
+            (('workarounds', 'optimize_for_wide_provider_trees'), 'True'),
+            benchmark._parse_config_override(
+                'workarounds.optimize_for_wide_provider_trees=True'))
+        self.assertRaises(
+            argparse.ArgumentTypeError,
+            benchmark._parse_config_override, 'no_group=True')
@@ -0,0 +1,195 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+from unittest import mock
+
+import fixtures
+from oslo_db.sqlalchemy import enginefacade
+from oslo_db.sqlalchemy import orm
+from oslo_utils.fixture import uuidsentinel
+import sqlalchemy as sa
+
+from placement import db_api
+from placement import direct
+from placement.tests.functional import base
+from placement.tests.functional.db import test_base as tb
+
+
+class TestReadReplicaRouting(base.TestCase):
+    """Test that the read-only requests routed to the read replica work.
+
+    The read replica is a copy of the test database made at the end of
+    setUp, so the changes made afterwards are not replicated to it.
+    """
+
+    def setUp(self):
+        super(TestReadReplicaRouting, self).setUp()
+        self.headers = {
+            'x-auth-token': 'admin',
+            'OpenStack-API-Version': 'placement latest',
+        }
+        cn = tb.create_provider(self.context, 'cn', uuid=uuidsentinel.cn)
+        tb.add_inventory(cn, 'VCPU', 8)
+        pf = tb.create_provider(self.context, 'pf', parent=cn.uuid)
+        tb.add_inventory(pf, 'CUSTOM_VF', 4)
+        tb.set_traits(pf, 'CUSTOM_PHYSNET1')
+
+        replica_url = 'sqlite:///%s' % os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'replica.db')
+        self.conf_fixture.config(
+            slave_connection=replica_url, group='placement_database')
+        replica = sa.create_engine(replica_url)
+        self.addCleanup(replica.dispose)
+        primary_conn = db_api.get_placement_engine().raw_connection()
+        replica_conn = replica.raw_connection()
+        try:
+            primary_conn.driver_connection.backup(
+                replica_conn.driver_connection)
+        finally:
+            replica_conn.close()
+            primary_conn.close()
+        # The test database fixture patches the engine of the transaction
+        # factory, so the replica engine configured by slave_connection is
+        # patched in likewise.
+        factory = db_api.placement_context_manager._factory
+        self.useFixture(fixtures.MockPatchObject(
+            factory, '_reader_engine', replica))
+        self.useFixture(fixtures.MockPatchObject(
+            factory, '_reader_maker', orm.get_maker(engine=replica)))
+        # Setting up the providers committed writes
+        self.conf_fixture.config(read_replica_lag=0, group='placement')
+
+    def _get_all(self):
+        bodies = []
+        with direct.PlacementDirect(self.conf_fixture.conf) as client:
+            for url in (
+                    '/allocation_candidates?resources=VCPU:1'
+                    '&resources1=CUSTOM_VF:1&required1=CUSTOM_PHYSNET1',
+                    '/resource_providers?resources=VCPU:1',
+                    '/resource_providers?in_tree=%s' % uuidsentinel.cn,
+                    '/resource_providers/%s/usages' % uuidsentinel.cn,
+                    '/usages?project_id=%s' % uuidsentinel.project,
+                    '/usages?project_id=%s&consumer_type=all' %
+                    uuidsentinel.project):
+                resp = client.get(url, headers=self.headers)
+                self.assertEqual(200, resp.status_code, resp.text)
+                bodies.append(resp.json())
+        return bodies
+
+    def test_read_replica_routing(self):
+        expected = self._get_all()
+
+        self.conf_fixture.config(read_replica_routing=True, group='placement')
+        with mock.patch.object(
+                enginefacade._TransactionContext, '_async_reader',
+                autospec=True,
+                side_effect=enginefacade._TransactionContext._async_reader
+        ) as mock_async:
+            actual = self._get_all()
+
+        self.assertEqual(6, mock_async.call_count)
+        self.assertEqual(expected, actual)
+
+    def test_read_replica_routing_group_workers(self):
+        expected = self._get_all()
+
+        self.conf_fixture.config(
+            read_replica_routing=True, allocation_candidates_group_workers=2,
+            group='placement')
+        with mock.patch.object(
+                enginefacade._TransactionContext, '_async_reader',
+                autospec=True,
+                side_effect=enginefacade._TransactionContext._async_reader
+        ) as mock_async:
+            actual = self._get_all()
+
+        # The two request groups of the allocation candidates request are
+        # searched in read-only transactions of their own
+        self.assertEqual(8, mock_async.call_count)
+        self.assertEqual(expected, actual)
+
+    def test_missing_provider_usages(self):
+        self.conf_fixture.config(read_replica_routing=True, group='placement')
+        with direct.PlacementDirect(self.conf_fixture.conf) as client:
+            resp = client.get(
+                '/resource_providers/%s/usages' % uuidsentinel.missing,
+                headers=self.headers)
+        self.assertEqual(404, resp.status_code)
+
+    def test_reads_from_replica(self):
+        self.conf_fixture.config(
+            read_replica_routing=True, read_replica_lag=60, group='placement')
+        # Changes not replicated yet
+        cn2 = tb.create_provider(self.context, 'cn2', uuid=uuidsentinel.cn2)
+        tb.add_inventory(cn2, 'VCPU', 8)
+        with direct.PlacementDirect(self.conf_fixture.conf) as client:
+            resp = client.put(
+                '/allocations/%s' % uuidsentinel.consumer,
+                json={
+                    'allocations': {
+                        uuidsentinel.cn: {'resources': {'VCPU': 2}}},
+                    'consumer_generation': None,
+                    'project_id': uuidsentinel.project,
+                    'user_id': uuidsentinel.user,
+                    'consumer_type': 'INSTANCE',
+                },
+                headers=self.headers)
+            self.assertEqual(204, resp.status_code, resp.text)
+
+            def _get(url):
+                resp = client.get(url, headers=self.headers)
+                return resp.status_code, resp.json()
+
+            # Served by the replica
+            status, body = _get('/resource_providers')
+            self.assertEqual(
+                {'cn', 'pf'},
+                {rp['name'] for rp in body['resource_providers']})
+            status, body = _get('/allocation_candidates?resources=VCPU:1')
+            self.assertEqual(
+                {uuidsentinel.cn, uuidsentinel.pf},
+                set(body['provider_summaries']))
+            self.assertEqual(
+                8, body['provider_summaries'][uuidsentinel.cn]['resources'][
+                    'VCPU']['capacity'])
+            self.assertEqual(
+                0, body['provider_summaries'][uuidsentinel.cn]['resources'][
+                    'VCPU']['used'])
+
+            # The providers and projects changed by this process recently
+            # are read from the primary database
+            status, body = _get(
+                '/resource_providers?uuid=%s' % uuidsentinel.cn2)
+            self.assertEqual(1, len(body['resource_providers']))
+            status, body = _get(
+                '/resource_providers/%s/usages' % uuidsentinel.cn)
+            self.assertEqual({'VCPU': 2}, body['usages'])
+            status, body = _get('/usages?project_id=%s' % uuidsentinel.project)
+            self.assertEqual(
+                {'INSTANCE': {'VCPU': 2, 'consumer_count': 1}},
+                body['usages'])
+
+            # Once the changes are expected to be replicated, these are
+            # served by the replica as well
+            self.conf_fixture.config(read_replica_lag=0, group='placement')
+            status, body = _get(
+                '/resource_providers?uuid=%s' % uuidsentinel.cn2)
+            self.assertEqual([], body['resource_providers'])
+            status, body = _get(
+                '/resource_providers/%s/usages' % uuidsentinel.cn2)
+            self.assertEqual(404, status)
+            status, body = _get(
+                '/resource_providers/%s/usages' % uuidsentinel.cn)
+            self.assertEqual({'VCPU': 0}, body['usages'])
+            status, body = _get('/usages?project_id=%s' % uuidsentinel.project)
+            self.assertEqual({}, body['usages'])
@@ -60,6 +60,8 @@ class TestAllocationCandidatesNoDB(base.TestCase):
         self.assertEqual(aro_in[:2], aro)
         self.assertEqual(set([sum1, sum0, sum4, sum8, sum5]), set(sum))
 
+    @mock.patch('placement.objects.research_context._has_provider_trees',
+                new=mock.Mock(return_value=True))
     def test_check_same_subtree(self):
         # Construct a tree that look like this
         #
@@ -93,13 +95,67 @@ class TestAllocationCandidatesNoDB(base.TestCase):
             set(["0", "1"]),
         ]
 
+        rw_ctx = res_ctx.RequestWideSearchContext(
+            self.context, placement_lib.RequestWideParams(), True)
+        rw_ctx.index_provider_trees(parent_by_rp)
+        interval_by_rp = rw_ctx.subtree_interval_by_rp_uuid
+
         for group in same_subtree:
             self.assertTrue(
-                ac_obj._check_same_subtree(group, parent_by_rp))
+                ac_obj._check_same_subtree(group, interval_by_rp))
 
         for group in different_subtree:
             self.assertFalse(
-                ac_obj._check_same_subtree(group, parent_by_rp))
+                ac_obj._check_same_subtree(group, interval_by_rp))
+
+    @mock.patch('placement.objects.research_context._has_provider_trees',
+                new=mock.Mock(return_value=True))
+    def test_index_provider_trees(self):
+        #  0 -+- 00 --- 000    1
+        #     +- 01
+        rw_ctx = res_ctx.RequestWideSearchContext(
+            self.context, placement_lib.RequestWideParams(), True)
+        rw_ctx.index_provider_trees(
+            {"0": None, "00": "0", "000": "00", "01": "0"})
+        # Trees indexed later do not overlap with the ones indexed before
+        rw_ctx.index_provider_trees({"1": None})
+        intervals = rw_ctx.subtree_interval_by_rp_uuid
+
+        self.assertEqual((0, 4), intervals["0"])
+        self.assertEqual(2, intervals["00"][1] - intervals["00"][0])
+        self.assertEqual(intervals["00"][0] + 1, intervals["000"][0])
+        self.assertEqual(1, intervals["01"][1] - intervals["01"][0])
+        self.assertEqual((4, 5), intervals["1"])
+
+    @mock.patch('placement.objects.research_context._has_provider_trees',
+                new=mock.Mock(return_value=True))
+    def test_check_traits_for_alloc_request(self):
+        rw_ctx = res_ctx.RequestWideSearchContext(
+            self.context, placement_lib.RequestWideParams(), True)
+        rw_ctx.register_traits(['A', 'B', 'C', 'D'])
+        # Registering a trait again keeps its bit
+        rw_ctx.register_traits(['B', 'E'])
+        self.assertEqual(0b10, rw_ctx.trait_mask(['B']))
+        # Traits not relevant to the request are ignored
+        self.assertEqual(0b10001, rw_ctx.trait_mask(['A', 'E', 'X']))
+
+        summaries = {}
+        res_requests = []
+        for rp_id, traits in enumerate((['A', 'X'], ['C'], ['D'])):
+            summaries[rp_id] = ac_obj.ProviderSummary(
+                traits=traits, trait_mask=rw_ctx.trait_mask(traits))
+            res_requests.append(ac_obj.AllocationRequestResource(
+                resource_provider=rp_obj.ResourceProvider(
+                    self.context, id=rp_id)))
+
+        def _check(required):
+            return ac_obj._check_traits_for_alloc_request(
+                res_requests, summaries, required,
+                [rw_ctx.trait_mask(any_traits) for any_traits in required])
+
+        # Required traits are provided collectively
+        self.assertEqual([0, 1, 2], _check([{'A'}, {'B', 'C'}, {'D'}]))
+        self.assertEqual([], _check([{'A'}, {'B', 'E'}]))
 
     @mock.patch('placement.objects.research_context._has_provider_trees',
                 new=mock.Mock(return_value=True))
@@ -107,6 +163,10 @@ class TestAllocationCandidatesNoDB(base.TestCase):
         self.conf_fixture.conf.set_override(
             "allocation_candidates_generation_strategy", strategy,
             group="placement")
+        # The areqs below are just placeholders so the capacity based
+        # pruning of the product cannot be applied to them.
+        self.conf_fixture.conf.set_override(
+            "optimize_for_wide_provider_trees", False, group="workarounds")
 
         rw_ctx = res_ctx.RequestWideSearchContext(
             self.context, placement_lib.RequestWideParams(), True)
@@ -159,11 +219,9 @@ class TestAllocationCandidatesNoDB(base.TestCase):
         self._test_generate_areq_list("breadth-first", expected_candidates)
 
 
-def _rp(rp_id, capacity=1, max_unit=None):
-    return {(rp_id, "SRIOV_VF"):
-            ac_obj.ProviderSummaryResource(
-                resource_class="SRIOV_VF", capacity=capacity,
-                used=0, max_unit=max_unit or capacity)}
+def _add_rp(rw_ctx, rp_id, capacity=1, max_unit=None, used=0):
+    rw_ctx.add_provider_capacity(
+        rp_id, "SRIOV_VF", capacity, used, max_unit or capacity)
 
 
 def _alloc_req(group, rp_id, amount):
@@ -180,6 +238,118 @@ def _alloc_req(group, rp_id, amount):
         mappings={group: [rp_id]})
 
 
+class TestAllocationRequestNoDB(base.TestCase):
+
+    def test_eq_and_hash_ignore_order(self):
+        rp1 = rp_obj.ResourceProvider(context=None, id=1, uuid=uuids.rp1)
+        rp2 = rp_obj.ResourceProvider(context=None, id=2, uuid=uuids.rp2)
+        arr1 = ac_obj.AllocationRequestResource(
+            resource_provider=rp1, resource_class="VCPU", amount=1)
+        arr2 = ac_obj.AllocationRequestResource(
+            resource_provider=rp2, resource_class="VCPU", amount=1)
+        mappings = {"": {uuids.rp1, uuids.rp2}}
+
+        areq1 = ac_obj.AllocationRequest(
+            resource_requests=[arr1, arr2], mappings=mappings)
+        areq2 = ac_obj.AllocationRequest(
+            resource_requests=[arr2, arr1], mappings=mappings)
+        areq3 = ac_obj.AllocationRequest(
+            resource_requests=[
+                arr1,
+                ac_obj.AllocationRequestResource(
+                    resource_provider=rp2, resource_class="VCPU", amount=2)],
+            mappings=mappings)
+
+        self.assertEqual(areq1, areq2)
+        self.assertEqual(hash(areq1), hash(areq2))
+        self.assertNotEqual(areq1, areq3)
+        self.assertEqual(2, len({areq1, areq2, areq3}))
+
+    def test_hash_depends_on_mappings(self):
+        rp1 = rp_obj.ResourceProvider(context=None, id=1, uuid=uuids.rp1)
+        rp2 = rp_obj.ResourceProvider(context=None, id=2, uuid=uuids.rp2)
+        arrs = [
+            ac_obj.AllocationRequestResource(
+                resource_provider=rp, resource_class="VCPU", amount=1)
+            for rp in (rp1, rp2)]
+
+        # Consumes the same resources but the groups are satisfied by
+        # different providers
+        areq1 = ac_obj.AllocationRequest(
+            resource_requests=arrs,
+            mappings={"1": {uuids.rp1}, "2": {uuids.rp2}})
+        areq2 = ac_obj.AllocationRequest(
+            resource_requests=arrs,
+            mappings={"1": {uuids.rp2}, "2": {uuids.rp1}})
+
+        self.assertNotEqual(areq1, areq2)
+        self.assertNotEqual(hash(areq1), hash(areq2))
+
+    @mock.patch('placement.objects.research_context._has_provider_trees',
+                new=mock.Mock(return_value=True))
+    def test_consolidate_does_not_change_input(self):
+        rw_ctx = res_ctx.RequestWideSearchContext(
+            self.context, placement_lib.RequestWideParams(), True)
+        g1_rp1 = _alloc_req("G1", rp_id="RP1", amount=1)
+        g2_rp1 = _alloc_req("G2", rp_id="RP1", amount=2)
+
+        areq = ac_obj._consolidate_allocation_requests(
+            [g1_rp1, g2_rp1], rw_ctx)
+
+        self.assertEqual(1, len(areq.resource_requests))
+        self.assertEqual(3, areq.resource_requests[0].amount)
+        self.assertEqual({"G1": {"RP1"}, "G2": {"RP1"}}, areq.mappings)
+        # The AllocationRequestResources of the input are shared with other
+        # candidates so they are left intact
+        self.assertEqual(1, g1_rp1.resource_requests[0].amount)
+        self.assertEqual(2, g2_rp1.resource_requests[0].amount)
+
+
+class TestResultCacheKeyNoDB(base.TestCase):
+
+    def test_key_ignores_order(self):
+        def _key(traits, aggs, limit):
+            groups = {
+                '1': placement_lib.RequestGroup(
+                    resources={'VCPU': 1, 'MEMORY_MB': 512},
+                    required_traits=traits, member_of=aggs),
+            }
+            return ac_obj._result_cache_key(
+                self.context, groups,
+                placement_lib.RequestWideParams(limit=limit), True)
+
+        key = _key([{'A', 'B'}, {'C'}], [[uuids.agg1, uuids.agg2]], [])
+        # The result of RequestWideParams.from_request without a limit
+        self.assertEqual(key, _key([{'C'}, {'B', 'A'}],
+                                   [[uuids.agg2, uuids.agg1]], None))
+        self.assertNotEqual(key, _key([{'A', 'B', 'C'}],
+                                      [[uuids.agg1, uuids.agg2]], None))
+        self.assertNotEqual(key, _key([{'A', 'B'}, {'C'}],
+                                      [[uuids.agg1], [uuids.agg2]], None))
+        self.assertNotEqual(key, _key([{'A', 'B'}, {'C'}],
+                                      [[uuids.agg1, uuids.agg2]], 1))
+        hash(key)
+
+    def test_key_includes_options(self):
+        groups = {
+            '': placement_lib.RequestGroup(
+                use_same_provider=False, resources={'VCPU': 1}),
+        }
+        rqparams = placement_lib.RequestWideParams()
+        keys = {ac_obj._result_cache_key(
+            self.context, groups, rqparams, True)}
+        for name, value, group in (
+                ('max_allocation_candidates', 10, 'placement'),
+                ('allocation_candidates_generation_strategy',
+                 'breadth-first', 'placement'),
+                ('randomize_allocation_candidates', True, 'placement'),
+                ('optimize_for_wide_provider_trees', True, 'workarounds')):
+            self.conf_fixture.conf.set_override(name, value, group=group)
+            keys.add(ac_obj._result_cache_key(
+                self.context, groups, rqparams, True))
+        self.assertEqual(5, len(keys))
+
+
 class TestOptimizedAllocationCandidatesNoDB(base.TestCase):
     def setUp(self):
         super().setUp()
@@ -193,9 +363,9 @@ class TestOptimizedAllocationCandidatesNoDB(base.TestCase):
             self.context, placement_lib.RequestWideParams(), True)
 
         # We have 3 child RPs each having a capacity of one resource
-        rw_ctx.psum_res_by_rp_rc.update(_rp("RP1", capacity=1))
-        rw_ctx.psum_res_by_rp_rc.update(_rp("RP2", capacity=1))
-        rw_ctx.psum_res_by_rp_rc.update(_rp("RP3", capacity=1))
+        _add_rp(rw_ctx, "RP1", capacity=1)
+        _add_rp(rw_ctx, "RP2", capacity=1)
+        _add_rp(rw_ctx, "RP3", capacity=1)
 
         G1_RP1 = _alloc_req("G1", rp_id="RP1", amount=1)
         G1_RP2 = _alloc_req("G1", rp_id="RP2", amount=1)
@@ -229,34 +399,34 @@ class TestOptimizedAllocationCandidatesNoDB(base.TestCase):
             consolidate_calls.append(copy.deepcopy(areq_list))
             return orig_consolidate(areq_list, rw_ctx)
 
-        orig_exceeds_capacity = ac_obj._exceeds_capacity
-        # pairs of areq_list from the call arg and the return value of the
+        orig_push = ac_obj._CandidateTracker.push
+        # pairs of areq from the call arg and the return value of the
         # wrapped call
-        exceeds_capacity_calls = []
+        push_calls = []
 
-        def warp_exceeds_capacity(rw_ctx, areq_list):
-            result = orig_exceeds_capacity(rw_ctx, areq_list)
-            exceeds_capacity_calls.append((areq_list, result))
+        def wrap_push(tracker, areq):
+            result = orig_push(tracker, areq)
+            push_calls.append((areq, result))
             return result
 
         with (
-            # Consolidate is not called during product generation as we
-            # re-implemented exceeds_capacity to work on non consolidated
-            # areq_lists
+            # Consolidate is not called during product generation as the
+            # tracker adds up the capacity_demand of the areqs of the
+            # partial product instead of consolidating them
             mock.patch.object(
                 ac_obj, "_consolidate_allocation_requests",
                 new=mock.NonCallableMock
             ),
             # the rw_ctx exceeds_capacity working on consolidated areqs
-            # are not called at all, the local _exceeds_capacity called instead
-            # on all partial products, mocked below.
+            # is not called at all, the capacity tracker is called instead
+            # with the last areq of all partial products, mocked below.
             mock.patch.object(
                 rw_ctx, "exceeds_capacity", new=mock.NonCallableMock()
             ),
             mock.patch.object(
-                ac_obj, "_exceeds_capacity",
-                side_effect=warp_exceeds_capacity
-            ) as mock_exceeds_capacity,
+                ac_obj._CandidateTracker, "push", autospec=True,
+                side_effect=wrap_push
+            ) as mock_push,
         ):
             generator = ac_obj._generate_areq_lists(
                 rw_ctx, areq_lists_by_anchor, {"G1", "G2", "G3"})
@@ -281,8 +451,9 @@ class TestOptimizedAllocationCandidatesNoDB(base.TestCase):
                 areq_lists)
 
         # areq_list, result pairs where areq_list is a partial product
-        # and the result is the expected return value of _exceeds_capacity
-        expected_exceeds_capacity_calls = [
+        # and the result is whether the capacity_demand of its areqs
+        # together exceeds the capacity of the providers
+        expected_exceeds_capacity = [
             ((G1_RP1,), False),
             ((G1_RP1, G2_RP1), True),
             # This is the pruning. The algo did not try to generate
@@ -292,9 +463,9 @@ class TestOptimizedAllocationCandidatesNoDB(base.TestCase):
             ((G1_RP1, G2_RP2), False),
             ((G1_RP1, G2_RP2, G3_RP1), True),
             # This is another optimization (compared to an index odometer
-            # based product algo) that the recursive call reuses the already
-            # calculated and checked valid prefix of G1_RP1, G2_RP2 and don't
-            # need to re-create it to try G3_RP2 with it.
+            # based product algo) that the tracker keeps the consumption of
+            # the already checked valid prefix of G1_RP1, G2_RP2 and only
+            # needs to add G3_RP2 to it.
             ((G1_RP1, G2_RP2, G3_RP2), True),
             ((G1_RP1, G2_RP2, G3_RP3), False),  # this is a valid product
             # simple backtrack as we run out of possibilities on level 3
@@ -328,9 +499,13 @@ class TestOptimizedAllocationCandidatesNoDB(base.TestCase):
             # possibilities as well
         ]
 
-        for i, p in enumerate(
-            zip(expected_exceeds_capacity_calls, exceeds_capacity_calls)
-        ):
+        # Each partial product is checked by pushing its last areq to the
+        # tracker, which accepts it if the partial product does not exceed
+        # the capacity
+        expected_push_calls = [
+            (areq_list[-1], not exceeds)
+            for areq_list, exceeds in expected_exceeds_capacity]
+        for i, p in enumerate(zip(expected_push_calls, push_calls)):
             expected, actual = p
             self.assertEqual(
                 expected, actual, "Call index %d does not match" % i)
@@ -346,11 +521,35 @@ class TestOptimizedAllocationCandidatesNoDB(base.TestCase):
         # this is already a must-have optimization to run the checks in
         # less than a minute. See the included functional tests for the
         # scale results.
-        self.assertEqual(30, len(mock_exceeds_capacity.mock_calls))
-        self.assertEqual(30, len(expected_exceeds_capacity_calls))
+        self.assertEqual(30, len(mock_push.mock_calls))
+        self.assertEqual(30, len(expected_exceeds_capacity))
+
+    @mock.patch('placement.objects.research_context._has_provider_trees',
+                new=mock.Mock(return_value=True))
+    def test_tracker_built_on_first_next(self):
+        rw_ctx = res_ctx.RequestWideSearchContext(
+            self.context, placement_lib.RequestWideParams(), True)
+        _add_rp(rw_ctx, "RP1", capacity=1)
+        _add_rp(rw_ctx, "RP2", capacity=1)
+        areq_lists_by_anchor = {
+            root: {
+                "G1": [_alloc_req("G1", rp_id=rp_id, amount=1)],
+            }
+            for root, rp_id in (("root1", "RP1"), ("root2", "RP2"))
+        }
 
+        with mock.patch.object(
+                ac_obj, "_CandidateTracker",
+                wraps=ac_obj._CandidateTracker) as mock_tracker:
+            generators = ac_obj._get_areq_list_generators(
+                rw_ctx, areq_lists_by_anchor, {"G1"})
+            # No tracker is built for the anchors not consumed yet
+            mock_tracker.assert_not_called()
+            self.assertEqual(1, len(list(generators[0])))
+            mock_tracker.assert_called_once()
 
-class TestExceedsCapacityNoDB(base.TestCase):
+
+class TestCandidateTrackerNoDB(base.TestCase):
 
     def setUp(self):
         super().setUp()
@@ -364,43 +563,208 @@ class TestExceedsCapacityNoDB(base.TestCase):
         self.rw_ctx = res_ctx.RequestWideSearchContext(
             self.context, placement_lib.RequestWideParams(), True)
 
-        self.rw_ctx.psum_res_by_rp_rc.update(
-            _rp("RP1", capacity=3, max_unit=1))
-        self.rw_ctx.psum_res_by_rp_rc.update(
-            _rp("RP2", capacity=2, max_unit=2))
-        self.rw_ctx.psum_res_by_rp_rc.update(
-            _rp("RP3", capacity=1, max_unit=1))
+        _add_rp(self.rw_ctx, "RP1", capacity=3, max_unit=1)
+        _add_rp(self.rw_ctx, "RP2", capacity=2, max_unit=2)
+        _add_rp(self.rw_ctx, "RP3", capacity=1, max_unit=1)
 
-    def test_not_exceeds(self):
-        self.assertFalse(
-            ac_obj._exceeds_capacity(
-                self.rw_ctx, (_alloc_req("G1", rp_id="RP1", amount=1),)))
+    def _fits(self, *areqs):
+        tracker = ac_obj._CandidateTracker(self.rw_ctx)
+        return all(tracker.push(areq) for areq in areqs)
 
-        self.assertFalse(
-            ac_obj._exceeds_capacity(
-                self.rw_ctx, (
-                    _alloc_req("G1", rp_id="RP2", amount=1),
-                    _alloc_req("G2", rp_id="RP2", amount=1),
-                )))
+    def test_fits(self):
+        self.assertTrue(self._fits(_alloc_req("G1", rp_id="RP1", amount=1)))
 
-        self.assertFalse(
-            ac_obj._exceeds_capacity(
-                self.rw_ctx, (
-                    _alloc_req("G1", rp_id="RP3", amount=1),
-                    _alloc_req("G2", rp_id="RP1", amount=1),
-                )))
+        self.assertTrue(
+            self._fits(
+                _alloc_req("G1", rp_id="RP2", amount=1),
+                _alloc_req("G2", rp_id="RP2", amount=1),
+            ))
 
-    def test_exceeds_capacity(self):
         self.assertTrue(
-            ac_obj._exceeds_capacity(
-                self.rw_ctx, (
-                    _alloc_req("G1", rp_id="RP3", amount=1),
-                    _alloc_req("G2", rp_id="RP3", amount=1),
-                )))
+            self._fits(
+                _alloc_req("G1", rp_id="RP3", amount=1),
+                _alloc_req("G2", rp_id="RP1", amount=1),
+            ))
+
+    def test_exceeds_capacity(self):
+        self.assertFalse(
+            self._fits(
+                _alloc_req("G1", rp_id="RP3", amount=1),
+                _alloc_req("G2", rp_id="RP3", amount=1),
+            ))
 
     def test_exceeds_max_unit(self):
-        self.assertTrue(
-            ac_obj._exceeds_capacity(self.rw_ctx, (
+        self.assertFalse(
+            self._fits(
                 _alloc_req("G1", rp_id="RP1", amount=1),
-                _alloc_req("G2", rp_id="RP1", amount=1)
-            )))
+                _alloc_req("G2", rp_id="RP1", amount=1),
+            ))
+
+    def test_exceeds_capacity_used(self):
+        _add_rp(self.rw_ctx, "RP4", capacity=4, max_unit=2, used=3)
+
+        self.assertTrue(self._fits(_alloc_req("G1", rp_id="RP4", amount=1)))
+        self.assertFalse(
+            self._fits(
+                _alloc_req("G1", rp_id="RP4", amount=1),
+                _alloc_req("G2", rp_id="RP4", amount=1),
+            ))
+        # The check of the consolidated allocation request agrees
+        self.assertTrue(
+            self.rw_ctx.exceeds_capacity(
+                _alloc_req("G1", rp_id="RP4", amount=2)))
+
+    def test_isolate(self):
+        self.rw_ctx.group_policy = 'isolate'
+        tracker = ac_obj._CandidateTracker(self.rw_ctx)
+        g1_rp1 = _alloc_req("G1", rp_id="RP1", amount=1)
+        g2_rp1 = _alloc_req("G2", rp_id="RP1", amount=1)
+        g2_rp2 = _alloc_req("G2", rp_id="RP2", amount=1)
+
+        self.assertTrue(tracker.push(g1_rp1))
+        # RP1 has the capacity but it is used by G1 already
+        self.assertFalse(tracker.push(g2_rp1))
+        self.assertTrue(tracker.push(g2_rp2))
+        tracker.pop(g2_rp2)
+        tracker.pop(g1_rp1)
+
+        self.assertTrue(tracker.push(g2_rp1))
+        tracker.pop(g2_rp1)
+        self.assertEqual(set(), tracker._isolated_rp_uuids)
+
+        # Not granular groups are not isolated
+        g1_rp2 = _alloc_req("G1", rp_id="RP2", amount=1)
+        g1_rp2.use_same_provider = False
+        self.assertTrue(tracker.push(g2_rp2))
+        self.assertTrue(tracker.push(g1_rp2))
+
+    def test_same_subtree(self):
+        #  ROOT -+- RP1 --- RP3
+        #        +- RP2
+        self.rw_ctx.same_subtrees = [{"G1", "G2", "G3"}]
+        self.rw_ctx.index_provider_trees(
+            {"ROOT": None, "RP1": "ROOT", "RP2": "ROOT", "RP3": "RP1"})
+        _add_rp(self.rw_ctx, "ROOT")
+        tracker = ac_obj._CandidateTracker(self.rw_ctx)
+        g1_rp2 = _alloc_req("G1", rp_id="RP2", amount=1)
+        g2_rp3 = _alloc_req("G2", rp_id="RP3", amount=1)
+        g3_rp1 = _alloc_req("G3", rp_id="RP1", amount=1)
+        g3_root = _alloc_req("G3", rp_id="ROOT", amount=1)
+        g4_rp1 = _alloc_req("G4", rp_id="RP1", amount=1)
+
+        # RP2 and RP3 are not in the same subtree, but that is only checked
+        # once all the groups of the same_subtree constraint are added.
+        self.assertTrue(tracker.push(g1_rp2))
+        self.assertTrue(tracker.push(g2_rp3))
+        self.assertTrue(tracker.push(g4_rp1))
+        self.assertFalse(tracker.push(g3_rp1))
+        self.assertTrue(tracker.push(g3_root))
+        for areq in (g3_root, g4_rp1, g2_rp3, g1_rp2):
+            tracker.pop(areq)
+
+        self.assertEqual([{}], tracker._rp_uuids_by_same_subtree)
+        self.assertEqual([0], tracker._num_in_same_subtrees)
+        self.assertTrue(tracker.push(g2_rp3))
+        self.assertTrue(tracker.push(g3_rp1))
+        self.assertFalse(tracker.push(g1_rp2))
+
+    def _add_children(self, *rp_ids):
+        for rp_id in rp_ids:
+            _add_rp(self.rw_ctx, rp_id, capacity=1, max_unit=1)
+            self.rw_ctx.parent_uuid_by_rp_uuid[rp_id] = "ROOT"
+        self.rw_ctx.parent_uuid_by_rp_uuid["ROOT"] = None
+
+    def test_interchangeable_providers(self):
+        self._add_children("RP4", "RP5", "RP6")
+        # RP5 and RP6 are only interchangeable with each other as G2 cannot
+        # use RP4
+        areq_lists = [
+            [_alloc_req("G1", rp_id=rp_id, amount=1)
+             for rp_id in ("RP4", "RP5", "RP6")],
+            [_alloc_req("G2", rp_id=rp_id, amount=1)
+             for rp_id in ("RP5", "RP6")],
+        ]
+        tracker = ac_obj._CandidateTracker(self.rw_ctx, areq_lists)
+        self.assertEqual({"RP5": "RP5", "RP6": "RP5"}, tracker.interchangeable)
+
+        # RP3 is not a child provider of the tree
+        areq_lists[1].append(_alloc_req("G2", rp_id="RP3", amount=1))
+        tracker = ac_obj._CandidateTracker(self.rw_ctx, areq_lists)
+        self.assertEqual({"RP5": "RP5", "RP6": "RP5"}, tracker.interchangeable)
+
+        areq_lists[1].append(_alloc_req("G2", rp_id="RP4", amount=1))
+        tracker = ac_obj._CandidateTracker(self.rw_ctx, areq_lists)
+        self.assertEqual(
+            {"RP4": "RP4", "RP5": "RP4", "RP6": "RP4"},
+            tracker.interchangeable)
+
+    def test_not_interchangeable_different_capacity(self):
+        self._add_children("RP4", "RP5")
+        _add_rp(self.rw_ctx, "RP5", capacity=2, max_unit=2)
+        areq_lists = [
+            [_alloc_req("G1", rp_id=rp_id, amount=1)
+             for rp_id in ("RP4", "RP5")],
+        ]
+        tracker = ac_obj._CandidateTracker(self.rw_ctx, areq_lists)
+        self.assertEqual({}, tracker.interchangeable)
+
+    def test_interchangeable_providers_without_sibling_leaves(self):
+        # Flat trees have no sibling leaves, so nothing is looked up to find
+        # interchangeable providers.
+        for rp_id in ("RP1", "RP2", "RP3"):
+            self.rw_ctx.parent_uuid_by_rp_uuid[rp_id] = None
+        areq_lists = [
+            [_alloc_req("G1", rp_id=rp_id, amount=1)
+             for rp_id in ("RP1", "RP2", "RP3")],
+        ]
+        with mock.patch.object(
+                self.rw_ctx, "capacity_slots_by_provider",
+                wraps=self.rw_ctx.capacity_slots_by_provider) as mock_slots:
+            tracker = ac_obj._CandidateTracker(self.rw_ctx, areq_lists)
+        self.assertEqual({}, tracker.interchangeable)
+        mock_slots.assert_called_once_with({})
+
+        # The sibling leaves are found once the trees are extended
+        self._add_children("RP4", "RP5")
+        areq_lists[0].extend(
+            _alloc_req("G1", rp_id=rp_id, amount=1)
+            for rp_id in ("RP4", "RP5"))
+        tracker = ac_obj._CandidateTracker(self.rw_ctx, areq_lists)
+        self.assertEqual({"RP4": "RP4", "RP5": "RP4"}, tracker.interchangeable)
+
+    def test_symmetry_key(self):
+        self._add_children("RP4", "RP5", "RP6")
+        g1 = [_alloc_req("G1", rp_id=rp_id, amount=1)
+              for rp_id in ("RP4", "RP5", "RP6")]
+        g2 = [_alloc_req("G2", rp_id=rp_id, amount=1)
+              for rp_id in ("RP4", "RP5", "RP6")]
+        g3 = [_alloc_req("G3", rp_id="RP1", amount=1)]
+        tracker = ac_obj._CandidateTracker(self.rw_ctx, [g1, g2, g3])
+
+        self.assertIsNone(tracker.symmetry_key(g3[0]))
+        self.assertEqual(
+            {tracker.symmetry_key(g1[0])},
+            {tracker.symmetry_key(areq) for areq in g1})
+
+        self.assertTrue(tracker.push(g1[0]))
+        # RP4 is used already so it is not interchangeable with the others
+        # for the rest of the product
+        self.assertNotEqual(
+            tracker.symmetry_key(g2[0]), tracker.symmetry_key(g2[1]))
+        self.assertEqual(
+            tracker.symmetry_key(g2[1]), tracker.symmetry_key(g2[2]))
+
+        tracker.pop(g1[0])
+        self.assertEqual(
+            tracker.symmetry_key(g2[0]), tracker.symmetry_key(g2[1]))
+
+    def test_rejected_push_leaves_state_unchanged(self):
+        tracker = ac_obj._CandidateTracker(self.rw_ctx)
+        self.assertTrue(tracker.push(_alloc_req("G1", rp_id="RP3", amount=1)))
+        self.assertFalse(
+            tracker.push(_alloc_req("G2", rp_id="RP3", amount=1)))
+        # The rejected areq is not popped, only the accepted one
+        tracker.pop(_alloc_req("G1", rp_id="RP3", amount=1))
+        self.assertFalse(any(tracker._consumed.values()))
+        # After the pop the capacity is available again
+        self.assertTrue(tracker.push(_alloc_req("G2", rp_id="RP3", amount=1)))
@@ -79,3 +79,28 @@ class TestRPCandidateList(testtools.TestCase):
         empty_candidates = rp_candidates.RPCandidateList()
         self.rp_candidates.merge_common_trees(empty_candidates)
         self.assertEqual(expected_rpsinfo, self.rp_candidates.rps_info)
+
+    def test_filter_by_rp_nor_tree(self):
+        self.rp_candidates.filter_by_rp_nor_tree(set(['ss1', 'root1']))
+        # we get rps outside 'root1' except for 'ss1'
+        expected_rpsinfo = set([('rp3', 'root', 'rc_1')])
+        self.assertEqual(expected_rpsinfo, self.rp_candidates.rps_info)
+
+    def test_exclude_rps(self):
+        self.rp_candidates.exclude_rps(set(['ss1', 'root1']))
+        expected_rpsinfo = set([('rp1', 'root1', 'rc_1'),
+                                ('rp2', 'root1', 'rc_1'),
+                                ('rp3', 'root', 'rc_1')])
+        self.assertEqual(expected_rpsinfo, self.rp_candidates.rps_info)
+        self.assertEqual(set(['rp1', 'rp2', 'rp3']), self.rp_candidates.rps)
+
+    def test_add_rps_skips_existing_candidates(self):
+        self.rp_candidates.add_rps(
+            set([('ss1', 'root'), ('ss2', 'root')]), 'rc_1')
+        self.assertEqual(6, len(self.rp_candidates))
+        self.assertIn(('ss2', 'root', 'rc_1'), self.rp_candidates.rps_info)
+        self.assertEqual(
+            set(['rp1', 'rp2', 'rp3', 'ss1', 'ss2']), self.rp_candidates.rps)
+
+        copied = rp_candidates.RPCandidateList(self.rp_candidates.rps_info)
+        self.assertEqual(self.rp_candidates.rps_info, copied.rps_info)
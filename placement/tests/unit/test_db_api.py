@@ -10,7 +10,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-
+import collections
 from unittest import mock
 
 from oslo_config import cfg
@@ -50,3 +50,52 @@ class DbApiTests(testtools.TestCase):
         # db_api.configure and the second invocation should not
         # have called it again
         configure_mock.assert_called_once()
+
+    @mock.patch.object(db_api, '_RECENT_WRITES', collections.OrderedDict())
+    @mock.patch('time.monotonic', return_value=100.0)
+    def test_use_read_replica(self, mock_time):
+        context = mock.Mock(config=self.conf_fixture.conf)
+        rp_keys = [db_api._provider_key('rp1')]
+
+        # Disabled by default
+        self.conf_fixture.config(
+            slave_connection='sqlite://', group='placement_database')
+        self.assertFalse(db_api._use_read_replica(context, []))
+
+        # No replica configured
+        self.conf_fixture.config(
+            read_replica_routing=True, group='placement')
+        self.conf_fixture.config(
+            slave_connection=None, group='placement_database')
+        self.assertFalse(db_api._use_read_replica(context, []))
+
+        self.conf_fixture.config(
+            slave_connection='sqlite://', group='placement_database')
+        self.assertTrue(db_api._use_read_replica(context, []))
+        self.assertTrue(db_api._use_read_replica(context, rp_keys))
+
+        # The process committed a change of the provider recently
+        conn = mock.Mock(info={})
+        conn.info[db_api._WRITTEN_KEYS] = set(rp_keys)
+        db_api._record_commit(conn)
+        self.assertEqual({}, conn.info)
+        self.assertFalse(db_api._use_read_replica(context, rp_keys))
+        # Other data can still be read from the replica
+        self.assertTrue(db_api._use_read_replica(
+            context, [db_api._provider_key('rp2'), db_api._project_key('p')]))
+        mock_time.return_value = 102.0
+        self.assertTrue(db_api._use_read_replica(context, rp_keys))
+        # The expired writes are forgotten
+        self.assertEqual({}, db_api._RECENT_WRITES)
+
+        db_api._record_commit(mock.Mock(info={db_api._WRITTEN_KEYS: rp_keys}))
+        self.conf_fixture.config(read_replica_lag=5, group='placement')
+        mock_time.return_value = 106.0
+        self.assertFalse(db_api._use_read_replica(context, rp_keys))
+
+        # Rolled back writes are not recorded
+        db_api._RECENT_WRITES.clear()
+        conn = mock.Mock(info={db_api._WRITTEN_KEYS: set(rp_keys)})
+        db_api._record_rollback(conn)
+        db_api._record_commit(conn)
+        self.assertTrue(db_api._use_read_replica(context, rp_keys))
@@ -1483,15 +1483,20 @@ class RoundRobinTests(testtools.TestCase):
 
 class ProductGeneratorTest(testtools.TestCase):
     @staticmethod
-    def _no_skip(*args, **kwargs):
-        return False
+    def _accept(*args, **kwargs):
+        return True
+
+    @staticmethod
+    def _no_op(*args, **kwargs):
+        pass
 
     def test_no_input(self):
         self.assertEqual(
-            [()], list(util.filtered_product(should_skip=self._no_skip)))
+            [()], list(util.tracked_product(self._accept, self._no_op)))
 
     def test_full_product_no_pruning(self):
-        product = list(util.filtered_product(self._no_skip, [0, 1], [0, 1]))
+        product = list(util.tracked_product(
+            self._accept, self._no_op, [0, 1], [0, 1]))
         self.assertEqual(4, len(product))
         self.assertEqual([(0, 0), (0, 1), (1, 0), (1, 1)], product)
 
@@ -1499,41 +1504,49 @@ class ProductGeneratorTest(testtools.TestCase):
         """This test shows that the filtering removes products from the
         results that are invalid
         """
+        state = set()
 
-        def reject_if_non_unique_items(partial_product):
+        def push(item):
             # A simple check that rejects a partial candidate if any of the
             # items in the candidate are non-unique
-            return len(set(partial_product)) != len(partial_product)
+            if item in state:
+                return False
+            state.add(item)
+            return True
 
-        product = list(util.filtered_product(
-            reject_if_non_unique_items, [0, 1], [0, 1]))
+        product = list(util.tracked_product(
+            push, state.remove, [0, 1], [0, 1]))
         self.assertEqual(2, len(product))
         self.assertEqual([(0, 1), (1, 0)], product)
 
     def test_product_with_pruning(self):
-        """This test shows that if the filter rejects partial candidates then
+        """This test shows that if push rejects partial candidates then
         the product generation will skip generating any product with that
         partial prefix and therefore takes fewer steps than the same
         itertools.product() call.
         """
-        mock_filter = mock.Mock(return_value=False)
-        product = list(
-            util.filtered_product(mock_filter, *([range(3)] * 3)))
+        mock_push = mock.Mock(return_value=True)
+        product = list(util.tracked_product(
+            mock_push, self._no_op, *([range(3)] * 3)))
         self.assertEqual(27, len(product))
         self.assertEqual(product, list(itertools.product(*([range(3)] * 3))))
 
         nr_of_check_calls = 0
+        state = set()
 
-        def reject_if_non_unique_items(partial_product):
+        def push(item):
             # A simple check that rejects a partial candidate if any of the
             # items in the candidate are non-unique. While counting the
             # number of times the check is called.
             nonlocal nr_of_check_calls
             nr_of_check_calls += 1
-            return len(set(partial_product)) != len(partial_product)
+            if item in state:
+                return False
+            state.add(item)
+            return True
 
-        product = list(util.filtered_product(
-            reject_if_non_unique_items, *([range(3)] * 3)))
+        product = list(util.tracked_product(
+            push, state.remove, *([range(3)] * 3)))
         self.assertEqual(6, len(product))
         self.assertEqual(
             [(0, 1, 2),
@@ -1544,7 +1557,84 @@ class ProductGeneratorTest(testtools.TestCase):
              (2, 1, 0)],
             product)
 
-        # If a filter is provided that rejected partial candidates then the
-        # product generation does fewer actual steps, this is the pruning we
-        # want
-        self.assertLess(nr_of_check_calls, len(mock_filter.mock_calls))
+        # If push rejected partial candidates then the product generation
+        # does fewer actual steps, this is the pruning we want
+        self.assertLess(nr_of_check_calls, len(mock_push.mock_calls))
+
+    def test_tracked_product(self):
+        """This test shows that the state kept by push and pop always reflects
+        the partial product, so a check can be done incrementally.
+        """
+        state = []
+        pushed = []
+
+        def push(item):
+            pushed.append(item)
+            # Reject the partial candidate if its items are non-unique
+            if item in state:
+                return False
+            state.append(item)
+            return True
+
+        def pop(item):
+            self.assertEqual(item, state.pop())
+
+        product = list(util.tracked_product(push, pop, *([range(3)] * 3)))
+        self.assertEqual(
+            list(itertools.permutations(range(3))), product)
+        # Each item is checked once per valid prefix
+        self.assertEqual(3 + 3 * 3 + 6 * 3, len(pushed))
+        self.assertEqual([], state)
+
+    def test_tracked_product_symmetry_key(self):
+        """This test shows that the items having the same symmetry key as
+        an item no product was found with are skipped.
+        """
+        # Each of the 3 tokens can be used once, but 4 are needed.
+        iterables = [range(3)] * 4
+
+        def run(symmetry_key):
+            state = []
+            pushed = []
+
+            def push(item):
+                pushed.append(item)
+                if item in state:
+                    return False
+                state.append(item)
+                return True
+
+            def pop(item):
+                self.assertEqual(item, state.pop())
+
+            def key(item):
+                # The unused tokens are interchangeable
+                return item in state
+
+            product = list(util.tracked_product(
+                push, pop, *iterables,
+                symmetry_key=key if symmetry_key else None))
+            self.assertEqual([], state)
+            return product, len(pushed)
+
+        product, pushes = run(symmetry_key=False)
+        self.assertEqual([], product)
+        self.assertEqual(3 + 3 * 3 + 6 * 3 + 6 * 3, pushes)
+
+        product, pushes = run(symmetry_key=True)
+        self.assertEqual([], product)
+        # Only the first unused token is tried on each level, the used ones
+        # are still pushed and rejected
+        self.assertEqual(1 + 2 + 3 + 3, pushes)
+
+        # The symmetry key does not change the products found
+        iterables = [range(3)] * 3
+        self.assertEqual(run(symmetry_key=False)[0], run(symmetry_key=True)[0])
+
+    def test_tracked_product_empty_iterable(self):
+        push = mock.Mock(return_value=True)
+        pop = mock.Mock()
+        self.assertEqual(
+            [], list(util.tracked_product(push, pop, [0, 1], [], [0, 1])))
+        self.assertEqual(push.call_count, pop.call_count)
+        self.assertEqual([()], list(util.tracked_product(push, pop)))
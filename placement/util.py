@@ -628,52 +628,84 @@ def roundrobin(*iterables):
         yield from map(next, iterators)
 
 
-def filtered_product(should_skip, *iterables):
-    """Recursively generates the Cartesian product of a list of iterables,
-    allowing for parts of the product space to be skipped.
-
-    :param should_skip: A function that takes a partial product (a tuple)
-        and returns True if the rest of this product branch should be
-        skipped (pruned), False otherwise.
+def tracked_product(push, pop, *iterables, symmetry_key=None):
+    """Iteratively generates the Cartesian product of a list of iterables,
+    allowing for parts of the product space to be skipped based on a state
+    the caller keeps up to date with the partial product.
+
+    :param push: A function called with an item before appending it to the
+        partial product. It returns False if the partial product extended with
+        the item should be skipped (pruned), in which case it must leave the
+        state unchanged, True otherwise.
+    :param pop: A function called with an item when it is removed from the
+        partial product. It is called exactly once for each item push returned
+        True for.
     :param iterables: A list of iterables to find the product of.
+    :param symmetry_key: An optional function called with an item of the
+        current level and the state of the partial product before the item is
+        pushed. It returns a hashable key, or None. Items of the same level
+        having the same key for the same partial product must either both or
+        neither have products starting with the partial product extended with
+        them, so if no product was found with one of them the others are
+        skipped.
     :yield: Tuples representing the elements of the Cartesian product. For each
-        returned product the caller can assume that the function should_skip
-        returned False.
+        returned product the caller can assume that push returned True for
+        every item of it.
     """
     # Convert iterables to tuples to ensure they can be iterated over multiple
     # times.
-    frozen_iterables = tuple(map(tuple, iterables))
-    num_iterables = len(frozen_iterables)
-
-    def _generate(index: int, current_product):
-        """A nested recursive helper function to generate the product."""
-        # Base case. If we have processed all iterables, we have a complete
-        # product.
-        if index == num_iterables:
-            yield current_product
-            return
-
-        # Iterate through items in the current iterable and extend the
-        # current partial product to see if we should continue or backtrack.
-        for item in frozen_iterables[index]:
-            new_partial_product = current_product + (item,)
-
-            # Check if we should skip this entire branch. This is the core of
-            # the pruning logic.
-            if should_skip(new_partial_product):
-                # Move to the next item on the current level, pruning any
-                # product with the same invalid prefix.
-                continue
-
-            # If not skipped, recurse to the next level to get a longer
-            # partial product
-            yield from _generate(index + 1, new_partial_product)
+    pools = tuple(map(tuple, iterables))
+    last = len(pools) - 1
 
     # If the input list is empty, the cartesian product is one empty tuple.
-    if not frozen_iterables:
+    if last < 0:
         yield ()
         return
 
-    # Start the recursion with an empty partial product and asking for
-    # appending the first item to it from the first iterable.
-    yield from _generate(0, ())
+    product = []
+    # The index of the next item to try in each pool up to the current depth
+    # of the partial product.
+    positions = [0]
+    # The symmetry keys of the items of each level up to the current depth
+    # that no product was found with, extending the current partial product.
+    failed = [set()]
+    # The number of products yielded before each item of the partial product
+    # was appended.
+    marks = []
+    yielded = 0
+    while positions:
+        depth = len(positions) - 1
+        pool = pools[depth]
+        position = positions[depth]
+        if position == len(pool):
+            # Backtrack as we ran out of items on this level.
+            positions.pop()
+            failed.pop()
+            if product:
+                item = product.pop()
+                pop(item)
+                if marks.pop() == yielded and symmetry_key is not None:
+                    # The state is the same as before the item was pushed.
+                    key = symmetry_key(item)
+                    if key is not None:
+                        failed[-1].add(key)
+            continue
+        positions[depth] = position + 1
+
+        item = pool[position]
+        if failed[depth] and symmetry_key(item) in failed[depth]:
+            # No product can be found with this item either.
+            continue
+        if not push(item):
+            # Move to the next item on the current level, pruning any
+            # product with the same invalid prefix.
+            continue
+        product.append(item)
+        if depth == last:
+            yielded += 1
+            yield tuple(product)
+            pop(product.pop())
+        else:
+            positions.append(0)
+            failed.append(set())
+            marks.append(yielded)